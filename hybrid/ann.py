@@ -0,0 +1,435 @@
+import threading
+import numpy as np
+
+
+def normalize(vector):
+    vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+    norm = np.linalg.norm(vector)
+    if norm > 0:
+        vector = vector / norm
+    return vector
+
+
+def vote(labels, similarities):
+    """
+    Identity chosen by the neighbors, each voting with its similarity.
+    Returns (pid, cosine distance of its closest neighbor).
+    """
+    pids, inverse = np.unique(labels, return_inverse=True)
+    scores = np.bincount(inverse, weights=similarities)
+    best = int(np.argmax(scores))
+    return int(pids[best]), float(1.0 - similarities[inverse == best].max())
+
+
+class SampleRows:
+    """Contiguous block of normalized samples with their (pid, slot) keys"""
+
+    def __init__(self, dim, capacity=1024):
+        self.vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self.pids = np.full(capacity, -1, dtype=np.int64)
+        self.slots = np.zeros(capacity, dtype=np.int64)
+        self.size = 0
+
+    def append(self, pid, slot, vector):
+        if self.size == len(self.pids):
+            capacity = 2 * len(self.pids)
+            for name in ("vectors", "pids", "slots"):
+                old = getattr(self, name)
+                new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+                new[: self.size] = old[: self.size]
+                setattr(self, name, new)
+        row = self.size
+        self.vectors[row] = vector
+        self.pids[row] = pid
+        self.slots[row] = slot
+        self.size += 1
+        return row
+
+    def pop(self, row):
+        """Remove a row moving the last one into it, returns the moved key"""
+        last = self.size - 1
+        self.size = last
+        if row == last:
+            return None
+        self.vectors[row] = self.vectors[last]
+        self.pids[row] = self.pids[last]
+        self.slots[row] = self.slots[last]
+        return int(self.pids[row]), int(self.slots[row])
+
+    def candidates(self, query, pids=None):
+        """(pids, similarities) of the rows, optionally only of some identities"""
+        labels = self.pids[: self.size]
+        similarities = self.vectors[: self.size] @ query
+        if pids is not None:
+            mask = np.isin(labels, pids)
+            return labels[mask], similarities[mask]
+        return labels, similarities
+
+
+class FlatSampleIndex:
+    """
+    Exact k-NN over every stored sample of every identity.
+
+    Each gallery slot owns one row, so a rotating gallery only overwrites
+    rows in place; removing an identity swaps the last rows into its holes.
+    """
+
+    def __init__(self, k=10):
+        self.k = k
+        self.rows = None
+        self.where = {}
+        self.slots = {}
+
+    def __len__(self):
+        return len(self.where)
+
+    def __contains__(self, pid):
+        return pid in self.slots
+
+    def _rows_for(self, vector):
+        if self.rows is None:
+            self.rows = SampleRows(vector.shape[0])
+        return self.rows, 0
+
+    def put(self, pid, slot, embedding):
+        """Insert the sample stored at a gallery slot, replacing the old one"""
+        vector = normalize(embedding)
+        key = (pid, slot)
+        if key in self.where:
+            self._remove_key(key)
+        rows, block = self._rows_for(vector)
+        row = rows.append(pid, slot, vector)
+        self.where[key] = (block, row)
+        self.slots.setdefault(pid, set()).add(slot)
+
+    def _block(self, block):
+        return self.rows
+
+    def _remove_key(self, key):
+        block, row = self.where.pop(key)
+        moved = self._block(block).pop(row)
+        if moved is not None:
+            self.where[moved] = (block, row)
+
+    def remove(self, pid):
+        """Drop every sample of an identity"""
+        for slot in self.slots.pop(pid, ()):
+            self._remove_key((pid, slot))
+
+    def _candidates(self, query, pids):
+        if self.rows is None:
+            return np.empty(0, np.int64), np.empty(0, np.float32)
+        return self.rows.candidates(query, pids)
+
+    def search(self, embedding, pids=None):
+        """
+        Vote among the k nearest samples, returns (pid, cosine distance)
+        or None when nothing can be matched
+        """
+        query = normalize(embedding)
+        if pids is not None:
+            pids = np.fromiter(pids, dtype=np.int64)
+        labels, similarities = self._candidates(query, pids)
+        if labels.size == 0:
+            return None
+        if labels.size > self.k:
+            top = np.argpartition(similarities, -self.k)[-self.k :]
+            labels, similarities = labels[top], similarities[top]
+        return vote(labels, similarities)
+
+    def get_status(self):
+        return {"backend": "flat", "samples": len(self), "identities": len(self.slots)}
+
+
+class IVFSampleIndex(FlatSampleIndex):
+    """
+    Inverted-file k-NN: samples are grouped by their nearest k-means
+    centroid and a query only scans the nprobe closest lists.
+
+    Until train_size samples exist everything lives in a single list and
+    the search is exact. The quantizer is retrained whenever the index has
+    grown retrain_factor times since the last training. Training runs on a
+    copy of the samples in a background thread while searches keep using
+    the current lists; samples put or removed meanwhile are journaled and
+    replayed when the new lists are swapped in.
+    """
+
+    def __init__(
+        self, k=10, nlist=0, nprobe=8, train_size=4096, retrain_factor=4, seed=0
+    ):
+        super().__init__(k)
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.train_size = train_size
+        self.retrain_factor = retrain_factor
+        self.rng = np.random.default_rng(seed)
+        self.centroids = None
+        self.lists = []
+        self.trained_at = 0
+        self.trainer = None
+        self.trained = None
+        self.journal = None
+
+    def _block(self, block):
+        return self.lists[block]
+
+    def _rows_for(self, vector):
+        if not self.lists:
+            self.lists.append(SampleRows(vector.shape[0]))
+        if self.centroids is None:
+            return self.lists[0], 0
+        block = int(np.argmax(self.centroids @ vector))
+        return self.lists[block], block
+
+    def _remove_key(self, key):
+        super()._remove_key(key)
+        if self.journal is not None:
+            self.journal[key] = None
+
+    def put(self, pid, slot, embedding):
+        self._swap()
+        super().put(pid, slot, embedding)
+        if self.journal is not None:
+            block, row = self.where[(pid, slot)]
+            self.journal[(pid, slot)] = self.lists[block].vectors[row].copy()
+        size = len(self.where)
+        if (
+            self.trainer is None
+            and size >= self.train_size
+            and size >= self.retrain_factor * self.trained_at
+        ):
+            self.train()
+
+    def remove(self, pid):
+        self._swap()
+        super().remove(pid)
+
+    def search(self, embedding, pids=None):
+        self._swap()
+        return super().search(embedding, pids)
+
+    def _kmeans(self, data, nlist, iterations=10):
+        centroids = data[self.rng.choice(len(data), nlist, replace=False)].copy()
+        for _ in range(iterations):
+            assignment = np.argmax(data @ centroids.T, axis=1)
+            for c in range(nlist):
+                members = data[assignment == c]
+                if len(members):
+                    centroids[c] = normalize(members.sum(axis=0))
+                else:
+                    centroids[c] = data[self.rng.integers(len(data))]
+        return centroids
+
+    def train(self, background=True):
+        """
+        Fit the coarse quantizer on a copy of the samples and redistribute
+        them, in a background thread unless background is False
+        """
+        vectors = np.concatenate([b.vectors[: b.size] for b in self.lists])
+        pids = np.concatenate([b.pids[: b.size] for b in self.lists])
+        slots = np.concatenate([b.slots[: b.size] for b in self.lists])
+        self.journal = {}
+        self.trainer = threading.Thread(
+            target=self._fit, args=(vectors, pids, slots), daemon=True
+        )
+        self.trainer.start()
+        if not background:
+            self.trainer.join()
+            self._swap()
+
+    def _fit(self, vectors, pids, slots):
+        dim = vectors.shape[1]
+        nlist = self.nlist or max(1, int(4 * np.sqrt(len(vectors))))
+        nlist = min(nlist, len(vectors))
+        sample = vectors[
+            self.rng.choice(len(vectors), min(len(vectors), 64 * nlist), replace=False)
+        ]
+        centroids = self._kmeans(sample, nlist)
+
+        assignment = np.argmax(vectors @ centroids.T, axis=1)
+        lists = [SampleRows(dim, 64) for _ in range(nlist)]
+        where = {}
+        for vector, pid, slot, block in zip(vectors, pids, slots, assignment):
+            row = lists[block].append(pid, slot, vector)
+            where[(int(pid), int(slot))] = (int(block), row)
+        self.trained = (centroids, lists, where, len(vectors))
+
+    def _swap(self):
+        """Install the lists of a finished training, replaying the journal"""
+        if self.trained is None:
+            return
+        centroids, lists, where, trained_at = self.trained
+        journal = self.journal
+        self.trainer.join()
+        self.trained = self.journal = self.trainer = None
+        self.centroids, self.lists, self.where = centroids, lists, where
+        self.trained_at = trained_at
+        for key, vector in journal.items():
+            if key in self.where:
+                self._remove_key(key)
+            if vector is not None:
+                rows, block = self._rows_for(vector)
+                self.where[key] = (block, rows.append(key[0], key[1], vector))
+
+    def _candidates(self, query, pids):
+        if not self.lists:
+            return np.empty(0, np.int64), np.empty(0, np.float32)
+        if self.centroids is None:
+            blocks = [0]
+        else:
+            scores = self.centroids @ query
+            nprobe = min(self.nprobe, len(scores))
+            blocks = np.argpartition(scores, -nprobe)[-nprobe:]
+        parts = [self.lists[b].candidates(query, pids) for b in blocks]
+        return (
+            np.concatenate([labels for labels, _ in parts]),
+            np.concatenate([similarities for _, similarities in parts]),
+        )
+
+    def get_status(self):
+        status = super().get_status()
+        status.update(
+            {
+                "backend": "ivf",
+                "lists": len(self.lists),
+                "trained_at": self.trained_at,
+                "training": self.trainer is not None,
+            }
+        )
+        return status
+
+
+class HNSWSampleIndex:
+    """
+    Graph k-NN backed by hnswlib, only imported when this backend is used.
+    Deleted samples are marked and their labels reused by later inserts.
+    """
+
+    def __init__(self, k=10, max_elements=100000, m=16, ef_construction=200, ef=64):
+        import hnswlib
+
+        self.hnswlib = hnswlib
+        self.k = k
+        self.max_elements = max_elements
+        self.m = m
+        self.ef_construction = ef_construction
+        self.ef = ef
+        self.graph = None
+        self.labels = {}
+        self.keys = {}
+        self.slots = {}
+        self.free = []
+        self.next_label = 0
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __contains__(self, pid):
+        return pid in self.slots
+
+    def _graph(self, dim):
+        if self.graph is None:
+            self.graph = self.hnswlib.Index(space="ip", dim=dim)
+            self.graph.init_index(
+                self.max_elements,
+                self.m,
+                self.ef_construction,
+                allow_replace_deleted=True,
+            )
+            self.graph.set_ef(self.ef)
+        return self.graph
+
+    def put(self, pid, slot, embedding):
+        vector = normalize(embedding)
+        graph = self._graph(vector.shape[0])
+        key = (pid, slot)
+        if key in self.labels:
+            self._remove_key(key)
+        if self.free:
+            label = self.free.pop()
+            graph.add_items(vector[None], [label], replace_deleted=True)
+        else:
+            if self.next_label == graph.get_max_elements():
+                graph.resize_index(2 * self.next_label)
+            label = self.next_label
+            self.next_label += 1
+            graph.add_items(vector[None], [label])
+        self.labels[key] = label
+        self.keys[label] = key
+        self.slots.setdefault(pid, set()).add(slot)
+
+    def _remove_key(self, key):
+        label = self.labels.pop(key)
+        del self.keys[label]
+        self.graph.mark_deleted(label)
+        self.free.append(label)
+
+    def remove(self, pid):
+        for slot in self.slots.pop(pid, ()):
+            self._remove_key((pid, slot))
+
+    def search(self, embedding, pids=None):
+        if not self.labels:
+            return None
+        query = normalize(embedding)
+        available = len(self.labels)
+        allowed = None
+        if pids is not None:
+            pids = set(pids)
+            available = sum(len(self.slots.get(pid, ())) for pid in pids)
+            allowed = lambda label: self.keys[label][0] in pids
+        if available == 0:
+            return None
+        k = min(self.k, available)
+        try:
+            found, distances = self.graph.knn_query(query, k=k, filter=allowed)
+        except RuntimeError:
+            # The graph walk reached fewer than k allowed samples
+            return self._exact_search(query, pids)
+        labels = np.array([self.keys[label][0] for label in found[0]], dtype=np.int64)
+        return vote(labels, 1.0 - distances[0])
+
+    def _exact_search(self, query, pids):
+        """Brute-force vote over the stored vectors of the allowed samples"""
+        if pids is None:
+            found = list(self.keys)
+        else:
+            found = [
+                self.labels[(pid, slot)]
+                for pid in pids
+                for slot in self.slots.get(pid, ())
+            ]
+        vectors = np.asarray(self.graph.get_items(found), dtype=np.float32)
+        similarities = vectors @ query
+        labels = np.array([self.keys[label][0] for label in found], dtype=np.int64)
+        if labels.size > self.k:
+            top = np.argpartition(similarities, -self.k)[-self.k :]
+            labels, similarities = labels[top], similarities[top]
+        return vote(labels, similarities)
+
+    def get_status(self):
+        return {"backend": "hnsw", "samples": len(self), "identities": len(self.slots)}
+
+
+def create_sample_index(knn_cfg):
+    """Sample index described by the reid.knn config"""
+    backend = knn_cfg.get("backend", "flat")
+    k = knn_cfg.get("k", 10)
+    if backend == "flat":
+        return FlatSampleIndex(k)
+    if backend == "ivf":
+        return IVFSampleIndex(
+            k,
+            knn_cfg.get("nlist", 0),
+            knn_cfg.get("nprobe", 8),
+            knn_cfg.get("train_size", 4096),
+        )
+    if backend == "hnsw":
+        return HNSWSampleIndex(
+            k,
+            knn_cfg.get("max_elements", 100000),
+            knn_cfg.get("m", 16),
+            knn_cfg.get("ef_construction", 200),
+            knn_cfg.get("ef", 64),
+        )
+    raise ValueError(f"Unsupported knn backend: {backend}")
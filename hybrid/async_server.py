@@ -0,0 +1,457 @@
+import asyncio
+import multiprocessing
+import queue
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from server import PersonReidentificationServer
+from embedding import extract_embeddings
+from pipeline import decode_crops, embed_frames, init_embed_worker
+from protocol import parse_header, decode_embedding, HEADER_SIZE, MSG_EMBEDDING
+
+
+class ReceiverProtocol(asyncio.DatagramProtocol):
+    """Datagram endpoint that feeds the decode stage of the async server"""
+
+    def __init__(self, server, receiver):
+        self.server = server
+        self.reassembler = server.reassemblers[receiver]
+
+    def datagram_received(self, data, addr):
+        header = parse_header(data)
+        if header is None or HEADER_SIZE + header.payload_size > len(data):
+            self.server.logger.warning("Received packet with invalid header")
+            return
+
+        payload = memoryview(data)[HEADER_SIZE : HEADER_SIZE + header.payload_size]
+        crop = self.reassembler.add(header, payload)
+        if crop is None:
+            return
+
+        header, buffer = crop
+        received = time.monotonic()
+        self.server.observe_received(header)
+        if header.msg_type == MSG_EMBEDDING:
+            # Edge-First nodes already extracted the features
+            item = {
+                "embedding": decode_embedding(buffer),
+                "client_name": header.camera,
+                "header": header,
+                "received": received,
+            }
+            self.server.put("assign", item)
+            return
+
+        self.server.put(
+            "decode",
+            {
+                "buffer": buffer,
+                "pool_buffer": None,
+                "client_name": header.camera,
+                "header": header,
+                "received": received,
+            },
+            header.camera,
+        )
+
+    def error_received(self, exc):
+        self.server.logger.error(f"Socket error in receiver: {exc}")
+
+
+class AsyncPersonReidentificationServer(PersonReidentificationServer):
+    """
+    asyncio runtime of the server.
+
+    Datagrams are received by a DatagramProtocol on the event loop, decode
+    and embedding run in executors and identity assignment runs on a
+    single-thread executor so the gallery keeps one writer. Commands come
+    from stdin and, optionally, from a localhost control socket.
+    """
+
+    def __init__(self, config_path="config.yaml"):
+        super().__init__(config_path)
+        self.loop = None
+        self.ready = {}
+        self.tasks = {}
+        self.transports = []
+        self.expire_task = None
+        self.assign_pool = None
+        self.stopped = None
+
+    def put(self, stage, item, key=None):
+        """Queue an item for a stage and wake up its workers"""
+        self.stages[stage].put(item, key)
+        self.ready[stage].set()
+
+    async def next_batch(self, stage, batch_size, timeout):
+        """asyncio counterpart of pipeline.next_batch"""
+        source = self.stages[stage]
+        ready = self.ready[stage]
+        while True:
+            try:
+                item = source.queue.get_nowait()
+                break
+            except queue.Empty:
+                ready.clear()
+                await ready.wait()
+        if item is None:
+            return None
+
+        batch = [item]
+        deadline = self.loop.time() + timeout
+        while len(batch) < batch_size:
+            try:
+                item = source.queue.get_nowait()
+            except queue.Empty:
+                remaining = deadline - self.loop.time()
+                if remaining <= 0:
+                    break
+                ready.clear()
+                try:
+                    await asyncio.wait_for(ready.wait(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                continue
+            if item is None:
+                # Leave the sentinel for the next call so this batch still runs
+                self.put(stage, None)
+                break
+            batch.append(item)
+        return batch
+
+    async def decode_frames(self):
+        pipeline_cfg = self.cfg.get("pipeline", {})
+        batch_size = pipeline_cfg.get("decode_batch_size", 32)
+        batch_timeout = pipeline_cfg.get("decode_timeout_ms", 5) / 1000
+
+        while True:
+            batch = await self.next_batch("decode", batch_size, batch_timeout)
+            if batch is None:
+                break
+
+            buffers = [item["buffer"] for item in batch]
+            if isinstance(self.decode_pool, ProcessPoolExecutor):
+                buffers = [bytes(buffer) for buffer in buffers]
+            try:
+                frames = await self.loop.run_in_executor(
+                    self.decode_pool, decode_crops, buffers
+                )
+            except Exception as e:
+                self.logger.error(f"Could not decode {len(batch)} images: {e}")
+                continue
+
+            decoded = time.monotonic()
+            for item, frame in zip(batch, frames):
+                if frame is None:
+                    self.logger.error(
+                        f"Could not decode image from {item['client_name']}"
+                    )
+                    continue
+                self.put(
+                    "embed",
+                    {
+                        "frame": frame,
+                        "client_name": item["client_name"],
+                        "header": item["header"],
+                        "received": item["received"],
+                        "decoded": decoded,
+                    },
+                    item["client_name"],
+                )
+            self.stages["decode"].done(len(batch))
+
+    async def extract_features(self):
+        reid_cfg = self.cfg.get("reid", {})
+        batch_size = reid_cfg.get("batch_size", 16)
+        batch_timeout = reid_cfg.get("batch_timeout_ms", 20) / 1000
+
+        while True:
+            batch = await self.next_batch("embed", batch_size, batch_timeout)
+            if batch is None:
+                break
+
+            frames = [item["frame"] for item in batch]
+            try:
+                if isinstance(self.embed_pool, ProcessPoolExecutor):
+                    embeddings = await self.loop.run_in_executor(
+                        self.embed_pool, embed_frames, frames
+                    )
+                else:
+                    embeddings = await self.loop.run_in_executor(
+                        self.embed_pool, extract_embeddings, self.embedder, frames
+                    )
+            except Exception as e:
+                self.logger.error(f"Exception extracting {len(batch)} embeddings: {e}")
+                continue
+
+            embedded = time.monotonic()
+            # One queue entry per crop, so the assign depth counts crops
+            for item, embedding in zip(batch, embeddings):
+                self.put(
+                    "assign",
+                    {
+                        "embedding": embedding,
+                        "client_name": item["client_name"],
+                        "header": item["header"],
+                        "received": item["received"],
+                        "decoded": item["decoded"],
+                        "embedded": embedded,
+                    },
+                )
+            self.stages["embed"].done(len(batch))
+
+    def assign_batch(self, items):
+        for item in items:
+            client_name = item["client_name"]
+            try:
+                self.assign_identity(item["embedding"], client_name, item["header"])
+                self.observe_assigned(item)
+            except Exception as e:
+                self.logger.error(f"Exception processing frame from {client_name}: {e}")
+
+    async def reId(self):
+        batch_size = self.cfg.get("reid", {}).get("batch_size", 16)
+        while True:
+            # Whatever is already queued goes to the executor in one hop
+            batch = await self.next_batch("assign", batch_size, 0)
+            if batch is None:
+                break
+            await self.loop.run_in_executor(self.assign_pool, self.assign_batch, batch)
+            self.stages["assign"].done(len(batch))
+
+    async def broadcast_async(self, message):
+        """Run broadcast off the loop, it waits for the node acks"""
+        return await self.loop.run_in_executor(None, self.broadcast, message)
+
+    async def warmup_async(self, max_retries=100, retry_delay=0.1):
+        """Same warmup handshake as warmup without blocking the loop"""
+        await self.broadcast_async("warmup")
+        self.logger.info("Warmup routine started")
+        self.server.setblocking(False)
+        try:
+            await asyncio.wait_for(
+                self.loop.sock_recv(self.server, 4), max_retries * retry_delay
+            )
+            success = True
+        except (asyncio.TimeoutError, OSError):
+            success = False
+        self.logger.info("Warmup routine finished")
+        return success
+
+    async def start_processing(self):
+        if self.command == "start":
+            self.logger.warning("Processing already started")
+            return
+
+        self.command = "start"
+        if not self.transports:
+            await self.warmup_async()
+        await self.broadcast_async(self.command)
+
+        pipeline_cfg = self.cfg.get("pipeline", {})
+        if pipeline_cfg.get("executor", "thread") == "process":
+            context = multiprocessing.get_context("spawn")
+            self.decode_pool = ProcessPoolExecutor(
+                max_workers=self.stages["decode"].workers, mp_context=context
+            )
+            self.embed_pool = ProcessPoolExecutor(
+                max_workers=self.stages["embed"].workers,
+                mp_context=context,
+                initializer=init_embed_worker,
+                initargs=(self.cfg.get("reid", {}),),
+            )
+        else:
+            self.decode_pool = ThreadPoolExecutor(self.stages["decode"].workers)
+            self.embed_pool = ThreadPoolExecutor(self.stages["embed"].workers)
+        self.assign_pool = ThreadPoolExecutor(1)
+
+        workers = {
+            "decode": self.decode_frames,
+            "embed": self.extract_features,
+            "assign": self.reId,
+        }
+        for name, stage in self.stages.items():
+            self.tasks[name] = [
+                self.loop.create_task(workers[name]()) for _ in range(stage.workers)
+            ]
+        self.expire_task = self.loop.create_task(self.expire_chunks())
+        self.start_controller()
+
+        if self.transports:
+            for transport in self.transports:
+                transport.resume_reading()
+        else:
+            for receiver, sock in enumerate(self.receivers):
+                sock.setblocking(False)
+                transport, _ = await self.loop.create_datagram_endpoint(
+                    lambda r=receiver: ReceiverProtocol(self, r), sock=sock
+                )
+                self.transports.append(transport)
+
+        self.logger.info("Processing started - asyncio runtime")
+
+    async def expire_chunks(self):
+        """Periodically drop partial crops while processing"""
+        interval = max(self.reassemblers[0].timeout / 2, 0.1)
+        while True:
+            await asyncio.sleep(interval)
+            now = time.time()
+            for reassembler in self.reassemblers:
+                reassembler.expire(now)
+
+    async def stop_processing(self, notify_nodes=False):
+        """Stop receiving, drain every stage in order and release executors"""
+        if self.command != "start":
+            return
+
+        self.command = "stop"
+        if notify_nodes:
+            await self.broadcast_async("exit")
+
+        # Transports are only paused so processing can be started again
+        for transport in self.transports:
+            transport.pause_reading()
+        if self.expire_task is not None:
+            self.expire_task.cancel()
+            self.expire_task = None
+
+        for name, stage in self.stages.items():
+            for _ in range(stage.workers):
+                self.put(name, None)
+            await asyncio.gather(*self.tasks.pop(name, []), return_exceptions=True)
+
+        for pool in (self.decode_pool, self.embed_pool, self.assign_pool):
+            if pool is not None:
+                # Waiting for in-flight work must not block the event loop
+                await self.loop.run_in_executor(None, pool.shutdown, True)
+        self.decode_pool = None
+        self.embed_pool = None
+        self.assign_pool = None
+
+        self.write_results()
+        self.logger.info("Processing stopped")
+
+    async def handle_command(self, cmd):
+        """Execute a control command and return the text to show"""
+        self.logger.info(f"User command: {cmd}")
+        if cmd == "start":
+            await self.start_processing()
+            return "Processing started"
+        elif cmd == "stop":
+            await self.stop_processing()
+            return "Processing stopped"
+        elif cmd == "exit":
+            self.logger.info("Shutdown command received")
+            if self.command == "start":
+                await self.stop_processing(notify_nodes=True)
+            else:
+                await self.broadcast_async("exit")
+            self.command = "exit"
+            self.running = False
+            self.stopped.set()
+            return "Shutting down"
+        elif cmd == "status":
+            return self.format_status()
+        elif cmd == "cleanup":
+            self.cleanup_threads()
+            return "Thread cleanup completed"
+        elif cmd == "":
+            return ""
+        return "Unknown command. Use 'start', 'stop', 'exit', 'status', or 'cleanup'."
+
+    async def read_stdin(self, headless=False):
+        """
+        Read commands from stdin without blocking the event loop. EOF means
+        exit unless the server is headless, driven by its control socket.
+        """
+        reader = asyncio.StreamReader()
+        await self.loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader), sys.stdin
+        )
+        while self.running:
+            print("server@command# ", end="", flush=True)
+            line = await reader.readline()
+            if not line:
+                if headless:
+                    self.logger.info("stdin closed, commands only via control socket")
+                else:
+                    await self.handle_command("exit")
+                break
+            print(await self.handle_command(line.decode().strip().lower()))
+
+    async def handle_control(self, reader, writer):
+        """One command per line on the local control socket"""
+        try:
+            while self.running:
+                line = await reader.readline()
+                if not line:
+                    break
+                output = await self.handle_command(line.decode().strip().lower())
+                writer.write((output + "\n").encode())
+                await writer.drain()
+        except (asyncio.CancelledError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def main(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        self.ready = {name: asyncio.Event() for name in self.stages}
+        self.running = True
+
+        control = None
+        control_port = self.cfg["server"].get("control_port")
+        if control_port:
+            control = await asyncio.start_server(
+                self.handle_control, "127.0.0.1", control_port
+            )
+            self.logger.info(f"Control socket listening on 127.0.0.1:{control_port}")
+
+        print(
+            "Server started... (type 'start' to begin processing, 'stop' to pause, "
+            "'exit' to quit, 'status' for info)"
+        )
+        stdin_task = self.loop.create_task(self.read_stdin(control is not None))
+        await self.stopped.wait()
+
+        stdin_task.cancel()
+        if control is not None:
+            control.close()
+            await control.wait_closed()
+
+        for transport in self.transports:
+            transport.close()
+        self.transports.clear()
+        with self.server_lock:
+            for sock in self.receivers:
+                sock.close()
+            self.receivers = []
+            self.server = None
+
+    def run(self):
+        """Main server loop"""
+        if not self.initialize():
+            print("[ERROR] Fail initializing")
+            return
+
+        self.logger.info("Initializing Person Re-identification Server (asyncio)...")
+        try:
+            asyncio.run(self.main())
+        except KeyboardInterrupt:
+            self.logger.info("Keyboard interrupt received")
+            print("\nKeyboard interrupt received. Shutting down...")
+            self.broadcast("exit")
+            self.write_results()
+        if self.results is not None:
+            self.results.close()
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+        if self.control is not None:
+            self.control.stop()
+        self.logger.info("Server stopped")
+
+
+if __name__ == "__main__":
+    server = AsyncPersonReidentificationServer("config.yaml")
+    server.run()
@@ -0,0 +1,104 @@
+import argparse
+import time
+import numpy as np
+import yaml
+from detections import result_boxes
+from export import sample_frames
+from inference import load_detector
+from tracker import iou_matrix
+
+
+def run_detector(model, frames, warmup):
+    """Per-frame latencies in milliseconds and the (boxes, confidences) found"""
+    for img in frames[:warmup]:
+        model(img, verbose=False)
+    latencies, detections = [], []
+    for img in frames:
+        start = time.perf_counter()
+        result = model(img, verbose=False)[0]
+        latencies.append((time.perf_counter() - start) * 1000)
+        detections.append(result_boxes(result))
+    return np.array(latencies), detections
+
+
+def agreement(reference, detections, threshold=0.5):
+    """
+    Detections matched one-to-one to the reference ones by IoU: recall and
+    precision against the reference, mean IoU and confidence gap of the
+    matches
+    """
+    matched = found = expected = 0
+    ious, gaps = [], []
+    for (ref_boxes, ref_conf), (boxes, conf) in zip(reference, detections):
+        expected += len(ref_boxes)
+        found += len(boxes)
+        if not len(ref_boxes) or not len(boxes):
+            continue
+        overlap = iou_matrix(ref_boxes, boxes)
+        used = set()
+        for r in np.argsort(-ref_conf):
+            candidates = [b for b in np.argsort(-overlap[r]) if b not in used]
+            if candidates and overlap[r, candidates[0]] >= threshold:
+                b = candidates[0]
+                used.add(b)
+                matched += 1
+                ious.append(overlap[r, b])
+                gaps.append(abs(ref_conf[r] - conf[b]))
+    return {
+        "recall": matched / expected if expected else 1.0,
+        "precision": matched / found if found else 1.0,
+        "iou": float(np.mean(ious)) if ious else 0.0,
+        "conf_gap": float(np.mean(gaps)) if gaps else 0.0,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--config", default="config.yaml", help="config do nó")
+    parser.add_argument(
+        "-b",
+        "--backends",
+        nargs="+",
+        default=["onnx:fp32", "onnx:int8", "openvino:fp32", "openvino:fp16"],
+        help="backend:precisão comparados com pytorch:fp32",
+    )
+    parser.add_argument(
+        "-f", "--frames", type=int, default=200, help="frames tirados dos vídeos"
+    )
+    parser.add_argument(
+        "--warmup", type=int, default=10, help="frames rodados antes de medir"
+    )
+    args = parser.parse_args()
+
+    with open(args.config, "r") as f:
+        cfg = yaml.safe_load(f)
+    videos = [instance["video"] for instance in cfg["instances"]]
+    frames = sample_frames(videos, args.frames)
+
+    variants = ["pytorch:fp32"] + [b for b in args.backends if b != "pytorch:fp32"]
+    reference = None
+    print(
+        f"{'backend':>16} {'mean ms':>9} {'p50 ms':>8} {'p95 ms':>8} "
+        f"{'speedup':>8} {'recall':>7} {'prec':>7} {'iou':>6} {'conf Δ':>7}"
+    )
+    for variant in variants:
+        backend, _, precision = variant.partition(":")
+        model_cfg = dict(cfg["model"], backend=backend, precision=precision or "fp32")
+        try:
+            model = load_detector(model_cfg, videos)
+        except Exception as e:
+            if reference is None:
+                # Sem a referência não há com o que comparar
+                raise
+            print(f"{variant:>16} falhou: {e}")
+            continue
+        latencies, detections = run_detector(model, frames, args.warmup)
+        if reference is None:
+            reference, base = detections, latencies.mean()
+        match = agreement(reference, detections)
+        print(
+            f"{variant:>16} {latencies.mean():9.2f} {np.percentile(latencies, 50):8.2f} "
+            f"{np.percentile(latencies, 95):8.2f} {base / latencies.mean():7.2f}x "
+            f"{match['recall']:7.3f} {match['precision']:7.3f} "
+            f"{match['iou']:6.3f} {match['conf_gap']:7.3f}"
+        )
@@ -0,0 +1,69 @@
+import argparse
+import time
+import numpy as np
+from scipy.spatial import distance
+from gallery import IdentityIndex
+
+
+def build_index(n_identities, dim, rng):
+    """Fill an index with random unit centroids"""
+    index = IdentityIndex(dim=dim, capacity=n_identities)
+    for pid in range(n_identities):
+        index.add(pid, rng.standard_normal(dim).astype(np.float32))
+    return index
+
+
+def bench_index(index, queries):
+    """Average latency of IdentityIndex.search in milliseconds"""
+    start = time.perf_counter()
+    for query in queries:
+        index.search(query)
+    return (time.perf_counter() - start) * 1000 / len(queries)
+
+
+def bench_loop(index, queries):
+    """Average latency of the per-identity scipy loop in milliseconds"""
+    centroids = index.centroids[: index.size]
+    start = time.perf_counter()
+    for query in queries:
+        scores = [distance.cosine(c, query) for c in centroids]
+        int(np.argmin(scores))
+    return (time.perf_counter() - start) * 1000 / len(queries)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-n",
+        "--identities",
+        type=int,
+        nargs="+",
+        default=[1000, 10000, 100000],
+        help="quantidades de identidades na galeria",
+    )
+    parser.add_argument(
+        "-d", "--dim", type=int, default=1280, help="dimensão do embedding"
+    )
+    parser.add_argument(
+        "-q", "--queries", type=int, default=200, help="consultas por tamanho"
+    )
+    parser.add_argument(
+        "--loop-limit",
+        type=int,
+        default=10000,
+        help="maior galeria em que o laço antigo também é medido",
+    )
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    queries = rng.standard_normal((args.queries, args.dim)).astype(np.float32)
+
+    print(f"{'identities':>12} {'index ms':>10} {'loop ms':>10}")
+    for n in args.identities:
+        index = build_index(n, args.dim, rng)
+        index_ms = bench_index(index, queries)
+        if n <= args.loop_limit:
+            loop_ms = f"{bench_loop(index, queries[:10]):10.3f}"
+        else:
+            loop_ms = f"{'-':>10}"
+        print(f"{n:>12} {index_ms:10.3f} {loop_ms}")
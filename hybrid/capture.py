@@ -0,0 +1,122 @@
+import threading
+import time
+import cv2
+
+
+class FrameGrabber:
+    """
+    Reads a video source on its own thread and keeps only the newest
+    sampled frame.
+
+    Frames that are not going to be processed are only grabbed, never
+    decoded. With adaptive sampling a frame is decoded once per measured
+    processing latency, otherwise once every frame_freq frames. Raising
+    min_freq at runtime skips at least that many frames in either mode.
+    """
+
+    def __init__(
+        self, source, frame_freq=1, adaptive=True, pace=True, alpha=0.2, start=0
+    ):
+        self.cam = cv2.VideoCapture(source)
+        if start:
+            # Resume a restarted camera where it stopped
+            self.cam.set(cv2.CAP_PROP_POS_FRAMES, start)
+        fps = self.cam.get(cv2.CAP_PROP_FPS)
+        self.frame_interval = 1.0 / fps if pace and fps and fps > 0 else 0.0
+        self.frame_freq = max(1, frame_freq)
+        self.adaptive = adaptive
+        self.min_freq = 1
+        self.alpha = alpha
+        self.latency = 0.0
+        self.slot = None
+        self.frame_index = start
+        self.grabbed = 0
+        self.decoded = 0
+        self.consumed = 0
+        self.finished = False
+        self.stopped = False
+        self.cond = threading.Condition()
+        self.listeners = []
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped = True
+        self.thread.join()
+        self.cam.release()
+
+    def report_latency(self, seconds):
+        """Feed the processing time of one frame into the moving average"""
+        if self.latency == 0.0:
+            self.latency = seconds
+        else:
+            self.latency += self.alpha * (seconds - self.latency)
+
+    def sample_interval(self):
+        """Minimum time between two decoded frames"""
+        floor = self.min_freq * self.frame_interval if self.min_freq > 1 else 0.0
+        if self.adaptive:
+            return max(self.latency, floor)
+        return max(self.frame_freq * self.frame_interval, floor)
+
+    def run(self):
+        next_time = time.monotonic()
+        last_sample = float("-inf")
+        last_position = None
+        try:
+            while not self.stopped:
+                if self.frame_interval > 0:
+                    delay = next_time - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                    next_time += self.frame_interval
+
+                # Position of the frame in the video, as numbered by the dataset
+                position = self.frame_index
+                self.frame_index += 1
+                now = time.monotonic()
+                if self.frame_interval > 0 or self.adaptive:
+                    wanted = now - last_sample >= self.sample_interval()
+                    if self.frame_interval == 0 and last_position is not None:
+                        # No timing info to turn min_freq into time, count frames
+                        wanted &= position - last_position >= self.min_freq
+                else:
+                    # Unpaced source without timing info, fall back to frame_freq
+                    wanted = position % max(self.frame_freq, self.min_freq) == 0
+
+                if wanted:
+                    ret, img = self.cam.read()
+                    if not ret:
+                        break
+                    last_sample = now
+                    last_position = position
+                    self.decoded += 1
+                    with self.cond:
+                        self.slot = (position, time.time(), img)
+                        self.cond.notify_all()
+                    for listener in self.listeners:
+                        listener.set()
+                elif not self.cam.grab():
+                    break
+                self.grabbed += 1
+        finally:
+            with self.cond:
+                self.finished = True
+                self.cond.notify_all()
+            for listener in self.listeners:
+                listener.set()
+
+    def latest(self, timeout=None):
+        """
+        Take the newest frame as (frame_index, timestamp, image). Returns
+        None on timeout or once the source is exhausted.
+        """
+        with self.cond:
+            self.cond.wait_for(lambda: self.slot is not None or self.finished, timeout)
+            frame, self.slot = self.slot, None
+        if frame is not None:
+            self.consumed += 1
+        return frame
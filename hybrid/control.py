@@ -0,0 +1,351 @@
+import json
+import multiprocessing
+import socket
+import threading
+import time
+import numpy as np
+
+# Node settings the server can override, NaN keeps the node's own config
+SETTINGS = ("frame_freq", "jpeg_quality", "conf")
+# Counters a node keeps for its heartbeats, queued and sent are crops
+STATS = ("grabbed", "decoded", "consumed", "queued", "sent", "latency_ms")
+
+
+def encode_message(message):
+    return json.dumps(message, separators=(",", ":")).encode()
+
+
+def decode_message(data):
+    """
+    Control message as a dict, None if it cannot be parsed. Plain strings
+    from older servers become unacknowledged commands.
+    """
+    try:
+        text = bytes(data).decode()
+    except UnicodeDecodeError:
+        return None
+    if not text.startswith("{"):
+        return {"type": "cmd", "cmd": text.strip()}
+    try:
+        message = json.loads(text)
+    except ValueError:
+        return None
+    return message if isinstance(message, dict) else None
+
+
+class NodeTuning:
+    """
+    Settings pushed by the server and stats reported back, in shared
+    arrays so a camera running in its own process sees the same values
+    """
+
+    def __init__(self, context=None):
+        context = context or multiprocessing
+        self.settings_raw = context.RawArray("d", len(SETTINGS))
+        self.stats_raw = context.RawArray("d", len(STATS))
+        self.__setstate__(self.__getstate__())
+        self.settings[:] = np.nan
+
+    def __getstate__(self):
+        # The numpy views cannot be pickled, the shared arrays can
+        return {"settings_raw": self.settings_raw, "stats_raw": self.stats_raw}
+
+    def __setstate__(self, state):
+        self.settings_raw = state["settings_raw"]
+        self.stats_raw = state["stats_raw"]
+        self.settings = np.frombuffer(self.settings_raw, dtype=np.float64)
+        self.stats = np.frombuffer(self.stats_raw, dtype=np.float64)
+
+    def setting(self, name, default):
+        """Override of a setting, or default when the server set none"""
+        value = self.settings[SETTINGS.index(name)]
+        return default if np.isnan(value) else value
+
+    def apply(self, settings):
+        """Store the settings of a 'set' command, None clears an override"""
+        for name, value in settings.items():
+            if name in SETTINGS:
+                self.settings[SETTINGS.index(name)] = np.nan if value is None else value
+
+    def count(self, name, n=1):
+        self.stats[STATS.index(name)] += n
+
+    def report(self, **stats):
+        for name, value in stats.items():
+            self.stats[STATS.index(name)] = value
+
+    def get_status(self):
+        return {
+            "stats": dict(zip(STATS, self.stats.tolist())),
+            "settings": {
+                name: value
+                for name, value in zip(SETTINGS, self.settings.tolist())
+                if not np.isnan(value)
+            },
+        }
+
+
+class ControlPlane:
+    """
+    Server side of the node control channel.
+
+    Commands are JSON datagrams with a sequence number, resent every
+    ack_timeout seconds until the node acknowledges them or retries run
+    out. Nodes send heartbeats with their stats to the same socket; a
+    node is alive while its last heartbeat is younger than
+    heartbeat_timeout.
+    """
+
+    def __init__(
+        self,
+        host,
+        port,
+        clients,
+        ack_timeout=0.2,
+        retries=10,
+        heartbeat_timeout=5.0,
+        logger=None,
+    ):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.settimeout(0.5)
+        # Camera name -> address of the node control socket
+        self.clients = {
+            name: (client["host"], client["port"]) for name, client in clients.items()
+        }
+        self.ack_timeout = ack_timeout
+        self.retries = retries
+        self.heartbeat_timeout = heartbeat_timeout
+        self.logger = logger
+        # Nodes dedupe on (session, seq), so a restarted server is not ignored
+        self.session = time.time_ns()
+        self.seq = 0
+        self.acked = set()
+        self.cond = threading.Condition()
+        self.nodes = {}
+        self.running = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.running = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        self.sock.close()
+
+    def run(self):
+        while self.running:
+            try:
+                data, addr = self.sock.recvfrom(65535)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            message = decode_message(data)
+            if message is None:
+                continue
+            if message.get("type") == "ack":
+                with self.cond:
+                    self.acked.add(message.get("seq"))
+                    self.cond.notify_all()
+            elif message.get("type") == "hb":
+                camera = message.get("camera")
+                self.nodes[camera] = {
+                    "address": addr,
+                    "received": time.monotonic(),
+                    "stats": message.get("stats", {}),
+                    "settings": message.get("settings", {}),
+                }
+
+    def send(self, cameras, command, **fields):
+        """
+        Send a command to the nodes of the given cameras and wait for their
+        acks, returns the cameras that acknowledged it
+        """
+        pending = {}
+        with self.cond:
+            for camera in cameras:
+                if camera not in self.clients:
+                    continue
+                self.seq += 1
+                pending[self.seq] = camera
+        messages = {
+            seq: encode_message(
+                {
+                    "type": "cmd",
+                    "session": self.session,
+                    "seq": seq,
+                    "cmd": command,
+                    **fields,
+                }
+            )
+            for seq in pending
+        }
+
+        for _ in range(self.retries):
+            for seq, camera in pending.items():
+                try:
+                    self.sock.sendto(messages[seq], self.clients[camera])
+                except OSError as e:
+                    if self.logger is not None:
+                        self.logger.error(f"Error sending '{command}' to {camera}: {e}")
+            with self.cond:
+                self.cond.wait_for(
+                    lambda: all(seq in self.acked for seq in pending),
+                    self.ack_timeout,
+                )
+                for seq in [seq for seq in pending if seq in self.acked]:
+                    self.acked.discard(seq)
+                    del pending[seq]
+            if not pending:
+                break
+        return [
+            camera
+            for camera in cameras
+            if camera in self.clients and camera not in pending.values()
+        ]
+
+    def broadcast(self, command, **fields):
+        return self.send(list(self.clients), command, **fields)
+
+    def get_status(self):
+        now = time.monotonic()
+        status = {}
+        for camera in self.clients:
+            node = self.nodes.get(camera)
+            if node is None:
+                status[camera] = {
+                    "alive": False,
+                    "age": None,
+                    "stats": {},
+                    "settings": {},
+                }
+                continue
+            age = now - node["received"]
+            status[camera] = {
+                "alive": age < self.heartbeat_timeout,
+                "age": age,
+                "stats": node["stats"],
+                "settings": node["settings"],
+            }
+        return status
+
+
+class BackpressureController:
+    """
+    Turns server backlog and drops into per-camera throttle levels.
+
+    Every step looks at the bounded stage queues, the assign backlog and
+    the crops dropped or lost since the previous step, on the server or
+    in the send queue of the nodes. When overloaded,
+    the cameras that were dropping, or else those sending at least their
+    fair share, go up one level; after cooldown calm steps every throttled
+    camera comes down one level. Level L multiplies frame_freq by 2**L,
+    lowers the JPEG quality by quality_step*L and raises the detection
+    confidence by conf_step*L.
+    """
+
+    def __init__(
+        self,
+        base,
+        high_watermark=0.7,
+        low_watermark=0.3,
+        drop_rate=0.01,
+        assign_backlog=256,
+        max_level=3,
+        cooldown=5,
+        quality_step=10,
+        min_quality=30,
+        conf_step=0.05,
+        max_conf=0.9,
+    ):
+        self.base = base
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.drop_rate = drop_rate
+        self.assign_backlog = assign_backlog
+        self.max_level = max_level
+        self.cooldown = cooldown
+        self.quality_step = quality_step
+        self.min_quality = min_quality
+        self.conf_step = conf_step
+        self.max_conf = max_conf
+        self.levels = {}
+        self.calm = 0
+        self.previous = None
+        self.changes = 0
+
+    def settings(self, level):
+        """Node settings of a throttle level, None clears the override"""
+        if level == 0:
+            return {name: None for name in SETTINGS}
+        return {
+            "frame_freq": int(self.base["frame_freq"] * 2**level),
+            "jpeg_quality": max(
+                self.min_quality, self.base["jpeg_quality"] - self.quality_step * level
+            ),
+            "conf": min(self.max_conf, self.base["conf"] + self.conf_step * level),
+        }
+
+    @staticmethod
+    def counters(stages, transport, nodes):
+        """Per-camera received and dropped totals, on the nodes or the server"""
+        received, dropped = {}, {}
+        for camera, stats in transport["cameras"].items():
+            received[camera] = stats["completed"]
+            dropped[camera] = stats["lost"] + stats["expired"]
+        for stage in stages.values():
+            for camera, count in stage["dropped_by_key"].items():
+                dropped[camera] = dropped.get(camera, 0) + count
+        for camera, node in nodes.items():
+            count = node["stats"].get("dropped", 0)
+            dropped[camera] = dropped.get(camera, 0) + count
+        return received, dropped
+
+    def step(self, stages, transport, nodes):
+        """Levels that changed as {camera: settings}"""
+        received, dropped = self.counters(stages, transport, nodes)
+        previous = self.previous or ({}, {})
+        self.previous = (received, dropped)
+        new_received = {c: n - previous[0].get(c, 0) for c, n in received.items()}
+        new_dropped = {c: n - previous[1].get(c, 0) for c, n in dropped.items()}
+
+        fill = max(
+            [s["depth"] / s["maxsize"] for s in stages.values() if s["maxsize"]] or [0]
+        )
+        backlog = stages.get("assign", {}).get("depth", 0)
+        dropping = [
+            camera
+            for camera, count in new_dropped.items()
+            if count > self.drop_rate * max(new_received.get(camera, 0) + count, 1)
+        ]
+
+        changed = {}
+        if fill >= self.high_watermark or backlog >= self.assign_backlog or dropping:
+            self.calm = 0
+            targets = dropping
+            if not targets and new_received:
+                share = sum(new_received.values()) / len(new_received)
+                targets = [c for c, n in new_received.items() if n >= share]
+            for camera in targets:
+                level = self.levels.get(camera, 0)
+                if level < self.max_level:
+                    self.levels[camera] = level + 1
+                    changed[camera] = self.settings(level + 1)
+        elif fill <= self.low_watermark and backlog < self.assign_backlog / 2:
+            self.calm += 1
+            if self.calm >= self.cooldown:
+                self.calm = 0
+                for camera, level in self.levels.items():
+                    if level > 0:
+                        self.levels[camera] = level - 1
+                        changed[camera] = self.settings(level - 1)
+        self.changes += len(changed)
+        return changed
+
+    def get_status(self):
+        return {"levels": dict(self.levels), "changes": self.changes}
@@ -0,0 +1,84 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+from protocol import DEFAULT_MAX_DATAGRAM, HEADER_SIZE
+
+
+class CropEncoder:
+    """
+    Resizes crops to the embedder geometry and encodes them as JPEG with
+    the highest quality that fits the byte budget.
+
+    The quality chosen for the previous crop is the starting point of the
+    next search, so a steady scene usually needs a single encode. Crops of
+    a frame are encoded concurrently, each search works on its own copy
+    and only the shared starting point is updated under the lock.
+    """
+
+    def __init__(
+        self,
+        size=(128, 256),
+        budget=DEFAULT_MAX_DATAGRAM - HEADER_SIZE,
+        quality=(40, 90),
+        workers=4,
+        max_attempts=4,
+    ):
+        self.size = tuple(size) if size else None
+        self.budget = budget
+        self.min_quality, self.max_quality = quality
+        self.quality = self.max_quality
+        self.max_attempts = max_attempts
+        self.pool = ThreadPoolExecutor(workers) if workers > 1 else None
+        self.over_budget = 0
+        self.lock = threading.Lock()
+
+    def normalize(self, crop):
+        """Resize the crop to the embedder input size"""
+        if self.size is None or crop.size == 0:
+            return crop
+        return cv2.resize(crop, self.size, interpolation=cv2.INTER_AREA)
+
+    def encode(self, crop):
+        """Normalize and encode one crop, returns the JPEG buffer"""
+        crop = self.normalize(crop)
+        low, high = self.min_quality, self.max_quality
+        with self.lock:
+            quality = min(max(self.quality, low), high)
+        best = None
+        for _ in range(self.max_attempts):
+            _, buffer = cv2.imencode(
+                ".jpg", crop, [int(cv2.IMWRITE_JPEG_QUALITY), quality]
+            )
+            if len(buffer) <= self.budget:
+                best = (buffer, quality)
+                if len(buffer) >= 0.75 * self.budget:
+                    break
+                low = quality + 1
+            else:
+                high = quality - 1
+            if low > high:
+                break
+            quality = (low + high) // 2
+
+        over_budget = False
+        if best is None:
+            _, buffer = cv2.imencode(
+                ".jpg", crop, [int(cv2.IMWRITE_JPEG_QUALITY), self.min_quality]
+            )
+            best = (buffer, self.min_quality)
+            over_budget = len(buffer) > self.budget
+
+        with self.lock:
+            self.quality = best[1]
+            self.over_budget += over_budget
+        return best[0]
+
+    def encode_all(self, crops):
+        """Encode every crop of a frame, in parallel when there is a pool"""
+        if self.pool is None or len(crops) < 2:
+            return [self.encode(crop) for crop in crops]
+        return list(self.pool.map(self.encode, crops))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
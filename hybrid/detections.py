@@ -0,0 +1,191 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import cv2
+import numpy as np
+import yaml
+from numpy.lib.format import open_memmap
+
+META_FILE = "meta.json"
+
+# Model settings that change the detections of a video
+DETECTOR_KEYS = (
+    "path",
+    "backend",
+    "precision",
+    "imgsz",
+    "conf",
+    "agnostic_nms",
+    "single_cls",
+    "classes",
+)
+
+
+def result_boxes(result):
+    """(boxes, confidences) of one YOLO result as float32 arrays"""
+    if not result.boxes:
+        return np.empty((0, 4), dtype=np.float32), np.empty(0, dtype=np.float32)
+    return (
+        result.boxes.xyxy.cpu().numpy().astype(np.float32),
+        result.boxes.conf.cpu().numpy().astype(np.float32),
+    )
+
+
+def cache_path(cache_dir, video, model_cfg):
+    """Cache directory of a (video, model, detector settings) key"""
+    model = model_cfg["path"]
+    key = hashlib.sha1(
+        json.dumps(
+            {
+                "video": os.path.abspath(video),
+                "video_size": os.path.getsize(video),
+                "video_mtime": os.path.getmtime(video),
+                "model": {k: model_cfg.get(k) for k in DETECTOR_KEYS},
+                "model_mtime": (
+                    os.path.getmtime(model) if os.path.exists(model) else None
+                ),
+            },
+            sort_keys=True,
+        ).encode()
+    ).hexdigest()[:16]
+    name = os.path.splitext(os.path.basename(video))[0]
+    return os.path.join(cache_dir, f"{name}_{key}")
+
+
+class DetectionCache:
+    """
+    Detections of every frame of a video as memory-mapped columns.
+
+    - offsets.npy: frame i owns rows offsets[i]:offsets[i + 1]
+    - boxes.npy: (x1, y1, x2, y2) of every detection
+    - confidences.npy: detector confidence of every detection
+    - meta.json: video, frame count and detector settings
+
+    Reading a frame is two slices of the page cache, so many cameras can
+    be replayed from one machine without running the detector.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META_FILE), "r") as f:
+            self.meta = json.load(f)
+        self.offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+        self.boxes = np.load(os.path.join(path, "boxes.npy"), mmap_mode="r")
+        self.confidences = np.load(os.path.join(path, "confidences.npy"), mmap_mode="r")
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def detections(self, frame_index):
+        """(boxes, confidences) of a frame, empty past the end of the video"""
+        if not 0 <= frame_index < len(self):
+            return self.boxes[:0], self.confidences[:0]
+        start, end = self.offsets[frame_index], self.offsets[frame_index + 1]
+        return self.boxes[start:end], self.confidences[start:end]
+
+    @classmethod
+    def build(cls, path, video, model, model_cfg, batch_size=16):
+        """Run the detector over every frame of the video and save the cache"""
+        cam = cv2.VideoCapture(video)
+        if not cam.isOpened():
+            raise RuntimeError(f"Could not open {video}")
+        counts, boxes, confidences = [], [], []
+        while True:
+            batch = []
+            while len(batch) < batch_size:
+                ret, img = cam.read()
+                if not ret:
+                    break
+                batch.append(img)
+            if not batch:
+                break
+            for result in model(batch):
+                frame_boxes, frame_confidences = result_boxes(result)
+                counts.append(len(frame_boxes))
+                boxes.append(frame_boxes)
+                confidences.append(frame_confidences)
+        cam.release()
+
+        # Written next to the final directory and renamed, so a crash never
+        # leaves a half written cache behind
+        tmp = path + ".tmp"
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        offsets = open_memmap(
+            os.path.join(tmp, "offsets.npy"), "w+", np.int64, (len(counts) + 1,)
+        )
+        offsets[0] = 0
+        np.cumsum(counts, out=offsets[1:])
+        total = int(offsets[-1])
+        for name, parts, shape in (
+            ("boxes", boxes, (total, 4)),
+            ("confidences", confidences, (total,)),
+        ):
+            array = open_memmap(
+                os.path.join(tmp, f"{name}.npy"), "w+", np.float32, shape
+            )
+            if total:
+                array[:] = np.concatenate(parts)
+            array.flush()
+        offsets.flush()
+        with open(os.path.join(tmp, META_FILE), "w") as f:
+            json.dump(
+                {
+                    "video": os.path.abspath(video),
+                    "frames": len(counts),
+                    "detections": total,
+                    "model": {k: model_cfg.get(k) for k in DETECTOR_KEYS},
+                },
+                f,
+                indent=2,
+            )
+        os.replace(tmp, path)
+        return cls(path)
+
+
+def open_caches(videos, model_cfg, cache_dir, batch_size=16):
+    """
+    {video: DetectionCache}, running the detector once over the videos
+    whose cache is missing
+    """
+    caches = {}
+    model = None
+    for video in videos:
+        path = cache_path(cache_dir, video, model_cfg)
+        if os.path.exists(os.path.join(path, META_FILE)):
+            caches[video] = DetectionCache(path)
+            continue
+        if model is None:
+            from inference import load_detector
+
+            model = load_detector(model_cfg, videos)
+        print(f"[INFO] Gerando cache de detecções de {video} em {path}")
+        os.makedirs(cache_dir, exist_ok=True)
+        caches[video] = DetectionCache.build(path, video, model, model_cfg, batch_size)
+    return caches
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--config", default="config.yaml", help="config do nó")
+    parser.add_argument(
+        "-b", "--batch-size", type=int, default=16, help="frames por lote do YOLO"
+    )
+    args = parser.parse_args()
+
+    with open(args.config, "r") as f:
+        cfg = yaml.safe_load(f)
+    cache_cfg = cfg.get("node", {}).get("detection_cache", {})
+    caches = open_caches(
+        [instance["video"] for instance in cfg["instances"]],
+        cfg["model"],
+        cache_cfg.get("path", "detection_cache"),
+        args.batch_size,
+    )
+    for video, cache in caches.items():
+        print(
+            f"[INFO] {video}: {cache.meta['frames']} frames, "
+            f"{cache.meta['detections']} detecções em {cache.path}"
+        )
@@ -0,0 +1,30 @@
+import numpy as np
+from deep_sort_realtime.deepsort_tracker import DeepSort
+
+
+def create_embedder(reid_cfg):
+    """Build the DeepSort appearance embedder described by the reid config"""
+    tracker = DeepSort(
+        max_age=reid_cfg.get("max_age", 10),
+        n_init=reid_cfg.get("n_init", 3),
+        nn_budget=reid_cfg.get("nn_budget", 100),
+        embedder=reid_cfg.get("embedder", "mobilenet"),
+        half=reid_cfg.get("half", True),
+        bgr=True,
+        embedder_gpu=reid_cfg.get("embedder_gpu", True),
+    )
+    return tracker.embedder
+
+
+def extract_embeddings(embedder, frames):
+    """Run one batched forward pass and return an (N, dim) float32 matrix"""
+    if not frames:
+        return np.empty((0, 0), dtype=np.float32)
+
+    if embedder is None:
+        return np.stack(
+            [np.mean(frame, axis=(0, 1)).astype(np.float32) for frame in frames]
+        )
+
+    embeds = embedder.predict(frames)
+    return np.asarray(embeds, dtype=np.float32).reshape(len(frames), -1)
@@ -0,0 +1,202 @@
+import hashlib
+import json
+import os
+import shutil
+import cv2
+import numpy as np
+
+BACKENDS = ("pytorch", "onnx", "openvino")
+PRECISIONS = ("fp32", "fp16", "int8")
+
+
+def artifact_path(model_cfg):
+    """Where the exported model of a (checkpoint, backend, precision) key lives"""
+    source = model_cfg["path"]
+    backend = model_cfg.get("backend", "pytorch")
+    precision = model_cfg.get("precision", "fp32")
+    key = hashlib.sha1(
+        json.dumps(
+            {
+                "source": os.path.abspath(source),
+                "size": os.path.getsize(source),
+                "mtime": os.path.getmtime(source),
+                "imgsz": model_cfg.get("imgsz", 640),
+                "calibration": model_cfg.get("calibration", {}),
+            },
+            sort_keys=True,
+        ).encode()
+    ).hexdigest()[:12]
+    stem = os.path.splitext(os.path.basename(source))[0]
+    name = f"{stem}_{precision}_{key}"
+    export_dir = model_cfg.get(
+        "export_dir", os.path.join(os.path.dirname(source), "exported")
+    )
+    if backend == "onnx":
+        return os.path.join(export_dir, f"{name}.onnx")
+    # OpenVINO models are a directory that ultralytics recognizes by its suffix
+    return os.path.join(export_dir, f"{name}_openvino_model")
+
+
+def letterbox(img, size):
+    """Resize keeping the aspect ratio and pad to size x size, as YOLO does"""
+    h, w = img.shape[:2]
+    scale = min(size / h, size / w)
+    resized = cv2.resize(
+        img, (round(w * scale), round(h * scale)), interpolation=cv2.INTER_LINEAR
+    )
+    out = np.full((size, size, 3), 114, dtype=np.uint8)
+    top = (size - resized.shape[0]) // 2
+    left = (size - resized.shape[1]) // 2
+    out[top : top + resized.shape[0], left : left + resized.shape[1]] = resized
+    return out
+
+
+def sample_frames(videos, count):
+    """About count frames spread evenly over the videos"""
+    frames = []
+    per_video = max(1, -(-count // max(len(videos), 1)))
+    for video in videos:
+        cam = cv2.VideoCapture(video)
+        total = int(cam.get(cv2.CAP_PROP_FRAME_COUNT)) or per_video
+        for position in np.linspace(0, total - 1, per_video).astype(int):
+            cam.set(cv2.CAP_PROP_POS_FRAMES, int(position))
+            ret, img = cam.read()
+            if ret:
+                frames.append(img)
+        cam.release()
+    if not frames:
+        raise RuntimeError(
+            "No calibration frames could be read, set model.calibration.videos"
+        )
+    return frames[:count]
+
+
+def quantize_onnx(source, target, frames, imgsz):
+    """Static INT8 quantization of an ONNX model calibrated on frames"""
+    import onnxruntime
+    from onnxruntime.quantization import (
+        CalibrationDataReader,
+        QuantFormat,
+        QuantType,
+        quantize_static,
+    )
+
+    input_name = (
+        onnxruntime.InferenceSession(source, providers=["CPUExecutionProvider"])
+        .get_inputs()[0]
+        .name
+    )
+
+    class FrameReader(CalibrationDataReader):
+        def __init__(self):
+            self.frames = iter(frames)
+
+        def get_next(self):
+            img = next(self.frames, None)
+            if img is None:
+                return None
+            rgb = letterbox(img, imgsz)[:, :, ::-1]
+            blob = np.ascontiguousarray(rgb.transpose(2, 0, 1), dtype=np.float32)
+            return {input_name: blob[None] / 255.0}
+
+    quantize_static(
+        source,
+        target,
+        FrameReader(),
+        quant_format=QuantFormat.QDQ,
+        activation_type=QuantType.QUInt8,
+        weight_type=QuantType.QInt8,
+        per_channel=True,
+    )
+
+
+def calibration_dataset(path, frames):
+    """Unlabeled YOLO dataset of the frames, for the OpenVINO INT8 export"""
+    images = os.path.join(path, "images")
+    os.makedirs(images, exist_ok=True)
+    for i, img in enumerate(frames):
+        cv2.imwrite(os.path.join(images, f"{i:05d}.jpg"), img)
+    data = os.path.join(path, "data.yaml")
+    with open(data, "w") as f:
+        json.dump(
+            {
+                "path": os.path.abspath(path),
+                "train": "images",
+                "val": "images",
+                "names": {0: "person"},
+            },
+            f,
+        )
+    return data
+
+
+def export_detector(model_cfg, videos=()):
+    """
+    Path of the model the node should load for model_cfg, exporting (and
+    quantizing) the checkpoint once when the backend is not pytorch
+    """
+    backend = model_cfg.get("backend", "pytorch")
+    precision = model_cfg.get("precision", "fp32")
+    if backend not in BACKENDS:
+        raise ValueError(f"Unsupported detector backend: {backend}")
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unsupported detector precision: {precision}")
+    if backend == "pytorch":
+        if precision != "fp32":
+            raise ValueError("The pytorch backend only runs fp32 on CPU")
+        return model_cfg["path"]
+    if backend == "onnx" and precision == "fp16":
+        raise ValueError("fp16 ONNX needs a GPU, use openvino for fp16 on CPU")
+
+    target = artifact_path(model_cfg)
+    if os.path.exists(target):
+        return target
+
+    from ultralytics import YOLO
+
+    imgsz = model_cfg.get("imgsz", 640)
+    calibration_cfg = model_cfg.get("calibration", {})
+    frames = None
+    if precision == "int8":
+        frames = sample_frames(
+            calibration_cfg.get("videos") or list(videos),
+            calibration_cfg.get("frames", 200),
+        )
+
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    tmp = target + ".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    # ultralytics writes next to the checkpoint, so export from a copy in a
+    # scratch directory instead of beside the user's files
+    work = target + ".work"
+    shutil.rmtree(work, ignore_errors=True)
+    os.makedirs(work)
+    checkpoint = os.path.join(work, os.path.basename(model_cfg["path"]))
+    shutil.copy2(model_cfg["path"], checkpoint)
+    model = YOLO(checkpoint, task="detect")
+    print(f"[INFO] Exportando {model_cfg['path']} para {backend} {precision}")
+    if backend == "onnx":
+        # Static shapes quantize and run best on CPU
+        exported = model.export(format="onnx", imgsz=imgsz, dynamic=False)
+        if precision == "int8":
+            quantize_onnx(exported, tmp, frames, imgsz)
+        else:
+            shutil.move(exported, tmp)
+    else:
+        data = None
+        if precision == "int8":
+            data = calibration_dataset(target + ".calibration", frames)
+        exported = model.export(
+            format="openvino",
+            imgsz=imgsz,
+            half=precision == "fp16",
+            int8=precision == "int8",
+            data=data,
+        )
+        shutil.move(exported, tmp)
+        if data is not None:
+            shutil.rmtree(os.path.dirname(data), ignore_errors=True)
+    shutil.rmtree(work, ignore_errors=True)
+    # Renamed only when complete, so an interrupted export is redone
+    os.replace(tmp, target)
+    return target
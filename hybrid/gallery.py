@@ -0,0 +1,306 @@
+import time
+from collections import OrderedDict
+import numpy as np
+
+
+class IdentityIndex:
+    """
+    Contiguous matrix of L2-normalized identity centroids.
+
+    Each identity owns one row, so a query is a single matrix-vector
+    product followed by an argmax over the cosine similarities.
+    """
+
+    def __init__(self, dim=None, capacity=1024, allocator=None):
+        self.dim = dim
+        self.capacity = capacity
+        self.size = 0
+        self.centroids = None
+        self.ids = None
+        self.rows = {}
+        self.allocator = allocator
+        if dim is not None:
+            self._allocate(dim)
+
+    @staticmethod
+    def allocate_in_memory(capacity, dim):
+        """Default allocator, (centroids, ids) arrays in RAM"""
+        centroids = np.zeros((capacity, dim), dtype=np.float32)
+        ids = np.full(capacity, -1, dtype=np.int64)
+        return centroids, ids
+
+    def _new_arrays(self, capacity, dim):
+        if self.allocator is None:
+            return self.allocate_in_memory(capacity, dim)
+        return self.allocator(capacity, dim)
+
+    def _allocate(self, dim):
+        """Allocate the centroid matrix once the embedding size is known"""
+        self.dim = dim
+        self.centroids, self.ids = self._new_arrays(self.capacity, dim)
+
+    def _grow(self):
+        """Double the capacity keeping the rows contiguous"""
+        self.capacity *= 2
+        centroids, ids = self._new_arrays(self.capacity, self.dim)
+        centroids[: self.size] = self.centroids[: self.size]
+        ids[: self.size] = self.ids[: self.size]
+        self.centroids = centroids
+        self.ids = ids
+
+    @classmethod
+    def attach(cls, centroids, ids, size, allocator=None):
+        """Wrap existing (e.g. memory-mapped) arrays without copying them"""
+        index = cls(capacity=centroids.shape[0], allocator=allocator)
+        index.dim = centroids.shape[1]
+        index.centroids = centroids
+        index.ids = ids
+        index.size = size
+        index.rows = {int(pid): row for row, pid in enumerate(ids[:size])}
+        return index
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector = vector / norm
+        return vector
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, pid):
+        return pid in self.rows
+
+    def add(self, pid, centroid):
+        """Register a new identity with its centroid"""
+        centroid = self._normalize(centroid)
+        if self.centroids is None:
+            self._allocate(centroid.shape[0])
+        if pid in self.rows:
+            self.update(pid, centroid)
+            return self.rows[pid]
+        if self.size == self.capacity:
+            self._grow()
+
+        row = self.size
+        self.centroids[row] = centroid
+        self.ids[row] = pid
+        self.rows[pid] = row
+        self.size += 1
+        return row
+
+    def update(self, pid, centroid):
+        """Overwrite the centroid of an existing identity in place"""
+        self.centroids[self.rows[pid]] = self._normalize(centroid)
+
+    def centroid(self, pid):
+        """Copy of the normalized centroid of an identity"""
+        return self.centroids[self.rows[pid]].copy()
+
+    def remove(self, pid):
+        """Drop an identity, the last row is moved into its place"""
+        row = self.rows.pop(pid)
+        last = self.size - 1
+        if row != last:
+            moved = int(self.ids[last])
+            self.centroids[row] = self.centroids[last]
+            self.ids[row] = moved
+            self.rows[moved] = row
+        self.ids[last] = -1
+        self.size = last
+
+    def search(self, embedding, pids=None):
+        """
+        Return (pid, cosine distance) of the closest centroid or None
+        when the index is empty. If pids is given only those identities
+        are considered.
+        """
+        if self.size == 0:
+            return None
+
+        query = self._normalize(embedding)
+        if pids is None:
+            similarities = self.centroids[: self.size] @ query
+            row = int(np.argmax(similarities))
+            return int(self.ids[row]), float(1.0 - similarities[row])
+
+        rows = np.fromiter(
+            (self.rows[pid] for pid in pids if pid in self.rows), dtype=np.int64
+        )
+        if rows.size == 0:
+            return None
+        similarities = self.centroids[rows] @ query
+        best = int(np.argmax(similarities))
+        return int(self.ids[rows[best]]), float(1.0 - similarities[best])
+
+
+class TieredIndex:
+    """
+    Identity index split in a hot and a cold tier by last_seen.
+
+    Identities not seen for hot_ttl seconds, or past hot_capacity in LRU
+    order, move to the cold tier, which is only searched when no hot
+    identity passes the threshold. Cold identities are evicted after
+    cold_ttl seconds or past cold_capacity. A capacity or ttl of 0
+    disables that limit.
+    """
+
+    def __init__(
+        self,
+        hot=None,
+        hot_ttl=300.0,
+        hot_capacity=0,
+        cold_ttl=3600.0,
+        cold_capacity=0,
+        clock=time.time,
+    ):
+        self.hot = hot if hot is not None else IdentityIndex()
+        self.cold = IdentityIndex()
+        self.hot_ttl = hot_ttl
+        self.hot_capacity = hot_capacity
+        self.cold_ttl = cold_ttl
+        self.cold_capacity = cold_capacity
+        self.clock = clock
+        self.hot_seen = OrderedDict()
+        self.cold_seen = OrderedDict()
+        self.promoted = 0
+        self.demoted = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self.hot) + len(self.cold)
+
+    def __contains__(self, pid):
+        return pid in self.hot or pid in self.cold
+
+    def _touch(self, pid, now):
+        self.hot_seen[pid] = self.clock() if now is None else now
+        self.hot_seen.move_to_end(pid)
+
+    def restore(self, pid, centroid, last_seen):
+        """
+        Register a stored identity, in the tier it was saved in. Calls must
+        come in last_seen order to rebuild the LRU.
+        """
+        if pid in self.hot:
+            self.hot_seen[pid] = last_seen
+        else:
+            self.cold.add(pid, centroid)
+            self.cold_seen[pid] = last_seen
+
+    def add(self, pid, centroid, now=None):
+        if pid in self.cold:
+            self.cold.remove(pid)
+            del self.cold_seen[pid]
+        self.hot.add(pid, centroid)
+        self._touch(pid, now)
+
+    def update(self, pid, centroid, now=None):
+        """Update an identity, promoting it back to hot if it was cold"""
+        if pid in self.cold:
+            self.promoted += 1
+        self.add(pid, centroid, now)
+
+    def search(self, embedding, pids=None, threshold=None):
+        """Hot search first, cold only when the hot match is not close enough"""
+        match = self.hot.search(embedding, pids)
+        if match is not None and threshold is not None and match[1] < threshold:
+            return match
+        cold = self.cold.search(embedding, pids)
+        if cold is not None and (match is None or cold[1] < match[1]):
+            return cold
+        return match
+
+    @staticmethod
+    def _expired(seen, ttl, capacity, now):
+        pid, last_seen = next(iter(seen.items()))
+        if ttl and now - last_seen > ttl:
+            return pid
+        if capacity and len(seen) > capacity:
+            return pid
+        return None
+
+    def age(self, now=None):
+        """Demote and evict by age and count, returns the evicted pids"""
+        if now is None:
+            now = self.clock()
+
+        while self.hot_seen:
+            pid = self._expired(self.hot_seen, self.hot_ttl, self.hot_capacity, now)
+            if pid is None:
+                break
+            _, last_seen = self.hot_seen.popitem(last=False)
+            self.cold.add(pid, self.hot.centroid(pid))
+            self.hot.remove(pid)
+            self.cold_seen[pid] = last_seen
+            self.demoted += 1
+
+        evicted = []
+        while self.cold_seen:
+            pid = self._expired(self.cold_seen, self.cold_ttl, self.cold_capacity, now)
+            if pid is None:
+                break
+            self.cold_seen.popitem(last=False)
+            self.cold.remove(pid)
+            evicted.append(pid)
+        self.evicted += len(evicted)
+        return evicted
+
+    def get_status(self):
+        return {
+            "hot": len(self.hot),
+            "cold": len(self.cold),
+            "promoted": self.promoted,
+            "demoted": self.demoted,
+            "evicted": self.evicted,
+        }
+
+
+class EmbeddingGallery:
+    """
+    Fixed-capacity ring buffer of embeddings for a single identity.
+
+    The buffer is allocated once and the sum of the stored samples is kept
+    up to date, so appending and reading the mean are O(dim).
+    """
+
+    def __init__(self, dim, capacity=512, samples=None, total=None, count=0, head=0):
+        self.capacity = capacity
+        # samples/total may be views into a memory-mapped store
+        if samples is None:
+            samples = np.zeros((capacity, dim), dtype=np.float32)
+        if total is None:
+            total = np.zeros(dim, dtype=np.float64)
+        self.samples = samples
+        self.total = total
+        self.centroid = np.zeros(dim, dtype=np.float32)
+        self.count = count
+        self.head = head
+
+    def __len__(self):
+        return self.count
+
+    def append(self, embedding):
+        """Store an embedding, overwriting the oldest one when full, returns its slot"""
+        written = self.head
+        slot = self.samples[written]
+        if self.count == self.capacity:
+            np.subtract(self.total, slot, out=self.total)
+        else:
+            self.count += 1
+        slot[:] = embedding
+        np.add(self.total, slot, out=self.total)
+
+        self.head += 1
+        if self.head == self.capacity:
+            self.head = 0
+            # Resync once per lap so the running sum does not drift
+            np.sum(self.samples, axis=0, dtype=np.float64, out=self.total)
+        return written
+
+    def mean(self):
+        """Running mean of the stored embeddings"""
+        np.divide(self.total, max(self.count, 1), out=self.centroid, casting="unsafe")
+        return self.centroid
@@ -0,0 +1,129 @@
+import queue
+import threading
+import time
+from ultralytics import YOLO
+from export import export_detector
+
+
+class FrameByFrame:
+    """
+    Detector exported with a static batch of one. Lists of frames, as the
+    DetectionService and the detection cache send them, are run one frame
+    at a time and the results concatenated.
+    """
+
+    def __init__(self, model):
+        self.model = model
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+    def __call__(self, source, **kwargs):
+        if not isinstance(source, list):
+            return self.model(source, **kwargs)
+        return [result for img in source for result in self.model(img, **kwargs)]
+
+
+def load_detector(model_cfg, videos=()):
+    """
+    Load the YOLO detector with the overrides from the model config, from
+    the exported artifact of its backend and precision
+    """
+    model = YOLO(export_detector(model_cfg, videos), task="detect")
+    model.overrides.update(
+        {
+            "imgsz": model_cfg.get("imgsz", 640),
+            "conf": model_cfg.get("conf", 0.7),
+            "agnostic_nms": model_cfg.get("agnostic_nms", True),
+            "single_cls": model_cfg.get("single_cls", True),
+            "classes": model_cfg.get("classes", [0]),
+        }
+    )
+    if model_cfg.get("backend", "pytorch") != "pytorch":
+        return FrameByFrame(model)
+    return model
+
+
+class DetectionService:
+    """
+    Single detector shared by every camera of the node process.
+
+    Each round takes the newest frame of every registered camera, runs
+    them through the model as one batch and hands each result back to the
+    camera's outbox, which only ever holds the latest detection. A round
+    the model fails on is logged and skipped, the thread keeps serving.
+    """
+
+    def __init__(self, model_cfg, batch_window=0.005):
+        self.model = load_detector(model_cfg)
+        self.batch_window = batch_window
+        self.sources = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.batches = 0
+        self.frames = 0
+        self.errors = 0
+
+    def register(self, name, grabber):
+        """Add a camera and return the queue where its detections arrive"""
+        outbox = queue.Queue(maxsize=1)
+        grabber.listeners.append(self.wakeup)
+        with self.lock:
+            self.sources[name] = (grabber, outbox)
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        return outbox
+
+    def unregister(self, name):
+        with self.lock:
+            self.sources.pop(name, None)
+        self.wakeup.set()
+
+    @staticmethod
+    def deliver(outbox, item):
+        """Replace whatever detection the camera has not consumed yet"""
+        try:
+            outbox.get_nowait()
+        except queue.Empty:
+            pass
+        outbox.put_nowait(item)
+
+    def run(self):
+        while True:
+            self.wakeup.wait(timeout=0.5)
+            self.wakeup.clear()
+            with self.lock:
+                if not self.sources:
+                    break
+                sources = list(self.sources.items())
+
+            if len(sources) > 1 and self.batch_window > 0:
+                # Give the other cameras a moment to join the batch
+                time.sleep(self.batch_window)
+
+            batch = []
+            for name, (grabber, outbox) in sources:
+                frame = grabber.latest(timeout=0)
+                if frame is not None:
+                    batch.append((name, grabber, outbox, frame))
+            if not batch:
+                continue
+
+            started = time.perf_counter()
+            try:
+                results = self.model([frame[2] for _, _, _, frame in batch])
+            except Exception as e:
+                # Only these frames are lost, the cameras go on with the next ones
+                self.errors += 1
+                cameras = ", ".join(name for name, _, _, _ in batch)
+                print(f"[ERRO] Detecção falhou para {cameras}: {e}")
+                continue
+            elapsed = time.perf_counter() - started
+            self.batches += 1
+            self.frames += len(batch)
+
+            for (_, grabber, outbox, frame), result in zip(batch, results):
+                grabber.report_latency(elapsed)
+                self.deliver(outbox, (frame, result))
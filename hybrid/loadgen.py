@@ -0,0 +1,409 @@
+import argparse
+import json
+import multiprocessing
+import socket
+import time
+import cv2
+import numpy as np
+import yaml
+from protocol import (
+    build_packets,
+    elapsed_us,
+    stamp_send,
+    encode_embedding,
+    DEFAULT_MAX_DATAGRAM,
+    MSG_CROP,
+    MSG_EMBEDDING,
+)
+
+
+def parse_range(value):
+    """'a:b' or 'a' as an inclusive (low, high) pair of ints"""
+    low, _, high = value.partition(":")
+    return int(low), int(high or low)
+
+
+def synthetic_crops(rng, count, width, height, quality):
+    """Noisy solid-color JPEG crops with random sizes"""
+    crops = []
+    for _ in range(count):
+        w = int(rng.integers(width[0], width[1] + 1))
+        h = int(rng.integers(height[0], height[1] + 1))
+        img = np.empty((h, w, 3), dtype=np.uint8)
+        img[:] = rng.integers(0, 200, 3, dtype=np.uint8)
+        img += rng.integers(0, 56, img.shape, dtype=np.uint8)
+        _, buffer = cv2.imencode(".jpg", img, [int(cv2.IMWRITE_JPEG_QUALITY), quality])
+        crops.append((buffer.tobytes(), (0, 0, w, h)))
+    return crops
+
+
+def video_crops(path, rng, count, width, height, quality):
+    """Random crops taken from the frames of a prerecorded video"""
+    cam = cv2.VideoCapture(path)
+    frames = []
+    while len(frames) < count:
+        ret, img = cam.read()
+        if not ret:
+            break
+        frames.append(img)
+    cam.release()
+    if not frames:
+        raise RuntimeError(f"Could not read frames from {path}")
+
+    crops = []
+    for i in range(count):
+        img = frames[i % len(frames)]
+        h = min(int(rng.integers(height[0], height[1] + 1)), img.shape[0])
+        w = min(int(rng.integers(width[0], width[1] + 1)), img.shape[1])
+        y = int(rng.integers(0, img.shape[0] - h + 1))
+        x = int(rng.integers(0, img.shape[1] - w + 1))
+        _, buffer = cv2.imencode(
+            ".jpg", img[y : y + h, x : x + w], [int(cv2.IMWRITE_JPEG_QUALITY), quality]
+        )
+        crops.append((buffer.tobytes(), (x, y, x + w, y + h)))
+    return crops
+
+
+def detected_crops(path, cache, count, quality):
+    """The first count detections of a video, cropped with the cached boxes"""
+    cam = cv2.VideoCapture(path)
+    crops = []
+    frame = 0
+    while len(crops) < count:
+        ret, img = cam.read()
+        if not ret:
+            break
+        boxes, _ = cache.detections(frame)
+        for box in np.intp(boxes)[: count - len(crops)]:
+            x1, y1, x2, y2 = box
+            _, buffer = cv2.imencode(
+                ".jpg", img[y1:y2, x1:x2], [int(cv2.IMWRITE_JPEG_QUALITY), quality]
+            )
+            crops.append((buffer.tobytes(), (x1, y1, x2, y2)))
+        frame += 1
+    cam.release()
+    if not crops:
+        raise RuntimeError(f"No cached detections in {path}")
+    return crops
+
+
+def synthetic_embeddings(rng, count, dim, identities):
+    """Edge-First payloads around a few identity centers"""
+    centers = rng.standard_normal((identities, dim))
+    payloads = []
+    for i in range(count):
+        embedding = centers[i % identities] + 0.05 * rng.standard_normal(dim)
+        payloads.append((encode_embedding(embedding), (0, 0, 64, 128)))
+    return payloads
+
+
+def run_cameras(job):
+    """
+    Sender process: replays its cameras at fps frames per second with a
+    random number of persons per frame, all starting at start_at.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4 * 1024 * 1024)
+    rng = np.random.default_rng(job["seed"])
+    payloads = job["payloads"]
+    interval = 1.0 / job["fps"]
+    cameras = job["cameras"]
+    frame = {name: 0 for name in cameras}
+    seq = {name: 0 for name in cameras}
+    sent = packets = errors = 0
+
+    # Cameras of the same process are spread over one frame interval
+    offsets = {name: i * interval / len(cameras) for i, name in enumerate(cameras)}
+    next_time = {name: job["start_at"] + offsets[name] for name in cameras}
+    end = job["start_at"] + job["duration"]
+
+    while True:
+        name = min(next_time, key=next_time.get)
+        due = next_time[name]
+        if due >= end:
+            break
+        delay = due - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+        persons = int(rng.integers(job["persons"][0], job["persons"][1] + 1))
+        for _ in range(persons):
+            payload, bbox = payloads[int(rng.integers(len(payloads)))]
+            captured = time.time()
+            for packet in build_packets(
+                name,
+                frame[name],
+                captured,
+                bbox,
+                seq[name],
+                payload,
+                job["msg_type"],
+                job["max_datagram"],
+            ):
+                stamp_send(packet, elapsed_us(captured))
+                try:
+                    sock.sendto(packet, job["address"])
+                    packets += 1
+                except OSError:
+                    errors += 1
+            seq[name] += 1
+            sent += 1
+        frame[name] += 1
+        next_time[name] += interval
+
+    sock.close()
+    return {"crops": sent, "packets": packets, "errors": errors}
+
+
+def read_snmp():
+    """UDP counters of the kernel, empty outside Linux"""
+    try:
+        with open("/proc/net/snmp", "r") as f:
+            rows = [line.split() for line in f if line.startswith("Udp:")]
+    except OSError:
+        return {}
+    names, values = rows[0][1:], rows[1][1:]
+    return dict(zip(names, map(int, values)))
+
+
+def socket_drops(port):
+    """Kernel drops of the UDP sockets bound to port"""
+    drops = 0
+    for table in ("/proc/net/udp", "/proc/net/udp6"):
+        try:
+            with open(table, "r") as f:
+                next(f)
+                for line in f:
+                    fields = line.split()
+                    if int(fields[1].rsplit(":", 1)[1], 16) == port:
+                        drops += int(fields[-1])
+        except (OSError, StopIteration):
+            continue
+    return drops
+
+
+def start_server(config_path):
+    """In-process threads runtime, started as if a node answered the warmup"""
+    from server import PersonReidentificationServer
+
+    server = PersonReidentificationServer(config_path)
+    if not server.initialize():
+        raise RuntimeError("Server failed to initialize")
+    server.running = True
+
+    netcfg = server.cfg["server"]
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    probe.sendto(b"warm", (netcfg.get("host", "localhost"), netcfg.get("port", 5000)))
+    probe.close()
+    server.start_processing()
+    return server
+
+
+def wait_drained(server, expected, timeout):
+    """Wait until every stage is empty and nothing was assigned for a while"""
+    assign = server.stages["assign"]
+    deadline = time.time() + timeout
+    last = -1
+    while time.time() < deadline:
+        busy = any(stage.depth() for stage in server.stages.values())
+        if not busy and (assign.processed == last or assign.processed >= expected):
+            break
+        last = assign.processed
+        time.sleep(0.5)
+    return time.time()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-c", "--config", default="config.yaml", help="config do servidor"
+    )
+    parser.add_argument(
+        "-n", "--cameras", type=int, default=4, help="câmeras simuladas"
+    )
+    parser.add_argument(
+        "--fps", type=float, default=10, help="frames por segundo de cada câmera"
+    )
+    parser.add_argument(
+        "--persons", default="1:3", help="pessoas (crops) por frame, ex: 1:3"
+    )
+    parser.add_argument(
+        "-d", "--duration", type=float, default=20, help="duração do envio em segundos"
+    )
+    parser.add_argument(
+        "--width", default="48:160", help="largura dos crops, ex: 48:160"
+    )
+    parser.add_argument(
+        "--height", default="96:400", help="altura dos crops, ex: 96:400"
+    )
+    parser.add_argument("--quality", type=int, default=80, help="qualidade JPEG")
+    parser.add_argument(
+        "--video", default=None, help="vídeo gravado de onde os crops são tirados"
+    )
+    parser.add_argument(
+        "--detections",
+        action="store_true",
+        help="usa as caixas do cache de detecções do vídeo em vez de recortes aleatórios",
+    )
+    parser.add_argument(
+        "--embeddings",
+        type=int,
+        default=0,
+        help="envia embeddings Edge-First desta dimensão em vez de crops",
+    )
+    parser.add_argument(
+        "--pool", type=int, default=64, help="payloads pré-gerados por processo"
+    )
+    parser.add_argument(
+        "-p", "--processes", type=int, default=None, help="processos de envio"
+    )
+    parser.add_argument(
+        "--external",
+        action="store_true",
+        help="envia para um servidor já rodando em vez de iniciar um no processo",
+    )
+    parser.add_argument(
+        "--drain-timeout", type=float, default=30, help="espera máxima pela fila"
+    )
+    parser.add_argument("--json", default=None, help="salva o relatório em JSON")
+    args = parser.parse_args()
+
+    with open(args.config, "r") as f:
+        cfg = yaml.safe_load(f)
+    netcfg = cfg["server"]
+    address = (netcfg.get("host", "localhost"), netcfg.get("port", 5000))
+    max_datagram = netcfg.get("max_datagram", DEFAULT_MAX_DATAGRAM)
+    width, height = parse_range(args.width), parse_range(args.height)
+
+    cache = None
+    if args.video and args.detections:
+        from detections import open_caches
+
+        cache_cfg = cfg.get("node", {}).get("detection_cache", {})
+        cache = open_caches(
+            [args.video], cfg["model"], cache_cfg.get("path", "detection_cache")
+        )[args.video]
+
+    processes = args.processes or min(args.cameras, multiprocessing.cpu_count())
+    names = [f"camera_{i + 1}" for i in range(args.cameras)]
+    jobs = []
+    for i in range(processes):
+        rng = np.random.default_rng(i)
+        if args.embeddings:
+            payloads = synthetic_embeddings(rng, args.pool, args.embeddings, 8)
+        elif cache is not None:
+            payloads = detected_crops(args.video, cache, args.pool, args.quality)
+        elif args.video:
+            payloads = video_crops(
+                args.video, rng, args.pool, width, height, args.quality
+            )
+        else:
+            payloads = synthetic_crops(rng, args.pool, width, height, args.quality)
+        jobs.append(
+            {
+                "cameras": names[i::processes],
+                "payloads": payloads,
+                "fps": args.fps,
+                "persons": parse_range(args.persons),
+                "duration": args.duration,
+                "address": address,
+                "max_datagram": max_datagram,
+                "msg_type": MSG_EMBEDDING if args.embeddings else MSG_CROP,
+                "seed": 1000 + i,
+            }
+        )
+    jobs = [job for job in jobs if job["cameras"]]
+    sizes = np.array([len(p) for job in jobs for p, _ in job["payloads"]])
+
+    server = None if args.external else start_server(args.config)
+    snmp_before = read_snmp()
+    drops_before = socket_drops(address[1])
+
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(len(jobs)) as pool:
+        start = time.time() + 1.0
+        for job in jobs:
+            job["start_at"] = start
+        sent = pool.map(run_cameras, jobs)
+    sent_crops = sum(s["crops"] for s in sent)
+
+    end = time.time()
+    if server is not None:
+        end = wait_drained(server, sent_crops, args.drain_timeout)
+    snmp_after = read_snmp()
+
+    report = {
+        "cameras": args.cameras,
+        "duration": args.duration,
+        "sent": {
+            "crops": sent_crops,
+            "packets": sum(s["packets"] for s in sent),
+            "send_errors": sum(s["errors"] for s in sent),
+            "offered_rate": sent_crops / args.duration,
+            "payload_mean": float(sizes.mean()),
+            "payload_p95": float(np.percentile(sizes, 95)),
+        },
+        "kernel": {
+            "socket_drops": socket_drops(address[1]) - drops_before,
+            **{
+                key: snmp_after[key] - snmp_before.get(key, 0)
+                for key in ("InDatagrams", "InErrors", "RcvbufErrors")
+                if key in snmp_after
+            },
+        },
+    }
+
+    if server is not None:
+        status = server.get_status()
+        assigned = status["stages"]["assign"]["processed"]
+        report["server"] = {
+            "assigned": assigned,
+            "throughput": assigned / max(end - start, 1e-9),
+            "delivery": assigned / sent_crops if sent_crops else 0.0,
+            "queue_drops": {
+                name: stage["dropped"] for name, stage in status["stages"].items()
+            },
+            "lost": sum(c["lost"] for c in status["transport"]["cameras"].values()),
+            "expired": sum(
+                c["expired"] for c in status["transport"]["cameras"].values()
+            ),
+            "buffer_misses": status["buffer_pool"].get("misses", 0),
+            "latency": status["latency"],
+        }
+        server.stop_processing()
+        if server.results is not None:
+            server.results.close()
+
+    sent_report = report["sent"]
+    print(
+        f"sent      {sent_report['crops']} crops / {sent_report['packets']} packets "
+        f"({sent_report['offered_rate']:.1f} crops/s, "
+        f"payload mean {sent_report['payload_mean']:.0f}B "
+        f"p95 {sent_report['payload_p95']:.0f}B, "
+        f"{sent_report['send_errors']} send errors)"
+    )
+    print(
+        "kernel    "
+        + ", ".join(f"{key}={value}" for key, value in report["kernel"].items())
+    )
+    if "server" in report:
+        srv = report["server"]
+        latency = srv["latency"]
+        print(
+            f"server    {srv['assigned']} assigned, {srv['throughput']:.1f} crops/s, "
+            f"delivery {srv['delivery'] * 100:.1f}%"
+        )
+        print(
+            "drops     "
+            + ", ".join(f"{n}={d}" for n, d in srv["queue_drops"].items())
+            + f", lost={srv['lost']}, expired={srv['expired']}, "
+            f"buffer misses={srv['buffer_misses']}"
+        )
+        print(
+            f"latency   p50={latency['p50_ms']:.1f}ms p95={latency['p95_ms']:.1f}ms "
+            f"p99={latency['p99_ms']:.1f}ms"
+        )
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
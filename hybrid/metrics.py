@@ -0,0 +1,154 @@
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds in seconds, one more bucket catches everything above
+BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+# Order in which the stages of an item happen, from capture to match
+STAGES = ("detect", "encode", "send", "network", "decode", "embed", "match", "total")
+
+
+def label_value(value):
+    """Escape a label value as the Prometheus text format requires"""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Histogram:
+    """Fixed-bucket latency histogram, cheap enough for the hot path"""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def quantile(self, q):
+        """Estimate of the q quantile, interpolated inside its bucket"""
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count > 0:
+                low = self.buckets[i - 1] if i > 0 else 0.0
+                high = self.buckets[i] if i < len(self.buckets) else low
+                return low + (high - low) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+
+class Metrics:
+    """
+    Per-camera, per-stage latency histograms. Throughput comes from the
+    histogram counts, so it is not tracked separately.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+
+    def observe(self, stage, camera, seconds):
+        with self.lock:
+            histogram = self.histograms.get((stage, camera))
+            if histogram is None:
+                histogram = self.histograms[(stage, camera)] = Histogram(self.buckets)
+            histogram.observe(max(0.0, seconds))
+
+    def get_status(self):
+        """{camera: {stage: {count, rate, avg_ms, p50_ms, p95_ms, p99_ms}}}"""
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        status = {}
+        with self.lock:
+            for (stage, camera), h in self.histograms.items():
+                status.setdefault(camera, {})[stage] = {
+                    "count": h.count,
+                    "rate": h.count / elapsed,
+                    "avg_ms": h.sum / h.count * 1000 if h.count else 0.0,
+                    "p50_ms": h.quantile(0.50) * 1000,
+                    "p95_ms": h.quantile(0.95) * 1000,
+                    "p99_ms": h.quantile(0.99) * 1000,
+                }
+        for camera, stages in status.items():
+            status[camera] = {
+                stage: stages[stage] for stage in STAGES if stage in stages
+            }
+        return status
+
+    def render(self):
+        """Prometheus text exposition of the histograms"""
+        lines = [
+            "# HELP reid_stage_latency_seconds Time spent by an item in each stage",
+            "# TYPE reid_stage_latency_seconds histogram",
+        ]
+        with self.lock:
+            for (stage, camera), h in sorted(self.histograms.items()):
+                labels = f'stage="{stage}",camera="{label_value(camera)}"'
+                cumulative = 0
+                for bound, count in zip(self.buckets, h.counts):
+                    cumulative += count
+                    lines.append(
+                        f'reid_stage_latency_seconds_bucket{{{labels},le="{bound}"}} '
+                        f"{cumulative}"
+                    )
+                lines.append(
+                    f'reid_stage_latency_seconds_bucket{{{labels},le="+Inf"}} {h.count}'
+                )
+                lines.append(f"reid_stage_latency_seconds_sum{{{labels}}} {h.sum}")
+                lines.append(f"reid_stage_latency_seconds_count{{{labels}}} {h.count}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """Serves render() as Prometheus text on GET /metrics"""
+
+    def __init__(self, render, host="127.0.0.1", port=9100):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -1,12 +1,36 @@
 import socket
+import struct
 import threading
 import queue
 import argparse
+import multiprocessing
 import yaml
 import cv2
 import numpy as np
-from ultralytics import YOLO
 import time
+import os
+from collections import deque
+from queues import BoundedQueue
+from capture import FrameGrabber
+from inference import load_detector, DetectionService
+from export import export_detector
+from crops import CropEncoder
+from tracker import CropSelector, crop_quality
+from detections import result_boxes, open_caches
+from shmring import ShmRing
+from control import NodeTuning, decode_message, encode_message
+from protocol import (
+    build_packets,
+    elapsed_us,
+    stamp_send,
+    parse_header,
+    encode_camera,
+    encode_embedding,
+    DEFAULT_MAX_DATAGRAM,
+    HEADER_SIZE,
+    MSG_CROP,
+    MSG_EMBEDDING,
+)
 
 
 def create_client_socket(transmission_cfg, server_cfg):
@@ -28,7 +52,7 @@ def create_client_socket(transmission_cfg, server_cfg):
         raise ValueError(f"Unsupported protocol: {protocol}")
 
 
-def enviar_mensagens(fila, cfg, server_cfg):
+def enviar_mensagens(fila, cfg, server_cfg, tuning=None):
     """Thread responsável por enviar as mensagens (imagens ou dados)."""
     protocol = cfg.get("protocol", "udp").lower()
     server_addr = (server_cfg["host"], server_cfg["port"])
@@ -40,7 +64,12 @@ def enviar_mensagens(fila, cfg, server_cfg):
             if item is None:
                 break
             try:
-                sock.sendto(item["packet"], server_addr)
+                send_us = elapsed_us(item["timestamp"])
+                for packet in item["packets"]:
+                    stamp_send(packet, send_us)
+                    sock.sendto(packet, server_addr)
+                if tuning is not None:
+                    tuning.count("sent")
             except Exception as e:
                 print(f"[ERRO][UDP]: {e}")
     elif protocol == "tcp":
@@ -51,7 +80,12 @@ def enviar_mensagens(fila, cfg, server_cfg):
                 if item is None:
                     break
                 try:
-                    sock.sendall(item["header"] + item["buff"])
+                    send_us = elapsed_us(item["timestamp"])
+                    for packet in item["packets"]:
+                        stamp_send(packet, send_us)
+                    sock.sendall(b"".join(item["packets"]))
+                    if tuning is not None:
+                        tuning.count("sent")
                 except Exception as e:
                     print(f"[ERRO][TCP]: {e}")
     else:
@@ -60,89 +94,491 @@ def enviar_mensagens(fila, cfg, server_cfg):
         )
 
 
-def obj_detect(command_ref, fila, video_path, model_cfg, name):
+def obj_detect(
+    command_ref,
+    fila,
+    video_path,
+    cfg,
+    name,
+    service=None,
+    cache=None,
+    start_frame=0,
+    tuning=None,
+    start_seq=0,
+):
     """Thread de detecção de objetos."""
-    cam = cv2.VideoCapture(video_path)
-    model = YOLO(model_cfg["path"], task="detect")
-
-    model.overrides.update(
-        {
-            "conf": model_cfg.get("conf", 0.7),
-            "agnostic_nms": model_cfg.get("agnostic_nms", True),
-            "single_cls": model_cfg.get("single_cls", True),
-            "classes": model_cfg.get("classes", [0]),
-        }
+    model_cfg = cfg["model"]
+    node_cfg = cfg.get("node", {})
+    max_datagram = cfg["server"].get("max_datagram", DEFAULT_MAX_DATAGRAM)
+
+    embedder = None
+    if node_cfg.get("mode", "hybrid") == "edge_first":
+        # Só o modo Edge-First precisa do extrator de características no nó
+        from embedding import create_embedder, extract_embeddings
+
+        embedder = create_embedder(cfg.get("reid", {}))
+
+    grabber = FrameGrabber(
+        video_path,
+        frame_freq=model_cfg.get("frame_freq", 15),
+        adaptive=model_cfg.get("adaptive_sampling", True),
+        pace=node_cfg.get("pace_capture", True),
+        start=start_frame,
     )
+    if cache is not None:
+        # As detecções vêm do cache, o YOLO não roda neste nó
+        service = None
+    elif service is None:
+        model = load_detector(model_cfg)
+    else:
+        outbox = service.register(name, grabber)
 
-    bytes_name = name.encode("utf-8").ljust(32, b"\0")
+    encoder = None
+    if node_cfg.get("crop_normalize", False):
+        encoder = CropEncoder(
+            size=node_cfg.get("crop_size", [128, 256]),
+            budget=node_cfg.get("jpeg_budget", max_datagram - HEADER_SIZE),
+            quality=node_cfg.get("jpeg_quality", [40, 90]),
+            workers=node_cfg.get("encode_workers", 4),
+        )
+        max_quality = encoder.max_quality
+
+    selector = None
+    tracking_cfg = node_cfg.get("tracking", {})
+    if tracking_cfg.get("enabled", False):
+        # Agrupa as detecções em tracklets e envia só os melhores crops
+        selector = CropSelector(
+            iou=tracking_cfg.get("iou", 0.3),
+            max_age=tracking_cfg.get("max_age", 1.0),
+            min_hits=tracking_cfg.get("min_hits", 2),
+            refresh_interval=tracking_cfg.get("refresh_interval", 5.0),
+            improve=tracking_cfg.get("improve", 0.25),
+            max_sends=tracking_cfg.get("max_sends", 0),
+            flush_hits=tracking_cfg.get("flush_hits", 2),
+        )
 
-    frame_count = 0
-    frame_freq = model_cfg.get("frame_freq", 15)
+    bytes_name = encode_camera(name)
+    # Um processo reiniciado continua a numeração, o servidor conta perdas por ela
+    crop_seq = start_seq
+    # Os ids de tracklet recomeçam a cada execução, a sessão os distingue
+    session = int.from_bytes(os.urandom(4), "big") or 1
+    conf = model_cfg.get("conf", 0.7)
+    quality = None
 
+    grabber.start()
     try:
         while command_ref["state"] == "start":
-            frame_count += 1
-            if frame_count % frame_freq != 0:
-                continue
+            if tuning is not None:
+                # Ajustes enviados pelo servidor para aliviar a sua carga
+                grabber.min_freq = int(tuning.setting("frame_freq", 1))
+                conf = tuning.setting("conf", model_cfg.get("conf", 0.7))
+                quality = tuning.setting("jpeg_quality", None)
+                if encoder is not None:
+                    encoder.max_quality = max(
+                        encoder.min_quality, int(quality or max_quality)
+                    )
+                tuning.report(
+                    grabbed=grabber.grabbed,
+                    decoded=grabber.decoded,
+                    consumed=grabber.consumed,
+                    latency_ms=grabber.latency * 1000,
+                )
+            if service is None:
+                frame = grabber.latest(timeout=1.0)
+                if frame is None:
+                    if grabber.finished:
+                        break
+                    continue
+                started = time.perf_counter()
+                if cache is not None:
+                    detections = [cache.detections(frame[0])]
+                else:
+                    detections = [result_boxes(r) for r in model(frame[2])]
+                grabber.report_latency(time.perf_counter() - started)
+            else:
+                try:
+                    frame, result = outbox.get(timeout=1.0)
+                except queue.Empty:
+                    if grabber.finished:
+                        break
+                    continue
+                detections = [result_boxes(result)]
+
+            frame_count, timestamp, img = frame
+            detect_us = elapsed_us(timestamp)
+            for boxes, confidences in detections:
+                keep = confidences > conf
+                boxes, confidences = boxes[keep], confidences[keep]
+
+                selected = [np.intp(box) for box in boxes]
+                crops = [img[box[1] : box[3], box[0] : box[2]] for box in selected]
+                # Um crop por detecção, ou só os escolhidos pelo tracker
+                sources = [(frame_count, timestamp, 0)] * len(selected)
+                if selector is not None:
+                    tracklets = selector.update(boxes, timestamp)
+                    for tracklet, box, crop, confidence in zip(
+                        tracklets, selected, crops, confidences
+                    ):
+                        tracklet.offer(
+                            crop_quality(crop, confidence),
+                            crop,
+                            box,
+                            (frame_count, timestamp),
+                        )
+                    chosen = selector.select(timestamp)
+                    sources = [(*source, track_id) for track_id, source, _, _ in chosen]
+                    selected = [box for _, _, box, _ in chosen]
+                    crops = [crop for _, _, _, crop in chosen]
+                if not crops:
+                    continue
+
+                if embedder is not None:
+                    msg_type = MSG_EMBEDDING
+                    payloads = [
+                        encode_embedding(e) for e in extract_embeddings(embedder, crops)
+                    ]
+                else:
+                    msg_type = MSG_CROP
+                    if encoder is not None:
+                        payloads = encoder.encode_all(crops)
+                    else:
+                        params = []
+                        if quality is not None:
+                            params = [int(cv2.IMWRITE_JPEG_QUALITY), int(quality)]
+                        payloads = [
+                            cv2.imencode(".jpg", crop, params)[1] for crop in crops
+                        ]
+
+                encode_us = elapsed_us(timestamp)
+                for (crop_frame, crop_timestamp, track_id), box, payload in zip(
+                    sources, selected, payloads
+                ):
+                    # Crops guardados pelo tracker contam desde a sua captura
+                    delay_us = elapsed_us(crop_timestamp, timestamp)
+                    packets = build_packets(
+                        bytes_name,
+                        crop_frame,
+                        crop_timestamp,
+                        box,
+                        crop_seq,
+                        payload,
+                        msg_type=msg_type,
+                        max_datagram=max_datagram,
+                        detect_us=delay_us + detect_us,
+                        encode_us=delay_us + encode_us,
+                        track_id=track_id,
+                        session=session,
+                    )
+                    crop_seq += 1
+                    fila.put({"packets": packets, "timestamp": crop_timestamp}, name)
+                    if tuning is not None:
+                        tuning.count("queued")
+    finally:
+        if service is not None:
+            service.unregister(name)
+        if encoder is not None:
+            encoder.close()
+        grabber.stop()
+        print(
+            f"[INFO] Captura finalizada {name}. Frames lidos: {grabber.grabbed}, "
+            f"processados: {grabber.consumed}, latência média: "
+            f"{grabber.latency * 1000:.1f}ms"
+        )
+        if selector is not None:
+            status = selector.get_status()
+            print(
+                f"[INFO] Tracking {name}: {status['tracklets']} tracklets, "
+                f"{status['selected']} crops enviados de {status['detections']} "
+                f"detecções"
+            )
+
+
+# timestamp and packet count of a ring message, then each packet's length
+RING_ITEM = struct.Struct("<dH")
+RING_PACKET = struct.Struct("<H")
+
 
-            ret, img = cam.read()
+class PacketRing:
+    """
+    Fila de envio sobre um ShmRing: o processo da câmera escreve os pacotes
+    prontos e a thread de envio do processo principal os lê, sem pickle.
+    """
 
-            if not ret:
+    def __init__(self, ring):
+        self.ring = ring
+        self.closed = False
+        self.progress = 0
+        self.sequence = 0
+
+    @property
+    def dropped(self):
+        return self.ring.dropped
+
+    def put(self, item, key=None):
+        if item is None:
+            self.close()
+            return
+        packets = item["packets"]
+        parts = [RING_ITEM.pack(item["timestamp"], len(packets))]
+        for packet in packets:
+            parts += [RING_PACKET.pack(len(packet)), packet]
+        # Frames e crops já processados, para o supervisor saber onde retomar
+        header = parse_header(packets[0])
+        self.progress = max(self.progress, header.frame_index + 1)
+        self.sequence = header.crop_seq + 1
+        self.ring.write(parts, self.progress, self.sequence)
+
+    def get(self, timeout=None):
+        """Próximo item, ou None quando a fila foi fechada e está vazia"""
+        while True:
+            message = self.ring.read(timeout=0.5)
+            if message is not None:
                 break
+            if self.closed:
+                return None
+        timestamp, count = RING_ITEM.unpack_from(message)
+        packets, pos = [], RING_ITEM.size
+        for _ in range(count):
+            (size,) = RING_PACKET.unpack_from(message, pos)
+            pos += RING_PACKET.size
+            packets.append(bytearray(message[pos : pos + size]))
+            pos += size
+        return {"packets": packets, "timestamp": timestamp}
 
-            results = model(img)
-            for result in results:
-                if not result.boxes:
-                    continue
+    def close(self):
+        self.closed = True
 
-                boxes = result.boxes.xyxy.cpu().numpy()
-                confidences = result.boxes.conf.cpu().numpy()
 
-                for box, confidence in zip(boxes, confidences):
-                    if confidence > model_cfg.get("conf", 0.7):
-                        box = np.intp(box)
-                        _, buffer = cv2.imencode(
-                            ".jpg", img[box[1] : box[3], box[0] : box[2]]
-                        )
-                        size = len(buffer)
-                        if size > 9000:
-                            continue
-                        size_bytes = str(size).zfill(4).encode("utf-8")
-                        header = bytes_name + size_bytes
-                        packet = header + buffer.tobytes()
-                        fila.put({"packet": packet})
-            # time.sleep(0.05)
+def camera_worker(instance_cfg, cfg, ring_handle, stop, start_frame, start_seq, tuning):
+    """Processo de uma câmera no runtime 'processes': captura, detecta e codifica"""
+    ring = ShmRing.attach(*ring_handle)
+    command_ref = {"state": "start"}
+
+    def wait_stop():
+        while not stop.value:
+            time.sleep(0.2)
+        command_ref["state"] = "exit"
+
+    threading.Thread(target=wait_stop, daemon=True).start()
+    cache = None
+    cache_cfg = cfg.get("node", {}).get("detection_cache", {})
+    if cache_cfg.get("enabled", False):
+        # O processo principal já gerou o cache, aqui ele só é aberto
+        cache = open_caches(
+            [instance_cfg["video"]],
+            cfg["model"],
+            cache_cfg.get("path", "detection_cache"),
+        )[instance_cfg["video"]]
+    try:
+        obj_detect(
+            command_ref,
+            PacketRing(ring),
+            instance_cfg["video"],
+            cfg,
+            instance_cfg["name"],
+            cache=cache,
+            start_frame=start_frame,
+            tuning=tuning,
+            start_seq=start_seq,
+        )
     finally:
-        cam.release()
-        print(f"[INFO] Captura finalizada {name}.")
+        ring.close()
+
+
+class CameraProcess:
+    """
+    Supervisor de uma câmera rodando em processo próprio. Um processo que
+    morre com erro é reiniciado a partir do último frame enviado, até
+    max_restarts vezes.
+    """
+
+    def __init__(self, instance_cfg, cfg, context, tuning=None):
+        node_cfg = cfg.get("node", {})
+        self.instance_cfg = instance_cfg
+        self.cfg = cfg
+        self.context = context
+        self.max_restarts = node_cfg.get("max_restarts", 5)
+        self.ring = ShmRing.create(int(node_cfg.get("ring_mb", 8) * 2**20), context)
+        self.queue = PacketRing(self.ring)
+        # Flag sem lock: um Event travaria o set() se o processo morresse
+        # esperando nele
+        self.stop_flag = context.RawValue("b", 0)
+        # Ajustes do servidor sobrevivem aos reinícios do processo
+        self.tuning = tuning
+        self.process = None
+        self.restarts = 0
+        self.thread = threading.Thread(target=self.supervise, daemon=True)
+
+    def spawn(self, start_frame, start_seq):
+        self.process = self.context.Process(
+            target=camera_worker,
+            args=(
+                self.instance_cfg,
+                self.cfg,
+                self.ring.handle(),
+                self.stop_flag,
+                start_frame,
+                start_seq,
+                self.tuning,
+            ),
+            name=f"camera-{self.instance_cfg['name']}",
+        )
+        self.process.start()
+
+    def start(self):
+        self.spawn(0, 0)
+        self.thread.start()
+        return self
+
+    def supervise(self):
+        name = self.instance_cfg["name"]
+        while True:
+            self.process.join()
+            if self.stop_flag.value or self.process.exitcode == 0:
+                break
+            if self.restarts >= self.max_restarts:
+                print(
+                    f"[ERRO] Câmera {name} caiu {self.restarts + 1} vezes, "
+                    f"desistindo (código {self.process.exitcode})"
+                )
+                break
+            self.restarts += 1
+            start_frame = self.ring.progress
+            start_seq = self.ring.sequence
+            print(
+                f"[ERRO] Processo da câmera {name} terminou com código "
+                f"{self.process.exitcode}, reiniciando no frame {start_frame} "
+                f"({self.restarts}/{self.max_restarts})"
+            )
+            self.spawn(start_frame, start_seq)
+        # Sem produtor, a fila termina quando esvaziar
+        self.queue.close()
+
+    def join(self, timeout=10.0):
+        """Para o processo da câmera e libera a memória compartilhada"""
+        self.stop_flag.value = 1
+        self.thread.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.thread.join()
+        self.queue.close()
+
+    def release(self):
+        self.ring.close()
+        self.ring.unlink()
+
+
+def heartbeat(client, name, fila, tuning, control, command_ref, interval):
+    """
+    Envia periodicamente as estatísticas da câmera para o endereço de onde
+    vieram os comandos do servidor
+    """
+    while True:
+        time.sleep(interval)
+        if command_ref["state"] == "exit":
+            break
+        if control["address"] is None:
+            continue
+        status = tuning.get_status()
+        stats = status["stats"]
+        stats["dropped"] = fila.dropped
+        stats["queue"] = max(0, stats["queued"] - stats["sent"] - fila.dropped)
+        message = {
+            "type": "hb",
+            "camera": name,
+            "state": command_ref["state"],
+            "stats": stats,
+            "settings": status["settings"],
+        }
+        try:
+            client.sendto(encode_message(message), control["address"])
+        except OSError as e:
+            print(f"[ERRO][{name}] Heartbeat: {e}")
 
 
-def run_instance(instance_cfg, cfg):
-    """Executa uma instância completa de leitura e envio."""
+def run_instance(instance_cfg, cfg, service=None, cache=None, context=None):
+    """
+    Executa uma instância completa de leitura e envio. Com um contexto de
+    multiprocessing a detecção roda num processo supervisionado.
+    """
     transmission_cfg = instance_cfg["transmission"]
     server_cfg = cfg["server"]
     client = create_client_socket(transmission_cfg, server_cfg)
+    udp = cfg.get("protocol", "udp").lower() == "udp"
     command_ref = {"state": "wait"}
-    fila = queue.Queue()
+    node_cfg = cfg.get("node", {})
+    control_cfg = cfg.get("control", {})
+    tuning = NodeTuning(context)
+    # Endereço do plano de controle do servidor, aprendido no primeiro comando
+    control = {"address": None}
+    handled = deque(maxlen=256)
 
-    # Threads
-    detect_thread = threading.Thread(
-        target=obj_detect,
-        args=(
-            command_ref,
-            fila,
-            instance_cfg["video"],
-            cfg["model"],
-            instance_cfg["name"],
-        ),
-    )
+    if context is not None:
+        detect_thread = CameraProcess(instance_cfg, cfg, context, tuning)
+        fila = detect_thread.queue
+    else:
+        fila = BoundedQueue(
+            node_cfg.get("queue_size", 0),
+            node_cfg.get("overflow_policy", "drop_oldest"),
+        )
+        detect_thread = threading.Thread(
+            target=obj_detect,
+            args=(
+                command_ref,
+                fila,
+                instance_cfg["video"],
+                cfg,
+                instance_cfg["name"],
+                service,
+                cache,
+                0,
+                tuning,
+            ),
+        )
     send_thread = threading.Thread(
-        target=enviar_mensagens, args=(fila, cfg, server_cfg)
+        target=enviar_mensagens, args=(fila, cfg, server_cfg, tuning)
     )
+    heartbeat_thread = None
+    if udp:
+        heartbeat_thread = threading.Thread(
+            target=heartbeat,
+            args=(
+                client,
+                instance_cfg["name"],
+                fila,
+                tuning,
+                control,
+                command_ref,
+                control_cfg.get("heartbeat_interval", 1.0),
+            ),
+            daemon=True,
+        )
+        heartbeat_thread.start()
 
     print(f"[INFO] Instância '{instance_cfg['name']}' iniciada. Aguardando comandos...")
     while command_ref["state"] != "exit":
-        msg = client.recv(64).decode()
+        if udp:
+            data, addr = client.recvfrom(4096)
+        else:
+            data, addr = client.recv(4096), None
+        message = decode_message(data)
+        if message is None:
+            continue
+        seq = message.get("seq")
+        if seq is not None and addr is not None:
+            # Confirma sempre, o servidor reenvia até receber o ack
+            client.sendto(
+                encode_message(
+                    {"type": "ack", "seq": seq, "camera": instance_cfg["name"]}
+                ),
+                addr,
+            )
+            control["address"] = addr
+            key = (message.get("session"), seq)
+            if key in handled:
+                continue
+            handled.append(key)
+        msg = message.get("cmd", "")
         if len(msg) > 0:
             print(f"[{instance_cfg['name']}] Mensagem recebida: {msg}")
             if msg == "start" and command_ref["state"] != msg:
@@ -154,7 +590,18 @@ def run_instance(instance_cfg, cfg):
                 fila.put(None)
                 detect_thread.join()
                 send_thread.join()
-                print(f"[INFO] Instância '{instance_cfg['name']}' finalizada.")
+                if heartbeat_thread is not None:
+                    heartbeat_thread.join()
+                print(
+                    f"[INFO] Instância '{instance_cfg['name']}' finalizada. "
+                    f"Crops descartados pela fila: {fila.dropped}"
+                )
+                if context is not None:
+                    print(
+                        f"[INFO] Processo da câmera reiniciado "
+                        f"{detect_thread.restarts} vezes"
+                    )
+                    detect_thread.release()
             elif msg == "warmup":
                 print("[INFO] Warmup iniciado")
                 count = 0
@@ -182,12 +629,54 @@ def run_instance(instance_cfg, cfg):
                     count += 1
                     time.sleep(0.05)
                 print("[INFO] Warmup finalizado")
+            elif msg == "set":
+                tuning.apply(message.get("settings", {}))
+                print(
+                    f"[{instance_cfg['name']}] Ajustes do servidor: "
+                    f"{tuning.get_status()['settings'] or 'config padrão'}"
+                )
 
 
 def main(cfg):
+    service = None
+    context = None
+    caches = {}
+    node_cfg = cfg.get("node", {})
+    videos = [instance["video"] for instance in cfg["instances"]]
+    # Exporta (e calibra) o detector uma vez, antes de threads ou processos
+    # carregarem o modelo
+    export_detector(cfg["model"], videos)
+    cache_cfg = node_cfg.get("detection_cache", {})
+    if cache_cfg.get("enabled", False):
+        # Detecta uma vez por vídeo/modelo e depois só lê as caixas do cache
+        caches = open_caches(
+            videos,
+            cfg["model"],
+            cache_cfg.get("path", "detection_cache"),
+            cache_cfg.get("batch_size", 16),
+        )
+    if node_cfg.get("runtime", "threads") == "processes":
+        # Um processo por câmera, cada um abre o seu modelo ou o seu cache
+        context = multiprocessing.get_context("spawn")
+        caches = {}
+    elif not caches and node_cfg.get("shared_inference", False):
+        # Um único modelo YOLO atende todas as câmeras deste processo
+        service = DetectionService(
+            cfg["model"], cfg["node"].get("batch_window_ms", 5) / 1000
+        )
+
     threads = []
     for instance_cfg in cfg["instances"]:
-        t = threading.Thread(target=run_instance, args=(instance_cfg, cfg))
+        t = threading.Thread(
+            target=run_instance,
+            args=(
+                instance_cfg,
+                cfg,
+                service,
+                caches.get(instance_cfg["video"]),
+                context,
+            ),
+        )
         t.start()
         threads.append(t)
 
@@ -0,0 +1,141 @@
+import queue
+import threading
+import time
+import cv2
+import numpy as np
+from embedding import create_embedder, extract_embeddings
+from queues import BoundedQueue
+
+_embedder = None
+
+
+def init_embed_worker(reid_cfg):
+    """Process pool initializer that loads one embedder per worker"""
+    global _embedder
+    _embedder = create_embedder(reid_cfg)
+
+
+def embed_frames(frames):
+    """Embed a batch of frames with the embedder owned by this worker"""
+    return extract_embeddings(_embedder, frames)
+
+
+def decode_crops(buffers):
+    """Decode a batch of JPEG buffers, None for the ones that fail"""
+    frames = []
+    for buffer in buffers:
+        try:
+            frame = cv2.imdecode(
+                np.frombuffer(buffer, dtype=np.uint8), cv2.IMREAD_COLOR
+            )
+        except Exception:
+            frame = None
+        frames.append(frame)
+    return frames
+
+
+def next_batch(source, batch_size, timeout):
+    """
+    Block for one item and then drain source until batch_size items are
+    collected or timeout seconds have passed. Returns None once the stop
+    sentinel is reached with nothing left to process.
+    """
+    item = source.get()
+    if item is None:
+        return None
+
+    batch = [item]
+    deadline = time.monotonic() + timeout
+    while len(batch) < batch_size:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            item = source.get(timeout=remaining)
+        except queue.Empty:
+            break
+        if item is None:
+            # Leave the sentinel for the next call so this batch still runs
+            source.put(None)
+            break
+        batch.append(item)
+    return batch
+
+
+class Stage:
+    """Input queue of a pipeline stage with its depth and item counters"""
+
+    def __init__(self, name, workers=1, maxsize=0, policy="drop_oldest", on_drop=None):
+        self.name = name
+        self.workers = workers
+        self.queue = BoundedQueue(maxsize, policy, on_drop)
+        self.threads = []
+        self.processed = 0
+        self.max_depth = 0
+        self.lock = threading.Lock()
+
+    def put(self, item, key=None):
+        self.queue.put(item, key)
+        depth = self.queue.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def get(self, timeout=None):
+        return self.queue.get(timeout=timeout)
+
+    def done(self, count=1):
+        with self.lock:
+            self.processed += count
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def stop(self, timeout=2.0):
+        """Send one sentinel per worker and wait for them to finish"""
+        for _ in self.threads:
+            self.queue.put(None)
+        alive = []
+        for t in self.threads:
+            t.join(timeout=timeout)
+            if t.is_alive():
+                alive.append(t)
+        self.threads.clear()
+        return alive
+
+    def get_status(self):
+        queue_status = self.queue.get_status()
+        return {
+            "depth": self.depth(),
+            "maxsize": queue_status["maxsize"],
+            "policy": queue_status["policy"],
+            "dropped": queue_status["dropped"],
+            "dropped_by_key": queue_status["dropped_by_key"],
+            "max_depth": self.max_depth,
+            "processed": self.processed,
+            "workers": self.workers,
+        }
+
+
+class LatencyWindow:
+    """Ring of the last size latencies, for percentile reporting"""
+
+    def __init__(self, size=10000):
+        self.samples = np.zeros(size, dtype=np.float64)
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def add(self, seconds):
+        with self.lock:
+            self.samples[self.count % len(self.samples)] = seconds
+            self.count += 1
+
+    def get_status(self):
+        """Count and p50/p95/p99 in milliseconds"""
+        with self.lock:
+            samples = self.samples[: min(self.count, len(self.samples))].copy()
+        status = {"count": self.count}
+        for q in (50, 95, 99):
+            status[f"p{q}_ms"] = (
+                float(np.percentile(samples, q)) * 1000 if samples.size else 0.0
+            )
+        return status
@@ -0,0 +1,310 @@
+import struct
+import time
+import numpy as np
+from collections import namedtuple, deque
+
+MAGIC = b"RI"
+VERSION = 4
+
+MSG_CROP = 1
+MSG_EMBEDDING = 2
+
+# Edge-First nodes send embeddings as little-endian float16
+EMBEDDING_DTYPE = np.dtype("<f2")
+
+# magic, version, type, camera, frame index, capture timestamp,
+# bbox (x1, y1, x2, y2), crop sequence, chunk index, chunk count, payload size,
+# node tracklet id (0 when the node does not track), tracking session of
+# the node (tracklet ids restart with it), microseconds from capture until
+# detection, encoding and sending finished
+HEADER_FORMAT = "!2sBB32sId4HIHHHIIIII"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+SEND_OFFSET = HEADER_SIZE - 4
+DEFAULT_MAX_DATAGRAM = 8192
+
+Header = namedtuple(
+    "Header",
+    [
+        "version",
+        "msg_type",
+        "camera",
+        "frame_index",
+        "timestamp",
+        "bbox",
+        "crop_seq",
+        "chunk_index",
+        "chunk_count",
+        "payload_size",
+        "track_id",
+        "session",
+        "detect_us",
+        "encode_us",
+        "send_us",
+    ],
+)
+
+
+def encode_camera(name):
+    """Camera name as the fixed 32-byte header field"""
+    return name.encode("utf-8")[:32].ljust(32, b"\0")
+
+
+def encode_embedding(embedding):
+    """Serialize an embedding for an MSG_EMBEDDING payload"""
+    return np.ascontiguousarray(embedding, dtype=EMBEDDING_DTYPE).tobytes()
+
+
+def decode_embedding(payload):
+    """Float32 copy of the embedding carried by an MSG_EMBEDDING payload"""
+    return np.frombuffer(payload, dtype=EMBEDDING_DTYPE).astype(np.float32)
+
+
+def elapsed_us(since, now=None):
+    """Microseconds from since to now that fit the header offsets"""
+    if now is None:
+        now = time.time()
+    return max(0, min(int((now - since) * 1e6), 0xFFFFFFFF))
+
+
+def stamp_send(packet, send_us):
+    """Write the send offset into a packet built by build_packets"""
+    struct.pack_into("!I", packet, SEND_OFFSET, send_us)
+
+
+def build_packets(
+    camera,
+    frame_index,
+    timestamp,
+    bbox,
+    crop_seq,
+    payload,
+    msg_type=MSG_CROP,
+    max_datagram=DEFAULT_MAX_DATAGRAM,
+    detect_us=0,
+    encode_us=0,
+    track_id=0,
+    session=0,
+):
+    """
+    Split a payload into datagrams that each carry the full header. Packets
+    are bytearrays so the sender can stamp them with stamp_send.
+    """
+    if isinstance(camera, str):
+        camera = encode_camera(camera)
+    payload = memoryview(payload).cast("B")
+    chunk_size = max_datagram - HEADER_SIZE
+    chunk_count = max(1, -(-len(payload) // chunk_size))
+    if chunk_count > 0xFFFF:
+        raise ValueError(f"Payload of {len(payload)} bytes needs too many chunks")
+
+    x1, y1, x2, y2 = (max(0, min(int(v), 0xFFFF)) for v in bbox)
+    packets = []
+    for chunk_index in range(chunk_count):
+        chunk = payload[chunk_index * chunk_size : (chunk_index + 1) * chunk_size]
+        packet = bytearray(HEADER_SIZE + len(chunk))
+        struct.pack_into(
+            HEADER_FORMAT,
+            packet,
+            0,
+            MAGIC,
+            VERSION,
+            msg_type,
+            camera,
+            frame_index,
+            timestamp,
+            x1,
+            y1,
+            x2,
+            y2,
+            crop_seq & 0xFFFFFFFF,
+            chunk_index,
+            chunk_count,
+            len(chunk),
+            track_id,
+            session,
+            detect_us,
+            encode_us,
+            0,
+        )
+        packet[HEADER_SIZE:] = chunk
+        packets.append(packet)
+    return packets
+
+
+def parse_header(data):
+    """Parse the header of a datagram, None if it is not a valid packet"""
+    if len(data) < HEADER_SIZE:
+        return None
+    fields = struct.unpack_from(HEADER_FORMAT, data)
+    magic, version, msg_type, camera, frame_index, timestamp = fields[:6]
+    if magic != MAGIC or version != VERSION:
+        return None
+    crop_seq, chunk_index, chunk_count, payload_size = fields[10:14]
+    if chunk_index >= chunk_count:
+        return None
+    return Header(
+        version,
+        msg_type,
+        bytes(camera).decode("utf-8", errors="replace").rstrip("\0"),
+        frame_index,
+        timestamp,
+        tuple(fields[6:10]),
+        crop_seq,
+        chunk_index,
+        chunk_count,
+        payload_size,
+        *fields[14:],
+    )
+
+
+class CameraStats:
+    """Loss and latency counters of the crops received from one camera"""
+
+    def __init__(self):
+        self.completed = 0
+        self.expired = 0
+        self.lost = 0
+        self.last_seq = None
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+
+    def see(self, crop_seq):
+        """Track crop sequence gaps, late arrivals give back a lost crop"""
+        if self.last_seq is None or crop_seq > self.last_seq:
+            if self.last_seq is not None:
+                self.lost += crop_seq - self.last_seq - 1
+            self.last_seq = crop_seq
+        elif self.lost > 0:
+            self.lost -= 1
+
+    def get_status(self):
+        return {
+            "completed": self.completed,
+            "expired": self.expired,
+            "lost": self.lost,
+            "latency_avg": self.latency_sum / self.completed if self.completed else 0.0,
+            "latency_max": self.latency_max,
+        }
+
+
+class Reassembler:
+    """
+    Rebuilds crops split across several datagrams.
+
+    Partial crops older than timeout seconds are discarded and counted
+    as expired for their camera.
+    """
+
+    def __init__(self, timeout=1.0):
+        self.timeout = timeout
+        self.pending = {}
+        self.cameras = {}
+
+    def camera_stats(self, camera):
+        stats = self.cameras.get(camera)
+        if stats is None:
+            stats = self.cameras[camera] = CameraStats()
+        return stats
+
+    def _complete(self, header, payload, now):
+        stats = self.camera_stats(header.camera)
+        stats.completed += 1
+        latency = max(0.0, now - header.timestamp)
+        stats.latency_sum += latency
+        if latency > stats.latency_max:
+            stats.latency_max = latency
+        return header, payload
+
+    def add(self, header, payload, now=None):
+        """Store one chunk, returns (header, payload) once the crop is whole"""
+        if now is None:
+            now = time.time()
+
+        if header.chunk_count == 1:
+            self.camera_stats(header.camera).see(header.crop_seq)
+            return self._complete(header, payload, now)
+
+        key = (header.camera, header.crop_seq)
+        entry = self.pending.get(key)
+        if entry is None:
+            self.camera_stats(header.camera).see(header.crop_seq)
+            entry = self.pending[key] = {
+                "chunks": [None] * header.chunk_count,
+                "received": 0,
+                "first_seen": now,
+            }
+        if entry["chunks"][header.chunk_index] is None:
+            entry["chunks"][header.chunk_index] = bytes(payload)
+            entry["received"] += 1
+
+        if entry["received"] < header.chunk_count:
+            return None
+
+        del self.pending[key]
+        return self._complete(header, b"".join(entry["chunks"]), now)
+
+    def expire(self, now=None):
+        """Drop partial crops that waited longer than the timeout"""
+        if now is None:
+            now = time.time()
+        expired = [
+            key
+            for key, entry in self.pending.items()
+            if now - entry["first_seen"] > self.timeout
+        ]
+        for key in expired:
+            del self.pending[key]
+            self.camera_stats(key[0]).expired += 1
+        return len(expired)
+
+    def get_status(self):
+        return {
+            "pending": len(self.pending),
+            "cameras": {n: s.get_status() for n, s in self.cameras.items()},
+        }
+
+
+def merge_status(reassemblers):
+    """Combine the transport status of several receivers"""
+    cameras = {}
+    for reassembler in reassemblers:
+        for name, stats in reassembler.cameras.items():
+            merged = cameras.setdefault(name, CameraStats())
+            merged.completed += stats.completed
+            merged.expired += stats.expired
+            merged.lost += stats.lost
+            merged.latency_sum += stats.latency_sum
+            merged.latency_max = max(merged.latency_max, stats.latency_max)
+    return {
+        "pending": sum(len(r.pending) for r in reassemblers),
+        "cameras": {n: s.get_status() for n, s in cameras.items()},
+    }
+
+
+class BufferPool:
+    """
+    Preallocated receive buffers for recv_into.
+
+    When every buffer is in use a new one is allocated and counted as a
+    miss; only up to count buffers are kept when they come back.
+    """
+
+    def __init__(self, count, size):
+        self.count = count
+        self.size = size
+        self.free = deque(bytearray(size) for _ in range(count))
+        self.misses = 0
+
+    def acquire(self):
+        try:
+            return self.free.pop()
+        except IndexError:
+            self.misses += 1
+            return bytearray(self.size)
+
+    def release(self, buffer):
+        if len(self.free) < self.count:
+            self.free.append(buffer)
+
+    def get_status(self):
+        return {"free": len(self.free), "count": self.count, "misses": self.misses}
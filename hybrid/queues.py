@@ -0,0 +1,124 @@
+import queue
+import threading
+from collections import deque
+
+POLICIES = ("drop_oldest", "drop_newest", "fair_share")
+
+
+class BoundedQueue:
+    """
+    Queue with a maximum size and an explicit overflow policy.
+
+    - drop_oldest: the oldest item is discarded to make room
+    - drop_newest: the incoming item is discarded
+    - fair_share: items are kept per key (camera) and served round-robin;
+      when full, the key holding the most items loses its oldest one
+
+    None is treated as a stop sentinel: it is never dropped and is only
+    returned once every queued item has been consumed. on_drop is called
+    with every discarded item, e.g. to return its buffers to a pool.
+    """
+
+    def __init__(self, maxsize=0, policy="drop_oldest", on_drop=None):
+        if policy not in POLICIES:
+            raise ValueError(f"Unsupported overflow policy: {policy}")
+        self.maxsize = maxsize
+        self.policy = policy
+        self.items = {}
+        self.order = deque()
+        self.size = 0
+        self.sentinels = 0
+        self.dropped = 0
+        self.dropped_by_key = {}
+        self.on_drop = on_drop
+        self.cond = threading.Condition()
+
+    def _slot(self, key):
+        return key if self.policy == "fair_share" else None
+
+    def _popleft(self, slot):
+        key, item = self.items[slot].popleft()
+        self.size -= 1
+        if not self.items[slot]:
+            del self.items[slot]
+            self.order.remove(slot)
+        return key, item
+
+    def _drop(self, key, item):
+        self.dropped += 1
+        self.dropped_by_key[key] = self.dropped_by_key.get(key, 0) + 1
+        if self.on_drop is not None:
+            self.on_drop(item)
+
+    def _evict(self, key, item):
+        """Make room for item of key, returns False to reject it"""
+        if self.policy == "drop_newest":
+            self._drop(key, item)
+            return False
+
+        victim = self._slot(key)
+        if self.policy == "fair_share":
+            longest = max(self.items, key=lambda k: len(self.items[k]))
+            if len(self.items.get(victim, ())) < len(self.items[longest]):
+                victim = longest
+
+        dropped_key, dropped = self._popleft(victim)
+        self._drop(dropped_key, dropped)
+        return True
+
+    def put(self, item, key=None):
+        """Enqueue without blocking, the overflow policy decides what is dropped"""
+        with self.cond:
+            if item is None:
+                self.sentinels += 1
+                self.cond.notify()
+                return
+
+            if self.maxsize > 0 and self.size >= self.maxsize:
+                if not self._evict(key, item):
+                    return
+
+            slot = self._slot(key)
+            if slot not in self.items:
+                self.items[slot] = deque()
+                self.order.append(slot)
+            self.items[slot].append((key, item))
+            self.size += 1
+            self.cond.notify()
+
+    def _pop(self):
+        # Round-robin over the slots, a single slot unless fair_share
+        slot = self.order[0]
+        self.order.rotate(-1)
+        _, item = self._popleft(slot)
+        return item
+
+    def get(self, block=True, timeout=None):
+        with self.cond:
+            if not self.cond.wait_for(
+                lambda: self.size > 0 or self.sentinels > 0,
+                timeout if block else 0,
+            ):
+                raise queue.Empty
+            if self.size > 0:
+                return self._pop()
+            self.sentinels -= 1
+            return None
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def qsize(self):
+        return self.size
+
+    def empty(self):
+        return self.size == 0
+
+    def get_status(self):
+        return {
+            "size": self.size,
+            "maxsize": self.maxsize,
+            "policy": self.policy,
+            "dropped": self.dropped,
+            "dropped_by_key": dict(self.dropped_by_key),
+        }
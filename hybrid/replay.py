@@ -0,0 +1,334 @@
+import argparse
+import copy
+import hashlib
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import cv2
+import numpy as np
+import yaml
+from scipy.optimize import linear_sum_assignment
+from server import PersonReidentificationServer
+
+# reid settings that change the embeddings and so need their own recording
+EMBEDDER_KEYS = ("embedder", "half")
+
+
+def load_ground_truth(path, skip_occluded=False):
+    """
+    Dataset annotations as {frame: [(track_id, (x1, y1, x2, y2))]}, lost
+    boxes are skipped
+    """
+    boxes = {}
+    with open(path, "r") as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) < 9:
+                continue
+            track_id, x1, y1, x2, y2, frame, lost, occluded = map(int, fields[:8])
+            if lost or (skip_occluded and occluded):
+                continue
+            boxes.setdefault(frame, []).append((track_id, (x1, y1, x2, y2)))
+    return boxes
+
+
+def record_camera(embedder, name, video, ground_truth, frame_step, min_size):
+    """Embeddings of every annotated box of one camera, every frame_step frames"""
+    from embedding import extract_embeddings
+
+    boxes = load_ground_truth(ground_truth)
+    cam = cv2.VideoCapture(video)
+    fps = cam.get(cv2.CAP_PROP_FPS) or 25.0
+    records = {"frame": [], "timestamp": [], "bbox": [], "gt": [], "embedding": []}
+    frame = 0
+    while True:
+        if frame % frame_step or frame not in boxes:
+            if not cam.grab():
+                break
+            frame += 1
+            continue
+        ret, img = cam.read()
+        if not ret:
+            break
+
+        crops, kept = [], []
+        h, w = img.shape[:2]
+        for track_id, (x1, y1, x2, y2) in boxes[frame]:
+            x1, y1 = max(0, x1), max(0, y1)
+            x2, y2 = min(w, x2), min(h, y2)
+            if x2 - x1 < min_size or y2 - y1 < min_size:
+                continue
+            crops.append(img[y1:y2, x1:x2])
+            kept.append((track_id, (x1, y1, x2, y2)))
+        if crops:
+            embeddings = extract_embeddings(embedder, crops)
+            for (track_id, bbox), embedding in zip(kept, embeddings):
+                records["frame"].append(frame)
+                records["timestamp"].append(frame / fps)
+                records["bbox"].append(bbox)
+                records["gt"].append(track_id)
+                records["embedding"].append(embedding)
+        frame += 1
+    cam.release()
+    print(f"[INFO] {name}: {len(records['gt'])} crops recorded from {video}")
+    return records
+
+
+def record(cfg, cameras, frame_step, min_size, cache_dir):
+    """
+    Build (or load from cache) the recording: every annotated crop of every
+    camera, embedded once and sorted by timestamp
+    """
+    reid_cfg = cfg.get("reid", {})
+    key = hashlib.sha1(
+        json.dumps(
+            {
+                "cameras": [
+                    (name, video, gt, os.path.getmtime(video), os.path.getmtime(gt))
+                    for name, video, gt in cameras
+                ],
+                "reid": {k: reid_cfg.get(k) for k in EMBEDDER_KEYS},
+                "frame_step": frame_step,
+                "min_size": min_size,
+            },
+            sort_keys=True,
+        ).encode()
+    ).hexdigest()[:16]
+    path = os.path.join(cache_dir, f"recording_{key}.npz")
+    if os.path.exists(path):
+        print(f"[INFO] Using cached recording {path}")
+        return path
+
+    from embedding import create_embedder
+
+    embedder = create_embedder(reid_cfg)
+    parts = []
+    for camera, (name, video, gt) in enumerate(cameras):
+        records = record_camera(embedder, name, video, gt, frame_step, min_size)
+        records["camera"] = [camera] * len(records["gt"])
+        parts.append(records)
+
+    def column(field, dtype):
+        values = [v for part in parts for v in part[field]]
+        return np.asarray(values, dtype=dtype)
+
+    timestamp = column("timestamp", np.float64)
+    # Stable sort keeps the frame order of each camera
+    order = np.argsort(timestamp, kind="stable")
+    os.makedirs(cache_dir, exist_ok=True)
+    np.savez(
+        path,
+        names=np.array([name for name, _, _ in cameras]),
+        camera=column("camera", np.int32)[order],
+        frame=column("frame", np.int64)[order],
+        timestamp=timestamp[order],
+        bbox=column("bbox", np.int32).reshape(-1, 4)[order],
+        gt=column("gt", np.int64)[order],
+        embedding=column("embedding", np.float32)[order],
+    )
+    print(f"[INFO] Recording saved to {path}")
+    return path
+
+
+class ReplayServer(PersonReidentificationServer):
+    """Server without sockets or pipeline, running on the recording clock"""
+
+    def __init__(self, cfg):
+        super().__init__(config_path=None)
+        self.cfg = cfg
+        self.logger = logging.getLogger("PersonReIDReplay")
+        self.replay_time = 0.0
+        self.event_log_every = 0
+
+    def clock(self):
+        return self.replay_time
+
+
+def id_metrics(gt, predicted):
+    """
+    Identity metrics of the assignments against the annotations:
+    - idf1: share of crops with the right id under the best one-to-one
+      mapping between predicted and annotated ids
+    - purity: share of crops agreeing with the majority annotation of
+      their predicted id
+    - completeness: share of crops agreeing with the majority prediction
+      of their annotated id
+    - switches: changes of predicted id along each annotated track
+    """
+    gt_ids, gt_index = np.unique(gt, return_inverse=True)
+    pred_ids, pred_index = np.unique(predicted, return_inverse=True)
+    counts = np.zeros((len(gt_ids), len(pred_ids)), dtype=np.int64)
+    np.add.at(counts, (gt_index, pred_index), 1)
+
+    rows, cols = linear_sum_assignment(-counts)
+    total = len(gt)
+    switches = 0
+    for g in range(len(gt_ids)):
+        track = pred_index[gt_index == g]
+        switches += int(np.count_nonzero(track[1:] != track[:-1]))
+    return {
+        "idf1": float(counts[rows, cols].sum() / total),
+        "purity": float(counts.max(axis=0).sum() / total),
+        "completeness": float(counts.max(axis=1).sum() / total),
+        "switches": switches,
+        "gt_ids": len(gt_ids),
+        "predicted_ids": len(pred_ids),
+    }
+
+
+_recording = None
+
+
+def init_replay_worker(path):
+    """Process pool initializer that loads the recording once per worker"""
+    global _recording
+    logging.getLogger("PersonReIDReplay").setLevel(logging.WARNING)
+    _recording = dict(np.load(path))
+
+
+def apply_overrides(cfg, overrides):
+    cfg = copy.deepcopy(cfg)
+    for key, value in overrides.items():
+        section, name = key.split(".", 1)
+        cfg.setdefault(section, {})[name] = value
+    return cfg
+
+
+def replay(cfg, overrides):
+    """Run the recording through assign_identity with one parameter set"""
+    cfg = apply_overrides(cfg, overrides)
+    # Nothing is persisted or written by a replay
+    cfg.setdefault("gallery", {})["path"] = ""
+
+    server = ReplayServer(cfg)
+    server.setup_reid()
+
+    rec = _recording
+    names = [str(name) for name in rec["names"]]
+    predicted = np.empty(len(rec["gt"]), dtype=np.int64)
+    start = time.perf_counter()
+    for i in range(len(predicted)):
+        server.replay_time = float(rec["timestamp"][i])
+        predicted[i] = server.assign_identity(
+            rec["embedding"][i], names[rec["camera"][i]]
+        )
+    elapsed = time.perf_counter() - start
+
+    metrics = id_metrics(rec["gt"], predicted)
+    metrics["crops"] = len(predicted)
+    metrics["throughput"] = len(predicted) / max(elapsed, 1e-9)
+    return {"params": overrides, "metrics": metrics}
+
+
+def parse_grid(specs):
+    """['reid.similarity_threshold=0.1,0.2', ...] to a list of override dicts"""
+    axes = []
+    for spec in specs:
+        key, _, values = spec.partition("=")
+        axes.append([(key, yaml.safe_load(v)) for v in values.split(",")])
+    return [dict(combination) for combination in itertools.product(*axes)]
+
+
+def replay_all(path, cfg, grid, workers):
+    if workers <= 1:
+        init_replay_worker(path)
+        return [replay(cfg, overrides) for overrides in grid]
+
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=context,
+        initializer=init_replay_worker,
+        initargs=(path,),
+    ) as pool:
+        futures = [pool.submit(replay, cfg, overrides) for overrides in grid]
+        return [future.result() for future in futures]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--config", default="config.yaml", help="config base")
+    parser.add_argument(
+        "-g",
+        "--grid",
+        nargs="*",
+        default=[],
+        help="parâmetros a variar, ex: reid.similarity_threshold=0.1,0.13,0.2",
+    )
+    parser.add_argument(
+        "--frame-step",
+        type=int,
+        default=None,
+        help="usa um frame a cada N (padrão: model.frame_freq)",
+    )
+    parser.add_argument(
+        "--min-size", type=int, default=16, help="menor lado de um crop anotado"
+    )
+    parser.add_argument(
+        "--cache", default="replay_cache", help="pasta das gravações de embeddings"
+    )
+    parser.add_argument(
+        "-w", "--workers", type=int, default=None, help="processos do grid"
+    )
+    parser.add_argument("--json", default=None, help="salva o relatório em JSON")
+    args = parser.parse_args()
+
+    with open(args.config, "r") as f:
+        cfg = yaml.safe_load(f)
+
+    # Annotations sit next to each video unless the instance says otherwise
+    cameras = [
+        (
+            instance["name"],
+            instance["video"],
+            instance.get(
+                "ground_truth", os.path.splitext(instance["video"])[0] + ".txt"
+            ),
+        )
+        for instance in cfg["instances"]
+    ]
+    frame_step = args.frame_step or cfg.get("model", {}).get("frame_freq", 1)
+
+    # Parameter sets that share the embedder settings share a recording
+    groups = {}
+    for overrides in parse_grid(args.grid):
+        embedder = tuple(
+            (key, value)
+            for key, value in overrides.items()
+            if key.startswith("reid.") and key[5:] in EMBEDDER_KEYS
+        )
+        groups.setdefault(embedder, []).append(overrides)
+
+    results = []
+    for embedder, grid in groups.items():
+        path = record(
+            apply_overrides(cfg, dict(embedder)),
+            cameras,
+            frame_step,
+            args.min_size,
+            args.cache,
+        )
+        workers = args.workers or min(len(grid), multiprocessing.cpu_count())
+        results += replay_all(path, cfg, grid, workers)
+    results.sort(key=lambda r: r["metrics"]["idf1"], reverse=True)
+
+    print(
+        f"{'idf1':>7} {'purity':>7} {'compl':>7} {'switch':>7} "
+        f"{'ids':>9} {'crops/s':>9}  params"
+    )
+    for result in results:
+        m = result["metrics"]
+        ids = f"{m['predicted_ids']}/{m['gt_ids']}"
+        params = " ".join(f"{k}={v}" for k, v in result["params"].items())
+        print(
+            f"{m['idf1']:7.3f} {m['purity']:7.3f} {m['completeness']:7.3f} "
+            f"{m['switches']:7d} {ids:>9} {m['throughput']:9.0f}  {params}"
+        )
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
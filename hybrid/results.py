@@ -0,0 +1,175 @@
+import os
+import queue
+import re
+import threading
+import time
+from datetime import datetime
+from queues import BoundedQueue
+
+
+class ResultsWriter:
+    """
+    Streams ReID assignments to disk in the ground-truth format of the
+    dataset, one file per camera:
+
+        track_id xmin ymin xmax ymax frame lost occluded generated "PERSON"
+
+    followed by the capture timestamp when timestamps is set. Records are
+    written by a background thread in batches; files are flushed every
+    flush_interval seconds, fsynced every fsync_interval seconds and
+    rotated into a new numbered segment once they reach rotate_bytes.
+
+    Camera names come from the network, so when cameras is given only
+    those are written, and every name is reduced to a safe file name.
+    """
+
+    def __init__(
+        self,
+        path="results",
+        flush_interval=1.0,
+        fsync_interval=5.0,
+        rotate_bytes=64 * 1024 * 1024,
+        queue_size=8192,
+        batch_size=256,
+        timestamps=True,
+        cameras=None,
+    ):
+        self.directory = os.path.join(
+            path, f"run_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        )
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.rotate_bytes = rotate_bytes
+        self.batch_size = batch_size
+        self.timestamps = timestamps
+        self.cameras = set(cameras) if cameras is not None else None
+        self.rejected = 0
+        self.queue = BoundedQueue(queue_size, "drop_newest")
+        self.files = {}
+        self.segments = {}
+        self.written = 0
+        self.rotations = 0
+        self.cond = threading.Condition()
+        # sync() tickets, served once the queue has been drained
+        self.sync_requested = 0
+        self.synced = 0
+        self.thread = None
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def write(self, camera, pid, frame_index, bbox, timestamp):
+        """Queue one assignment, never blocks the caller"""
+        if self.cameras is not None and camera not in self.cameras:
+            self.rejected += 1
+            return
+        self.queue.put((camera, pid, frame_index, bbox, timestamp), camera)
+
+    def sync(self, timeout=5.0):
+        """Wait until everything queued so far is written and fsynced"""
+        if self.thread is None or not self.thread.is_alive():
+            return False
+        with self.cond:
+            self.sync_requested += 1
+            ticket = self.sync_requested
+            return self.cond.wait_for(lambda: self.synced >= ticket, timeout)
+
+    def close(self, timeout=5.0):
+        """Write what is left, fsync and close every file"""
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        self.thread.join(timeout=timeout)
+        self.thread = None
+
+    def _open(self, camera):
+        segment = self.segments.get(camera, -1) + 1
+        self.segments[camera] = segment
+        safe = re.sub(r"[^\w.-]", "_", str(camera)).lstrip(".") or "_"
+        name = os.path.join(self.directory, f"{safe}.{segment:03d}.txt")
+        f = self.files[camera] = open(name, "a", buffering=1 << 16)
+        return f
+
+    def _format(self, record):
+        _, pid, frame_index, bbox, timestamp = record
+        x1, y1, x2, y2 = bbox
+        line = f'{pid} {x1} {y1} {x2} {y2} {frame_index} 0 0 0 "PERSON"'
+        if self.timestamps:
+            line += f" {timestamp:.6f}"
+        return line + "\n"
+
+    def _write_batch(self, records):
+        by_camera = {}
+        for record in records:
+            by_camera.setdefault(record[0], []).append(self._format(record))
+        for camera, lines in by_camera.items():
+            f = self.files.get(camera)
+            if f is None:
+                f = self._open(camera)
+            elif f.tell() >= self.rotate_bytes:
+                f.close()
+                self.rotations += 1
+                f = self._open(camera)
+            f.writelines(lines)
+        self.written += len(records)
+
+    def _sync_files(self):
+        for f in self.files.values():
+            f.flush()
+            os.fsync(f.fileno())
+
+    def run(self):
+        last_flush = last_fsync = time.monotonic()
+        stopping = False
+        while not stopping:
+            records = []
+            try:
+                item = self.queue.get(timeout=self.flush_interval)
+                while item is not None:
+                    records.append(item)
+                    if len(records) >= self.batch_size:
+                        break
+                    item = self.queue.get_nowait()
+                else:
+                    # The sentinel only comes out once the queue is empty
+                    stopping = True
+            except queue.Empty:
+                pass
+
+            if records:
+                self._write_batch(records)
+
+            with self.cond:
+                ticket = self.sync_requested
+            sync = ticket > self.synced and self.queue.qsize() == 0
+
+            now = time.monotonic()
+            if sync or stopping or now - last_fsync >= self.fsync_interval:
+                self._sync_files()
+                last_flush = last_fsync = now
+            elif now - last_flush >= self.flush_interval:
+                for f in self.files.values():
+                    f.flush()
+                last_flush = now
+
+            if sync or stopping:
+                with self.cond:
+                    self.synced = ticket
+                    self.cond.notify_all()
+
+        for f in self.files.values():
+            f.close()
+        self.files.clear()
+
+    def get_status(self):
+        return {
+            "directory": self.directory,
+            "written": self.written,
+            "pending": self.queue.qsize(),
+            "dropped": self.queue.dropped,
+            "rejected": self.rejected,
+            "rotations": self.rotations,
+        }
@@ -1,35 +1,80 @@
 import socket
 import threading
-import queue
-import cv2
-import numpy as np
-import struct
+import argparse
+import multiprocessing
 import yaml
 import time
 import logging
 import errno
 import os
+from collections import OrderedDict
 from datetime import datetime
-from scipy.spatial import distance
-from deep_sort_realtime.deepsort_tracker import DeepSort
+from concurrent.futures import ProcessPoolExecutor
+from gallery import IdentityIndex, TieredIndex, EmbeddingGallery
+from ann import create_sample_index
+from store import GalleryStore, iso_to_time
+from results import ResultsWriter
+from control import ControlPlane, BackpressureController
+from metrics import Metrics, MetricsServer
+from topology import CameraTopology
+from embedding import create_embedder, extract_embeddings
+from protocol import (
+    Reassembler,
+    BufferPool,
+    parse_header,
+    decode_embedding,
+    merge_status,
+    HEADER_SIZE,
+    DEFAULT_MAX_DATAGRAM,
+    MSG_EMBEDDING,
+)
+from pipeline import (
+    Stage,
+    LatencyWindow,
+    next_batch,
+    decode_crops,
+    embed_frames,
+    init_embed_worker,
+)
 
 
 class PersonReidentificationServer:
     def __init__(self, config_path="config.yaml"):
         self.detectedPersons = {}
+        self.index = IdentityIndex()
+        self.samples = None
+        self.tracklets = OrderedDict()
+        self.tracklet_memory = 4096
         self.threads = []
         self.clients = []
-        self.lines = []
+        self.results = None
         self.id_counter = 0
         self.command = "wait"
         self.server = None
         self.server_lock = threading.Lock()
-        self.tracker = None
+        self.control = None
+        self.controller = None
+        self.control_interval = 1.0
+        self.embedder = None
+        self.topology = None
+        self.store = None
+        self.latency = LatencyWindow()
+        self.metrics = Metrics()
+        self.metrics_server = None
+        self.event_log_every = 1
+        self.events = 0
+        self.aging_interval = 1.0
+        self.last_aging = 0.0
         self.cfg = None
         self.config_path = config_path
         self.running = False
         self.logger = None
-        self.queue = queue.Queue()
+        self.stages = {}
+        self.receivers = []
+        self.reassemblers = []
+        self.buffer_pool = None
+        self.decode_pool = None
+        self.embed_pool = None
 
     def setup_logging(self):
         """Setup logging configuration"""
@@ -75,6 +120,25 @@ class PersonReidentificationServer:
             clients.append(instance_cfg["transmission"])
         return clients
 
+    def create_server_socket(self, host, port):
+        """Create a UDP socket bound to the server port"""
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+        # SO_REUSEPORT lets several receiver sockets share the port
+        try:
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        except AttributeError:
+            pass  # SO_REUSEPORT not available on this platform
+
+        buffer_size = self.cfg["server"].get("buffer_size") if self.cfg else None
+        if buffer_size:
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, buffer_size)
+
+        server.bind((host, port))
+        return server
+
     def initialize(self):
         """Initialize server components"""
         self.setup_logging()
@@ -90,209 +154,624 @@ class PersonReidentificationServer:
         server_port = netcfg.get("port", 5000)
 
         try:
-            self.server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-
-            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-
-            # On Linux, you might need SO_REUSEPORT instead
-            try:
-                self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
-            except AttributeError:
-                pass  # SO_REUSEPORT not available on this platform
-
-            self.server.bind((server_host, server_port))
-            self.logger.info(f"UDP server bound to {server_host}:{server_port}")
+            self.server = self.create_server_socket(server_host, server_port)
+            self.receivers = [self.server]
+            for _ in range(netcfg.get("receivers", 1) - 1):
+                self.receivers.append(
+                    self.create_server_socket(server_host, server_port)
+                )
+            self.logger.info(
+                f"UDP server bound to {server_host}:{server_port} "
+                f"with {len(self.receivers)} receiver sockets"
+            )
         except Exception as e:
             self.logger.error(f"Failed to initialize server socket: {e}")
             return False
 
+        self.buffer_pool = BufferPool(
+            netcfg.get("receive_buffers", 1024),
+            netcfg.get("max_datagram", DEFAULT_MAX_DATAGRAM),
+        )
+        self.reassemblers = [
+            Reassembler(netcfg.get("reassembly_timeout", 1.0)) for _ in self.receivers
+        ]
+
         self.clients = self.get_clients()
         self.logger.info(
             f"Loaded {len(self.clients) if self.clients is not None else []} clients from configuration"
         )
 
-        reid_cfg = self.cfg.get("reid", {})
+        if not self.setup_control():
+            return False
+
+        results_cfg = self.cfg.get("results", {})
         try:
-            self.tracker = DeepSort(
-                max_age=reid_cfg.get("max_age", 10),
-                n_init=reid_cfg.get("n_init", 3),
-                nn_budget=reid_cfg.get("nn_budget", 100),
+            self.results = ResultsWriter(
+                results_cfg.get("path", "results"),
+                results_cfg.get("flush_interval", 1.0),
+                results_cfg.get("fsync_interval", 5.0),
+                int(results_cfg.get("rotate_mb", 64) * 1024 * 1024),
+                results_cfg.get("queue_size", 8192),
+                results_cfg.get("batch_size", 256),
+                results_cfg.get("timestamps", True),
+                [instance["name"] for instance in self.cfg["instances"]],
+            ).start()
+            self.logger.info(f"Writing results to {self.results.directory}")
+        except Exception as e:
+            self.logger.error(f"Failed to start results writer: {e}")
+            return False
+
+        metrics_cfg = self.cfg.get("metrics", {})
+        self.event_log_every = metrics_cfg.get("event_log_every", 1)
+        http_port = metrics_cfg.get("http_port", 0)
+        if http_port:
+            try:
+                self.metrics_server = MetricsServer(
+                    self.render_metrics, "127.0.0.1", http_port
+                ).start()
+                self.logger.info(
+                    f"Metrics served on http://127.0.0.1:{http_port}/metrics"
+                )
+            except Exception as e:
+                self.logger.error(f"Failed to start metrics endpoint: {e}")
+                return False
+
+        if not self.setup_reid():
+            return False
+
+        pipeline_cfg = self.cfg.get("pipeline", {})
+        policy = pipeline_cfg.get("overflow_policy", "drop_oldest")
+        self.stages = {
+            "decode": Stage(
+                "decode",
+                pipeline_cfg.get("decode_workers", 1),
+                pipeline_cfg.get("decode_queue_size", 0),
+                policy,
+                self.release_buffer,
+            ),
+            "embed": Stage(
+                "embed",
+                pipeline_cfg.get("embed_workers", 1),
+                pipeline_cfg.get("embed_queue_size", 0),
+                policy,
+            ),
+            "assign": Stage("assign", 1),
+        }
+
+        reid_cfg = self.cfg.get("reid", {})
+        if pipeline_cfg.get("executor", "thread") == "thread":
+            try:
+                self.embedder = create_embedder(reid_cfg)
+                self.logger.info("DeepSort embedder initialized successfully")
+            except Exception as e:
+                self.logger.error(f"Failed to initialize DeepSort embedder: {e}")
+                return False
+
+        return True
+
+    def release_buffer(self, item):
+        """Return the receive buffer of a dropped decode item to the pool"""
+        if item.get("pool_buffer") is not None:
+            self.buffer_pool.release(item["pool_buffer"])
+            item["pool_buffer"] = None
+
+    def clock(self):
+        """Time used for last_seen, topology windows and aging"""
+        return time.time()
+
+    def setup_reid(self):
+        """Gallery, search index and topology, everything assign_identity needs"""
+        gallery_cfg = self.cfg.get("gallery", {})
+        if gallery_cfg.get("path"):
+            try:
+                self.store = GalleryStore(
+                    gallery_cfg["path"],
+                    self.cfg["reid"].get("max_gallery_per_person", 512),
+                    gallery_cfg.get("block_size", 256),
+                    gallery_cfg.get("snapshot_interval", 5.0),
+                )
+                self.index, self.detectedPersons, self.id_counter = self.store.open()
+                self.logger.info(
+                    f"Gallery store at {gallery_cfg['path']} loaded with "
+                    f"{len(self.detectedPersons)} persons"
+                )
+            except Exception as e:
+                self.logger.error(f"Failed to open gallery store: {e}")
+                return False
+
+        aging_cfg = self.cfg.get("aging", {})
+        if aging_cfg.get("enabled", False):
+            self.index = TieredIndex(
+                self.index,
+                aging_cfg.get("hot_ttl", 300.0),
+                aging_cfg.get("hot_capacity", 0),
+                aging_cfg.get("cold_ttl", 3600.0),
+                aging_cfg.get("cold_capacity", 0),
+                self.clock,
+            )
+            self.aging_interval = aging_cfg.get("interval", 1.0)
+            self.logger.info(
+                f"Identity aging enabled (hot ttl {self.index.hot_ttl}s, "
+                f"cold ttl {self.index.cold_ttl}s)"
+            )
+
+        # Stored identities that are not in the persisted hot index, in LRU order
+        for person in sorted(
+            self.detectedPersons.values(), key=lambda p: p["last_seen"]
+        ):
+            pid = person["id"]
+            if isinstance(self.index, TieredIndex):
+                self.index.restore(
+                    pid,
+                    person["extractedFeatures"].mean(),
+                    iso_to_time(person["last_seen"]),
+                )
+            elif pid not in self.index:
+                self.index.add(pid, person["extractedFeatures"].mean())
+
+        reid_cfg = self.cfg.get("reid", {})
+        if reid_cfg.get("search", "centroid") == "knn":
+            knn_cfg = reid_cfg.get("knn", {})
+            try:
+                self.samples = create_sample_index(knn_cfg)
+            except Exception as e:
+                self.logger.error(f"Failed to create knn index: {e}")
+                return False
+            for person in self.detectedPersons.values():
+                gallery = person["extractedFeatures"]
+                for slot in range(len(gallery)):
+                    self.samples.put(person["id"], slot, gallery.samples[slot])
+            self.logger.info(
+                f"Per-sample knn search enabled ({knn_cfg.get('backend', 'flat')}, "
+                f"k={self.samples.k}, {len(self.samples)} samples)"
+            )
+
+        self.tracklet_memory = reid_cfg.get("tracklet_memory", 4096)
+
+        topology_cfg = self.cfg.get("topology", {})
+        if topology_cfg.get("enabled", False):
+            self.topology = CameraTopology(
+                topology_cfg.get("adjacency", {}),
+                topology_cfg.get("transit_window", 30.0),
             )
-            self.logger.info("DeepSort tracker initialized successfully")
+            self.logger.info(
+                f"Topology pruning enabled (transit window {self.topology.transit_window}s)"
+            )
+        else:
+            self.logger.info("Topology pruning disabled, using exhaustive search")
+
+        return True
+
+    def setup_control(self):
+        """Acked command channel to the nodes and the backpressure controller"""
+        control_cfg = self.cfg.get("control", {})
+        instances = {i["name"]: i["transmission"] for i in self.cfg["instances"]}
+        host = self.cfg["server"].get("host", "0.0.0.0")
+        port = control_cfg.get("port", 8890)
+        try:
+            self.control = ControlPlane(
+                host,
+                port,
+                instances,
+                control_cfg.get("ack_timeout", 0.2),
+                control_cfg.get("retries", 10),
+                control_cfg.get("heartbeat_timeout", 5.0),
+                self.logger,
+            ).start()
+            self.logger.info(f"Node control channel bound to {host}:{port}")
         except Exception as e:
-            self.logger.error(f"Failed to initialize DeepSort tracker: {e}")
+            self.logger.error(f"Failed to initialize control channel: {e}")
             return False
 
+        controller_cfg = control_cfg.get("controller", {})
+        if controller_cfg.get("enabled", False):
+            model_cfg = self.cfg.get("model", {})
+            quality = self.cfg.get("node", {}).get("jpeg_quality", [40, 90])
+            self.control_interval = controller_cfg.get("interval", 1.0)
+            self.controller = BackpressureController(
+                {
+                    "frame_freq": model_cfg.get("frame_freq", 15),
+                    "jpeg_quality": max(quality),
+                    "conf": model_cfg.get("conf", 0.7),
+                },
+                high_watermark=controller_cfg.get("high_watermark", 0.7),
+                low_watermark=controller_cfg.get("low_watermark", 0.3),
+                drop_rate=controller_cfg.get("drop_rate", 0.01),
+                assign_backlog=controller_cfg.get("assign_backlog", 256),
+                max_level=controller_cfg.get("max_level", 3),
+                cooldown=controller_cfg.get("cooldown", 5),
+                min_quality=min(quality),
+            )
+            self.logger.info(
+                f"Backpressure controller enabled every {self.control_interval}s"
+            )
         return True
 
     def broadcast(self, message):
-        """Send message to all configured clients"""
+        """Send message to all configured clients and wait for their acks"""
 
-        if self.logger is None or self.clients is None:
+        if self.logger is None or self.control is None:
             return
 
-        with self.server_lock:
-            if self.server is None:
-                self.logger.warning("Server not initialized for broadcast")
-                return
-
-            success_count = 0
-            for client in self.clients:
-                try:
-                    self.server.sendto(
-                        message.encode(), (client["host"], client["port"])
-                    )
-                    success_count += 1
-                    self.logger.debug(
-                        f"Broadcast '{message}' to {client['host']}:{client['port']}"
+        acked = self.control.broadcast(message)
+        missing = [c for c in self.control.clients if c not in acked]
+        self.logger.info(
+            f"Broadcast '{message}' acknowledged by "
+            f"{len(acked)}/{len(self.control.clients)} clients"
+            + (f", no ack from {', '.join(missing)}" if missing else "")
+        )
+        return acked
+
+    def control_loop(self):
+        """Push throttle settings to the nodes while processing runs"""
+        self.logger.info("Backpressure controller started")
+        while self.command == "start":
+            time.sleep(self.control_interval)
+            levels = dict(self.controller.levels)
+            nodes = self.control.get_status()
+            changed = self.controller.step(
+                {n: s.get_status() for n, s in self.stages.items()},
+                merge_status(self.reassemblers),
+                nodes,
+            )
+            for camera, settings in changed.items():
+                level = self.controller.levels[camera]
+                # A node without heartbeats would only hold the loop in retries
+                alive = nodes.get(camera, {}).get("alive", False)
+                if alive and self.control.send([camera], "set", settings=settings):
+                    self.logger.info(
+                        f"Camera {camera} throttled to level {level}: {settings}"
                     )
-                except socket.error as e:
-                    if e.errno == errno.EAGAIN or e.errno == errno.EWOULDBLOCK:
-                        self.logger.info(
-                            f"Resource temporarily unavailable for {client['host']}:{client['port']}"
-                        )
-                        continue
-                    else:
-                        self.logger.error(
-                            f"Error notifying {client['host']}:{client['port']}: {e}"
-                        )
-                except Exception as e:
-                    self.logger.error(
-                        f"Unexpected error broadcasting to {client['host']}:{client['port']}: {e}"
+                else:
+                    # Tried again on the next step that still sees the overload
+                    self.controller.levels[camera] = levels.get(camera, 0)
+                    self.logger.warning(
+                        f"Camera {camera} not reachable for throttle level {level}"
                     )
+        self.logger.info("Backpressure controller stopped")
 
-            self.logger.info(
-                f"Broadcast '{message}' completed: {success_count}/{len(self.clients)} clients"
-            )
+    def start_controller(self):
+        """Run control_loop next to the pipeline when the controller is enabled"""
+        if self.controller is None:
+            return
+        t = threading.Thread(target=self.control_loop)
+        t.daemon = True
+        self.threads.append(t)
+        t.start()
 
-    def add_new_person(self, extractedFeature, client_name):
+    def add_new_person(self, embedding, client_name, log=True):
         """Add new person to the gallery"""
-        if self.logger is None:
+        if self.logger is None or self.cfg is None:
             return
 
+        max_gallery = self.cfg["reid"].get("max_gallery_per_person", 512)
         pid = self.id_counter
+        now = self.clock()
+        row = None
+        if self.store is not None:
+            row, gallery = self.store.new_gallery(pid, embedding.shape[0], now)
+        else:
+            gallery = EmbeddingGallery(embedding.shape[0], max_gallery)
+        slot = gallery.append(embedding)
+        if self.store is not None:
+            self.store.touch(row, gallery)
+        if self.samples is not None:
+            self.samples.put(pid, slot, embedding)
+
+        seen = datetime.fromtimestamp(now).isoformat()
         self.detectedPersons[f"id_{pid}"] = {
-            "extractedFeatures": extractedFeature,
+            "extractedFeatures": gallery,
             "id": pid,
+            "row": row,
             "appearances": 1,
-            "first_seen": datetime.now().isoformat(),
-            "last_seen": datetime.now().isoformat(),
+            "first_seen": seen,
+            "last_seen": seen,
         }
+        self.index.add(pid, gallery.mean())
 
         self.id_counter += 1
 
-        self.logger.info(f"New person id_{pid} registered from {client_name}")
+        if log:
+            self.logger.info(f"New person id_{pid} registered from {client_name}")
         return pid
 
-    def reId(self):
+    def assign_identity(self, embedding, client_name, header=None):
+        """Match an embedding against the gallery and assign it an id"""
+        if self.logger is None or self.cfg is None:
+            return
+
+        now = self.clock()
+        log = self.sample_event()
+        pids = None
+        if self.topology is not None:
+            pids = self.topology.candidates(client_name, now)
+
+        sim_thresh = self.cfg["reid"].get("similarity_threshold", 0.13)
+        if self.samples is not None:
+            match = self.search_samples(embedding, pids, sim_thresh)
+        elif isinstance(self.index, TieredIndex):
+            match = self.index.search(embedding, pids, sim_thresh)
+        else:
+            match = self.index.search(embedding, pids)
+        tracked = self.tracked_person(client_name, header)
+        if tracked is not None and (match is None or match[1] >= sim_thresh):
+            # The node saw the same person, trust its tracklet over a miss
+            pid = tracked
+            self.update_person(pid, embedding, now)
+            if log:
+                self.logger.info(
+                    f"Continued tracklet {header.track_id} as id_{pid} from {client_name}"
+                )
+        elif match is None:
+            pid = self.add_new_person(embedding, client_name, log)
+            if log:
+                self.logger.info(
+                    f"New person id_{pid} registered from {client_name} (no candidates)"
+                )
+        else:
+            top_id, top_score = match
+
+            if top_score < sim_thresh:
+                pid = top_id
+                self.update_person(pid, embedding, now)
+                if log:
+                    self.logger.info(
+                        f"Matched existing person id_{pid} (score={top_score:.4f}) from {client_name}"
+                    )
+            else:
+                pid = self.add_new_person(embedding, client_name, log)
+                if log:
+                    self.logger.info(
+                        f"New person id_{pid} created (best match score={top_score:.4f}) from {client_name}"
+                    )
+
+        if self.topology is not None:
+            self.topology.mark(client_name, pid, now)
+        if header is not None and header.track_id:
+            key = (client_name, header.session, header.track_id)
+            self.tracklets[key] = pid
+            self.tracklets.move_to_end(key)
+            if len(self.tracklets) > self.tracklet_memory:
+                self.tracklets.popitem(last=False)
+        if header is not None:
+            self.results.write(
+                client_name, pid, header.frame_index, header.bbox, header.timestamp
+            )
+        if (
+            isinstance(self.index, TieredIndex)
+            and now - self.last_aging >= self.aging_interval
+        ):
+            self.age_identities(now)
+        if self.store is not None:
+            self.store.maybe_snapshot(self.detectedPersons, self.id_counter)
+        return pid
+
+    def search_samples(self, embedding, pids, threshold):
         """
-        Re-identification logic using DeepSORT for embedding extraction
+        k-NN vote over the stored samples. The winner is scored by the
+        distance to its centroid, so similarity_threshold keeps the meaning
+        it has for centroid search. With aging the hot identities are voted
+        on first and cold ones only when that misses the threshold, as
+        TieredIndex.search does for centroids.
         """
 
-        if self.logger is None or self.tracker is None or self.cfg is None:
-            return
-
-        while True:
-            item = self.queue.get()
-            if item is None:
-                break
-            frame = item["frame"]
-            client_name = item["client_name"]
+        def search(candidates):
+            match = self.samples.search(embedding, candidates)
+            if match is None:
+                return None
+            return self.index.search(embedding, (match[0],))
+
+        if not isinstance(self.index, TieredIndex) or not self.index.cold_seen:
+            return search(pids)
+
+        def tier(seen):
+            if pids is None:
+                return seen.keys()
+            return [pid for pid in pids if pid in seen]
+
+        match = search(tier(self.index.hot_seen))
+        if match is not None and match[1] < threshold:
+            return match
+        cold = search(tier(self.index.cold_seen))
+        if cold is not None and (match is None or cold[1] < match[1]):
+            return cold
+        return match
+
+    def update_person(self, pid, embedding, now):
+        """Add a matched embedding to the gallery of an existing person"""
+        person = self.detectedPersons[f"id_{pid}"]
+        slot = person["extractedFeatures"].append(embedding)
+        if self.samples is not None:
+            self.samples.put(pid, slot, embedding)
+        person["appearances"] += 1
+        person["last_seen"] = datetime.fromtimestamp(now).isoformat()
+        self.index.update(pid, person["extractedFeatures"].mean())
+        if self.store is not None:
+            self.store.touch(person["row"], person["extractedFeatures"], now)
+
+    def tracked_person(self, client_name, header):
+        """Person already assigned to the node tracklet of this crop, if any"""
+        if header is None or not header.track_id:
+            return None
+        pid = self.tracklets.get((client_name, header.session, header.track_id))
+        if pid is None or f"id_{pid}" not in self.detectedPersons:
+            return None
+        return pid
 
-            try:
-                h, w = frame.shape[:2]
-                detections = [([0, 0, w, h], 1.0, "person")]
+    def sample_event(self):
+        """True for one in event_log_every assignments, 0 turns the logs off"""
+        self.events += 1
+        return self.event_log_every > 0 and self.events % self.event_log_every == 0
 
-                tracks = self.tracker.update_tracks(detections, frame=frame)
+    def observe_received(self, header):
+        """Node stages carried in the header and the network hop to here"""
+        if not header.send_us:
+            return
+        camera = header.camera
+        self.metrics.observe("detect", camera, header.detect_us / 1e6)
+        self.metrics.observe(
+            "encode", camera, (header.encode_us - header.detect_us) / 1e6
+        )
+        self.metrics.observe("send", camera, (header.send_us - header.encode_us) / 1e6)
+        self.metrics.observe(
+            "network", camera, time.time() - header.timestamp - header.send_us / 1e6
+        )
 
-                embedding = None
-                for tr in tracks:
-                    if tr.features and len(tr.features) > 0:
-                        embedding = np.asarray(tr.features[-1], dtype=np.float32)
-                        break
+    def observe_assigned(self, item):
+        """Server stages of an assigned item, from its receive timestamp"""
+        now = time.monotonic()
+        camera = item["client_name"]
+        previous = item["received"]
+        for stage, mark in (
+            ("decode", item.get("decoded")),
+            ("embed", item.get("embedded")),
+        ):
+            if mark is not None:
+                self.metrics.observe(stage, camera, mark - previous)
+                previous = mark
+        self.metrics.observe("match", camera, now - previous)
+        self.metrics.observe("total", camera, time.time() - item["header"].timestamp)
+        self.latency.add(now - item["received"])
+
+    def render_metrics(self):
+        """Prometheus text of the latency histograms and the stage queues"""
+        lines = [self.metrics.render()]
+        for name, help_text, key in (
+            ("reid_queue_depth", "Items waiting in each stage", "depth"),
+            ("reid_queue_dropped_total", "Items dropped by each stage", "dropped"),
+            ("reid_processed_total", "Items processed by each stage", "processed"),
+        ):
+            kind = "gauge" if key == "depth" else "counter"
+            lines.append(f"# HELP {name} {help_text}\n# TYPE {name} {kind}\n")
+            for stage, status in self.stages.items():
+                lines.append(f'{name}{{stage="{stage}"}} {status.get_status()[key]}\n')
+        return "".join(lines)
+
+    def age_identities(self, now):
+        """Demote inactive identities to the cold tier and forget evicted ones"""
+        self.last_aging = now
+        evicted = self.index.age(now)
+        for pid in evicted:
+            if self.samples is not None:
+                self.samples.remove(pid)
+            person = self.detectedPersons.pop(f"id_{pid}", None)
+            if person is not None and self.store is not None:
+                self.store.release(person["row"])
+        if evicted:
+            self.logger.info(f"Evicted {len(evicted)} inactive identities")
+
+    def decode_frames(self):
+        """Pipeline stage that turns received JPEG crops into frames"""
+        if self.logger is None or self.cfg is None:
+            return
 
-                if embedding is None:
-                    embedding = np.mean(frame, axis=(0, 1)).astype(np.float32)
-                    embedding = embedding.flatten()
-                    self.logger.debug("Used fallback feature extraction")
+        stage = self.stages["decode"]
+        pipeline_cfg = self.cfg.get("pipeline", {})
+        batch_size = pipeline_cfg.get("decode_batch_size", 32)
+        batch_timeout = pipeline_cfg.get("decode_timeout_ms", 5) / 1000
 
-                embedding = embedding.flatten()
+        while True:
+            batch = next_batch(stage, batch_size, batch_timeout)
+            if batch is None:
+                break
 
-                if not self.detectedPersons:
-                    pid = self.add_new_person(
-                        np.expand_dims(embedding, axis=0), client_name
-                    )
-                    self.lines.append(f"{pid} {client_name} 1\n")
-                    self.logger.info(
-                        f"First person id_{pid} registered from {client_name}"
+            try:
+                if self.decode_pool is None:
+                    frames = decode_crops([item["buffer"] for item in batch])
+                else:
+                    buffers = [bytes(item["buffer"]) for item in batch]
+                    frames = self.decode_pool.submit(decode_crops, buffers).result()
+            except Exception as e:
+                self.logger.error(f"Could not decode {len(batch)} images: {e}")
+                frames = [None] * len(batch)
+            finally:
+                for item in batch:
+                    item["buffer"] = None
+                    if item["pool_buffer"] is not None:
+                        self.buffer_pool.release(item["pool_buffer"])
+
+            decoded = time.monotonic()
+            for item, frame in zip(batch, frames):
+                if frame is None:
+                    self.logger.error(
+                        f"Could not decode image from {item['client_name']}"
                     )
                     continue
+                self.stages["embed"].put(
+                    {
+                        "frame": frame,
+                        "client_name": item["client_name"],
+                        "header": item["header"],
+                        "received": item["received"],
+                        "decoded": decoded,
+                    },
+                    item["client_name"],
+                )
+            stage.done(len(batch))
+
+    def extract_features(self):
+        """Pipeline stage that runs batched DeepSORT embedding extraction"""
+        if self.logger is None or self.cfg is None:
+            return
 
-                candidates = []
-                for key, value in self.detectedPersons.items():
-                    gallery = value["extractedFeatures"]
-                    if gallery.ndim == 1:
-                        gallery_mean = gallery
-                    else:
-                        gallery_mean = np.mean(gallery, axis=0).flatten()
-                    score = distance.cosine(gallery_mean, embedding.flatten())
-                    candidates.append(
-                        {
-                            "id": value["id"],
-                            "appearances": value["appearances"],
-                            "score": float(score),
-                        }
-                    )
+        stage = self.stages["embed"]
+        reid_cfg = self.cfg.get("reid", {})
+        batch_size = reid_cfg.get("batch_size", 16)
+        batch_timeout = reid_cfg.get("batch_timeout_ms", 20) / 1000
 
-                candidates_sorted = sorted(candidates, key=lambda d: d["score"])
-                top = candidates_sorted[0]
+        while True:
+            batch = next_batch(stage, batch_size, batch_timeout)
+            if batch is None:
+                break
 
-                sim_thresh = self.cfg["reid"].get("similarity_threshold", 0.13)
-                max_gallery = self.cfg["reid"].get("max_gallery_per_person", 512)
+            frames = [item["frame"] for item in batch]
+            try:
+                if self.embed_pool is None:
+                    embeddings = extract_embeddings(self.embedder, frames)
+                else:
+                    embeddings = self.embed_pool.submit(embed_frames, frames).result()
+            except Exception as e:
+                self.logger.error(f"Exception extracting {len(batch)} embeddings: {e}")
+                continue
 
-                if top["score"] < sim_thresh:
-                    person_key = f"id_{top['id']}"
-                    current_gallery = self.detectedPersons[person_key][
-                        "extractedFeatures"
-                    ]
-                    if current_gallery.ndim == 1:
-                        current_gallery = np.expand_dims(current_gallery, axis=0)
+            embedded = time.monotonic()
+            for item, embedding in zip(batch, embeddings):
+                self.stages["assign"].put(
+                    {
+                        "embedding": embedding,
+                        "client_name": item["client_name"],
+                        "header": item["header"],
+                        "received": item["received"],
+                        "decoded": item["decoded"],
+                        "embedded": embedded,
+                    }
+                )
+            stage.done(len(batch))
 
-                    if current_gallery.shape[0] < max_gallery:
-                        new_gallery = np.vstack(
-                            (current_gallery, np.expand_dims(embedding, axis=0))
-                        )
-                    else:
-                        new_gallery = np.vstack(
-                            (np.expand_dims(embedding, axis=0), current_gallery[1:])
-                        )
+    def reId(self):
+        """
+        Pipeline stage that assigns ids, kept on a single thread so the
+        gallery is only ever touched from one place
+        """
 
-                    self.detectedPersons[person_key] = {
-                        "extractedFeatures": new_gallery,
-                        "id": top["id"],
-                        "appearances": top["appearances"] + 1,
-                        "first_seen": self.detectedPersons[person_key]["first_seen"],
-                        "last_seen": datetime.now().isoformat(),
-                    }
-                    self.lines.append(
-                        f"{top['id']} {client_name} {top['appearances'] + 1}\n"
-                    )
-                    self.logger.info(
-                        f"Matched existing person id_{top['id']} (score={top['score']:.4f}) from {client_name}"
-                    )
-                else:
-                    pid = self.add_new_person(
-                        np.expand_dims(embedding, axis=0), client_name
-                    )
-                    self.lines.append(f"{pid} {client_name} 1\n")
-                    self.logger.info(
-                        f"New person id_{pid} created (best match score={top['score']:.4f}) from {client_name}"
-                    )
+        if self.logger is None or self.cfg is None:
+            return
+
+        stage = self.stages["assign"]
+        while True:
+            item = stage.get()
+            if item is None:
+                break
 
+            client_name = item["client_name"]
+            try:
+                self.assign_identity(item["embedding"], client_name, item["header"])
+                self.observe_assigned(item)
             except Exception as e:
                 self.logger.error(f"Exception processing frame from {client_name}: {e}")
+            stage.done()
 
-    def handle_client(self):
+    def handle_client(self, receiver=0):
         """Thread that receives frames while command == 'start'"""
         if self.logger is None or self.cfg is None:
             return
@@ -300,51 +779,81 @@ class PersonReidentificationServer:
         buffer_timeout = self.cfg["server"].get("socket_timeout", 2)
 
         with self.server_lock:
-            if self.server is None:
-                self.logger.error("Server socket is None in handle_client")
+            if receiver >= len(self.receivers):
+                self.logger.error(f"Receiver socket {receiver} is missing")
                 return
-            self.server.settimeout(buffer_timeout)
+            sock = self.receivers[receiver]
+            sock.settimeout(buffer_timeout)
+        reassembler = self.reassemblers[receiver]
+        pool = self.buffer_pool
 
-        self.logger.info("Client handler thread started")
+        self.logger.info(f"Client handler thread {receiver} started")
         consecutive_errors = 0
         max_consecutive_errors = 10
+        last_expire = time.time()
 
         while self.command == "start" and self.running:
             try:
-                data, _ = self.server.recvfrom(65535)
-
-                if len(data) < 36:
-                    self.logger.warning("Received invalid size header")
-                    continue
+                now = time.time()
+                if now - last_expire > reassembler.timeout / 2:
+                    reassembler.expire(now)
+                    last_expire = now
 
+                buf = pool.acquire()
                 try:
-                    client_name = data[:32].decode("utf-8").rstrip("\0")
-                    size = int(data[32:36].decode("utf-8"))
-                except Exception as e:
-                    self.logger.error(f"Could not decode the header with error: {e}")
+                    size = sock.recv_into(buf)
+                except BaseException:
+                    pool.release(buf)
+                    raise
+
+                view = memoryview(buf)[:size]
+                header = parse_header(view)
+                if header is None or HEADER_SIZE + header.payload_size > size:
+                    self.logger.warning("Received packet with invalid header")
+                    pool.release(buf)
                     continue
 
-                buffer = data[36 : 36 + size]
-                if not buffer:
+                payload = view[HEADER_SIZE : HEADER_SIZE + header.payload_size]
+                crop = reassembler.add(header, payload)
+                consecutive_errors = 0
+                if header.chunk_count > 1:
+                    # Chunks are copied by the reassembler, the slot is free again
+                    pool.release(buf)
+                    buf = None
+                if crop is None:
                     continue
 
-                try:
-                    frame = cv2.imdecode(
-                        np.frombuffer(buffer, dtype=np.uint8), cv2.IMREAD_COLOR
+                header, buffer = crop
+                received = time.monotonic()
+                self.observe_received(header)
+                if header.msg_type == MSG_EMBEDDING:
+                    # Edge-First nodes already extracted the features
+                    self.stages["assign"].put(
+                        {
+                            "embedding": decode_embedding(buffer),
+                            "client_name": header.camera,
+                            "header": header,
+                            "received": received,
+                        }
                     )
-                except Exception as e:
-                    self.logger.error(f"Could not decode the image with error: {e}")
-                    continue
-
-                if frame is None:
-                    self.logger.error(f"Could not decode image from {client_name}")
+                    if buf is not None:
+                        pool.release(buf)
                     continue
 
-                consecutive_errors = 0
-
-                self.queue.put({"frame": frame, "client_name": client_name})
+                self.stages["decode"].put(
+                    {
+                        "buffer": buffer,
+                        "pool_buffer": buf,
+                        "client_name": header.camera,
+                        "header": header,
+                        "received": received,
+                    },
+                    header.camera,
+                )
 
             except socket.timeout:
+                reassembler.expire()
+                last_expire = time.time()
                 continue
             except socket.error as e:
                 if e.errno == errno.EAGAIN or e.errno == errno.EWOULDBLOCK:
@@ -377,7 +886,7 @@ class PersonReidentificationServer:
                     break
                 time.sleep(0.5)
 
-        self.logger.info("Client handler thread stopped")
+        self.logger.info(f"Client handler thread {receiver} stopped")
 
     def cleanup_threads(self):
         """Clean up finished threads"""
@@ -426,23 +935,52 @@ class PersonReidentificationServer:
 
         self.cleanup_threads()
 
-        t = threading.Thread(target=self.handle_client)
-        t.daemon = True
-        self.threads.append(t)
-        t.start()
-        r = threading.Thread(target=self.reId, args=())
-        r.daemon = True
-        self.threads.append(r)
-        r.start()
+        pipeline_cfg = self.cfg.get("pipeline", {}) if self.cfg else {}
+        if pipeline_cfg.get("executor", "thread") == "process":
+            context = multiprocessing.get_context("spawn")
+            self.decode_pool = ProcessPoolExecutor(
+                max_workers=self.stages["decode"].workers, mp_context=context
+            )
+            self.embed_pool = ProcessPoolExecutor(
+                max_workers=self.stages["embed"].workers,
+                mp_context=context,
+                initializer=init_embed_worker,
+                initargs=(self.cfg.get("reid", {}),),
+            )
+            self.logger.info("Decode and embed stages running in process pools")
+
+        for receiver in range(len(self.receivers)):
+            t = threading.Thread(target=self.handle_client, args=(receiver,))
+            t.daemon = True
+            self.threads.append(t)
+            t.start()
+
+        targets = {
+            "decode": self.decode_frames,
+            "embed": self.extract_features,
+            "assign": self.reId,
+        }
+        for name, stage in self.stages.items():
+            for _ in range(stage.workers):
+                w = threading.Thread(target=targets[name])
+                w.daemon = True
+                stage.threads.append(w)
+                self.threads.append(w)
+                w.start()
 
-        self.logger.info("Processing started - handler thread launched")
+        self.start_controller()
+
+        self.logger.info(
+            "Processing started - "
+            + ", ".join(f"{s.workers} {n}" for n, s in self.stages.items())
+            + " workers launched"
+        )
 
     def stop_processing(self):
         """Stop the processing loop and clean up"""
         if self.logger is None:
             return
 
-        self.queue.put(None)
         self.command = "exit"
         self.running = False
 
@@ -450,6 +988,17 @@ class PersonReidentificationServer:
 
         self.logger.info(f"Waiting for {len(self.threads)} threads to finish...")
 
+        # Stages are drained in order so nothing is left behind in between
+        for name, stage in self.stages.items():
+            if stage.stop(timeout=2.0):
+                self.logger.warning(f"Stage {name} did not finish in time")
+
+        for pool in (self.decode_pool, self.embed_pool):
+            if pool is not None:
+                pool.shutdown(wait=True, cancel_futures=True)
+        self.decode_pool = None
+        self.embed_pool = None
+
         for i, t in enumerate(self.threads):
             try:
                 t.join(timeout=2.0)
@@ -461,22 +1010,39 @@ class PersonReidentificationServer:
         self.threads.clear()
 
         with self.server_lock:
-            if self.server:
+            for sock in self.receivers:
                 try:
-                    self.server.close()
-                    self.server = None
-                    self.logger.info("Server socket closed")
+                    sock.close()
                 except Exception as e:
                     self.logger.error(f"Error closing server socket: {e}")
+            if self.receivers:
+                self.logger.info(f"{len(self.receivers)} server sockets closed")
+            self.receivers = []
+            self.server = None
 
-        try:
-            with open("example.txt", "w") as f:
-                f.writelines(self.lines)
-            self.logger.info(
-                f"Results written to example.txt with {len(self.lines)} entries"
-            )
-        except Exception as e:
-            self.logger.error(f"Error writing results to file: {e}")
+        self.write_results()
+
+    def write_results(self):
+        """Make the streamed results durable and snapshot the gallery"""
+        if self.logger is None:
+            return
+
+        if self.results is not None:
+            if self.results.sync():
+                status = self.results.get_status()
+                self.logger.info(
+                    f"{status['written']} results synced to {status['directory']} "
+                    f"({status['dropped']} dropped)"
+                )
+            else:
+                self.logger.error("Timed out syncing the results writer")
+
+        if self.store is not None:
+            try:
+                self.store.snapshot(self.detectedPersons, self.id_counter)
+                self.logger.info(f"Gallery snapshot saved to {self.store.path}")
+            except Exception as e:
+                self.logger.error(f"Error saving gallery snapshot: {e}")
 
     def get_status(self):
         """Get current server status"""
@@ -484,12 +1050,103 @@ class PersonReidentificationServer:
         return {
             "command": self.command,
             "detected_persons": len(self.detectedPersons),
+            "index": (
+                self.index.get_status()
+                if isinstance(self.index, TieredIndex)
+                else {"hot": len(self.index), "cold": 0}
+            ),
+            "samples": self.samples.get_status() if self.samples is not None else {},
             "active_threads": len([t for t in self.threads if t.is_alive()]),
-            "total_reid_events": len(self.lines),
+            "total_reid_events": (
+                self.results.written if self.results is not None else 0
+            ),
             "clients_configured": len(self.clients) if self.clients is not None else [],
             "id_counter": self.id_counter,
+            "stages": {n: s.get_status() for n, s in self.stages.items()},
+            "transport": merge_status(self.reassemblers),
+            "latency": self.latency.get_status(),
+            "stage_latency": self.metrics.get_status(),
+            "buffer_pool": (
+                self.buffer_pool.get_status() if self.buffer_pool is not None else {}
+            ),
+            "nodes": self.control.get_status() if self.control is not None else {},
+            "controller": (
+                self.controller.get_status() if self.controller is not None else {}
+            ),
         }
 
+    def format_status(self):
+        """Human readable server status"""
+        status = self.get_status()
+        lines = []
+        lines.append("\n=== Server Status ===")
+        lines.append(f"Command State: {status['command']}")
+        lines.append(f"Detected Persons: {status['detected_persons']}")
+        lines.append(
+            f"Search Tiers: {status['index']['hot']} hot, {status['index']['cold']} cold"
+        )
+        if status["samples"]:
+            samples = status["samples"]
+            lines.append(
+                f"Sample Index: {samples['samples']} samples of "
+                f"{samples['identities']} persons ({samples['backend']})"
+            )
+        lines.append(f"Active Threads: {status['active_threads']}")
+        lines.append(f"ReID Events: {status['total_reid_events']}")
+        for name, stage in status["stages"].items():
+            lines.append(
+                f"Stage {name}: depth={stage['depth']}/{stage['maxsize'] or 'inf'} "
+                f"max={stage['max_depth']} processed={stage['processed']} "
+                f"workers={stage['workers']} dropped={stage['dropped']} "
+                f"({stage['policy']})"
+            )
+            for camera, dropped in stage["dropped_by_key"].items():
+                lines.append(f"  {camera}: {dropped} dropped")
+        latency = status["latency"]
+        lines.append(
+            f"Receive-to-Assign Latency: p50={latency['p50_ms']:.1f}ms "
+            f"p95={latency['p95_ms']:.1f}ms p99={latency['p99_ms']:.1f}ms"
+        )
+        lines.append(f"Pending Chunked Crops: {status['transport']['pending']}")
+        pool = status["buffer_pool"]
+        lines.append(
+            f"Receive Buffers: {pool.get('free', 0)}/{pool.get('count', 0)} "
+            f"free, {pool.get('misses', 0)} misses"
+        )
+        for camera, stats in status["transport"]["cameras"].items():
+            lines.append(
+                f"Camera {camera}: received={stats['completed']} "
+                f"lost={stats['lost']} expired={stats['expired']} "
+                f"latency avg={stats['latency_avg'] * 1000:.1f}ms "
+                f"max={stats['latency_max'] * 1000:.1f}ms"
+            )
+        for camera, stages in status["stage_latency"].items():
+            lines.append(f"Stage Latency {camera} (p50/p95/p99 ms):")
+            for stage, stats in stages.items():
+                lines.append(
+                    f"  {stage:<8} {stats['p50_ms']:7.1f} {stats['p95_ms']:7.1f} "
+                    f"{stats['p99_ms']:7.1f}  n={stats['count']} "
+                    f"({stats['rate']:.1f}/s)"
+                )
+        levels = status["controller"].get("levels", {})
+        for camera, node in status["nodes"].items():
+            if not node["alive"]:
+                lines.append(f"Node {camera}: no heartbeat")
+                continue
+            stats = node["stats"]
+            lines.append(
+                f"Node {camera}: heartbeat {node['age']:.1f}s ago "
+                f"grabbed={stats.get('grabbed', 0):.0f} "
+                f"sent={stats.get('sent', 0):.0f} queue={stats.get('queue', 0):.0f} "
+                f"dropped={stats.get('dropped', 0):.0f} "
+                f"latency={stats.get('latency_ms', 0):.1f}ms "
+                f"throttle={levels.get(camera, 0)} {node['settings'] or ''}"
+            )
+        lines.append(f"Clients Configured: {status['clients_configured']}")
+        lines.append(f"Next ID: {status['id_counter']}")
+        lines.append("====================\n")
+        return "\n".join(lines)
+
     def run(self):
         """Main server loop"""
         if not self.initialize():
@@ -522,16 +1179,7 @@ class PersonReidentificationServer:
                     break
 
                 elif cmd == "status":
-                    status = self.get_status()
-                    print("\n=== Server Status ===")
-                    print(f"Command State: {status['command']}")
-                    print(f"Detected Persons: {status['detected_persons']}")
-                    print(f"Active Threads: {status['active_threads']}")
-                    print(f"ReID Events: {status['total_reid_events']}")
-                    print(f"ReID Queue: {self.queue.qsize()}")
-                    print(f"Clients Configured: {status['clients_configured']}")
-                    print(f"Next ID: {status['id_counter']}")
-                    print("====================\n")
+                    print(self.format_status())
 
                 elif cmd == "cleanup":
                     self.cleanup_threads()
@@ -550,9 +1198,35 @@ class PersonReidentificationServer:
             self.logger.error(f"Unexpected error in main loop: {e}")
             self.stop_processing()
 
+        if self.results is not None:
+            self.results.close()
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+        if self.control is not None:
+            self.control.stop()
         self.logger.info("Server stopped")
 
 
 if __name__ == "__main__":
-    server = PersonReidentificationServer("config.yaml")
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-r",
+        "--runtime",
+        choices=["threads", "asyncio"],
+        default=None,
+        help="runtime do servidor (padrão: server.runtime do config.yaml)",
+    )
+    args = parser.parse_args()
+
+    runtime = args.runtime
+    if runtime is None:
+        with open("config.yaml", "r") as f:
+            runtime = yaml.safe_load(f)["server"].get("runtime", "threads")
+
+    if runtime == "asyncio":
+        from async_server import AsyncPersonReidentificationServer
+
+        server = AsyncPersonReidentificationServer("config.yaml")
+    else:
+        server = PersonReidentificationServer("config.yaml")
     server.run()
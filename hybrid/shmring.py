@@ -0,0 +1,133 @@
+import struct
+import numpy as np
+from multiprocessing import shared_memory
+
+# write offset, read offset, producer progress, dropped messages, sequence
+HEADER_SIZE = 40
+LENGTH = struct.Struct("<I")
+# Length of the marker telling the reader the next message starts at offset 0
+WRAP = 0xFFFFFFFF
+
+
+class ShmRing:
+    """
+    Single-producer, single-consumer ring of byte messages in shared memory.
+
+    Offsets are monotonic byte counters kept in the segment header, each
+    written by one side only. A message is a 4-byte length followed by its
+    bytes and is never split: when it does not fit before the end of the
+    buffer the writer leaves a WRAP marker and starts over at offset 0.
+    A full ring drops the incoming message, so a slow reader never blocks
+    the camera.
+
+    The semaphore counts the readable messages. The offsets are only read
+    and published under a shared lock, whose acquire/release orders them:
+    the write offset moves past a message once its payload is in place and
+    the read offset once the consumer has copied it out.
+    """
+
+    def __init__(self, memory, capacity, items, lock):
+        self.memory = memory
+        self.capacity = capacity
+        self.items = items
+        self.lock = lock
+        self.header = np.ndarray(5, dtype=np.uint64, buffer=memory.buf)
+        self.data = memory.buf[HEADER_SIZE : HEADER_SIZE + capacity]
+
+    @classmethod
+    def create(cls, capacity, context):
+        memory = shared_memory.SharedMemory(create=True, size=HEADER_SIZE + capacity)
+        memory.buf[:HEADER_SIZE] = bytes(HEADER_SIZE)
+        return cls(memory, capacity, context.Semaphore(0), context.Lock())
+
+    @classmethod
+    def attach(cls, name, capacity, items, lock):
+        return cls(shared_memory.SharedMemory(name=name), capacity, items, lock)
+
+    def handle(self):
+        """Arguments of attach() for a child process"""
+        return self.memory.name, self.capacity, self.items, self.lock
+
+    @property
+    def progress(self):
+        """Value the producer publishes with its messages, e.g. a frame index"""
+        return int(self.header[2])
+
+    @property
+    def sequence(self):
+        """Next message number of the producer, e.g. a crop counter"""
+        return int(self.header[4])
+
+    @property
+    def dropped(self):
+        return int(self.header[3])
+
+    def __len__(self):
+        with self.lock:
+            return int(self.header[0] - self.header[1])
+
+    def write(self, parts, progress=None, sequence=None):
+        """Append the concatenation of parts as one message, False when full"""
+        if sequence is not None:
+            # Published even when the message is dropped, its number is used
+            self.header[4] = sequence
+        size = LENGTH.size + sum(len(part) for part in parts)
+        with self.lock:
+            written, read = int(self.header[0]), int(self.header[1])
+        pos = written % self.capacity
+        skip = self.capacity - pos if pos + size > self.capacity else 0
+        if skip + size > self.capacity - (written - read):
+            self.header[3] += 1
+            return False
+
+        if skip:
+            if skip >= LENGTH.size:
+                LENGTH.pack_into(self.data, pos, WRAP)
+            pos = 0
+        LENGTH.pack_into(self.data, pos, size - LENGTH.size)
+        pos += LENGTH.size
+        for part in parts:
+            self.data[pos : pos + len(part)] = part
+            pos += len(part)
+
+        # Published only now that the whole message is in the buffer
+        with self.lock:
+            if progress is not None:
+                self.header[2] = progress
+            self.header[0] = written + skip + size
+        self.items.release()
+        return True
+
+    def read(self, timeout=None):
+        """Copy of the oldest message, None when nothing arrives in time"""
+        if not self.items.acquire(timeout=timeout):
+            return None
+        with self.lock:
+            written, read = int(self.header[0]), int(self.header[1])
+        if read >= written:
+            raise RuntimeError("ShmRing signalled a message it has not published")
+        pos = read % self.capacity
+        if self.capacity - pos < LENGTH.size:
+            read += self.capacity - pos
+            pos = 0
+        else:
+            (length,) = LENGTH.unpack_from(self.data, pos)
+            if length == WRAP:
+                read += self.capacity - pos
+                pos = 0
+        (length,) = LENGTH.unpack_from(self.data, pos)
+        start = pos + LENGTH.size
+        message = bytes(self.data[start : start + length])
+        # Released only after the copy, the writer may reuse the space next
+        with self.lock:
+            self.header[1] = read + LENGTH.size + length
+        return message
+
+    def close(self):
+        # Views must go before the mapping can be closed
+        self.data.release()
+        self.header = None
+        self.memory.close()
+
+    def unlink(self):
+        self.memory.unlink()
@@ -0,0 +1,287 @@
+import json
+import os
+import time
+from datetime import datetime
+import numpy as np
+from numpy.lib.format import open_memmap
+from gallery import IdentityIndex, EmbeddingGallery
+
+META_FILE = "meta.json"
+
+IDENTITY_DTYPE = np.dtype(
+    [
+        ("id", "<i8"),
+        ("appearances", "<i8"),
+        ("first_seen", "<f8"),
+        ("last_seen", "<f8"),
+        ("count", "<i4"),
+        ("head", "<i4"),
+    ]
+)
+
+
+class GalleryStore:
+    """
+    Identity gallery persisted as memory-mapped .npy files.
+
+    - identities_<capacity>.npy: metadata table, one row per identity
+    - centroids_<capacity>.npy / index_ids_<capacity>.npy: IdentityIndex buffers
+    - samples_<block>.npy / totals_<block>.npy: ring buffers of block_size
+      identities each, so growing never copies embeddings
+    - meta.json: sizes and current file names, rewritten atomically
+
+    Galleries are views into the mapped files, so appends go straight to
+    the page cache and snapshot() only has to flush them and record the
+    metadata of the identities touched since the last one.
+    """
+
+    def __init__(self, path, max_gallery=512, block_size=256, snapshot_interval=5.0):
+        self.path = path
+        self.snapshot_interval = snapshot_interval
+        self.last_snapshot = time.monotonic()
+        self.dirty = set()
+        self.free = []
+        self.identities = None
+        self.blocks = []
+        self.index = None
+        self.retired = None
+        self.meta = {
+            "version": 1,
+            "dim": None,
+            "max_gallery": max_gallery,
+            "block_size": block_size,
+            "size": 0,
+            "id_counter": 0,
+            "identities_file": None,
+            "index_files": None,
+            "index_size": 0,
+            "blocks": 0,
+        }
+        os.makedirs(path, exist_ok=True)
+        if os.path.exists(self._file(META_FILE)):
+            with open(self._file(META_FILE), "r") as f:
+                self.meta.update(json.load(f))
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _map(self, name, dtype, shape, fill=None):
+        """Open a mapped .npy file, creating it with the given shape if needed"""
+        path = self._file(name)
+        if os.path.exists(path):
+            return open_memmap(path, mode="r+")
+        array = open_memmap(path, mode="w+", dtype=dtype, shape=shape)
+        if fill is not None:
+            array[:] = fill
+        return array
+
+    @property
+    def dim(self):
+        return self.meta["dim"]
+
+    @property
+    def size(self):
+        return self.meta["size"]
+
+    def allocate_index(self, capacity, dim):
+        """IdentityIndex allocator backed by mapped files"""
+        old = self.meta["index_files"]
+        names = (f"centroids_{capacity}.npy", f"index_ids_{capacity}.npy")
+        centroids = self._map(names[0], np.float32, (capacity, dim), fill=0)
+        ids = self._map(names[1], np.int64, (capacity,), fill=-1)
+        self.meta["index_files"] = names
+        if old and tuple(old) != names:
+            # The index copies the live rows right after this returns
+            self.retired = old
+        return centroids, ids
+
+    def _ensure_identities(self, rows):
+        capacity = 0 if self.identities is None else self.identities.shape[0]
+        if rows <= capacity:
+            return
+        new_capacity = max(self.meta["block_size"], capacity * 2)
+        while new_capacity < rows:
+            new_capacity *= 2
+        name = f"identities_{new_capacity}.npy"
+        identities = self._map(name, IDENTITY_DTYPE, (new_capacity,))
+        old = self.meta["identities_file"] if self.identities is not None else None
+        if old is not None:
+            identities[:capacity] = self.identities
+            identities.flush()
+        self.identities = identities
+        self.meta["identities_file"] = name
+        if old is not None:
+            # Rows are now written to the new table, so meta.json has to name
+            # it before the old one goes away
+            self._write_meta()
+            os.remove(self._file(old))
+
+    def _block(self, number):
+        while len(self.blocks) <= number:
+            block = len(self.blocks)
+            size = self.meta["block_size"]
+            samples = self._map(
+                f"samples_{block}.npy",
+                np.float32,
+                (size, self.meta["max_gallery"], self.dim),
+            )
+            totals = self._map(f"totals_{block}.npy", np.float64, (size, self.dim))
+            self.blocks.append((samples, totals))
+        self.meta["blocks"] = max(self.meta["blocks"], len(self.blocks))
+        return self.blocks[number]
+
+    def _gallery(self, row):
+        samples, totals = self._block(row // self.meta["block_size"])
+        slot = row % self.meta["block_size"]
+        record = self.identities[row]
+        return EmbeddingGallery(
+            self.dim,
+            self.meta["max_gallery"],
+            samples=samples[slot],
+            total=totals[slot],
+            count=int(record["count"]),
+            head=int(record["head"]),
+        )
+
+    def open(self):
+        """
+        Map the stored files and return (index, persons, id_counter).
+        Nothing is parsed: galleries and the index are views into the maps.
+        """
+        persons = {}
+        if self.dim is None or self.meta["identities_file"] is None:
+            self.index = IdentityIndex(allocator=self.allocate_index)
+            return self.index, persons, self.meta["id_counter"]
+
+        self.identities = open_memmap(
+            self._file(self.meta["identities_file"]), mode="r+"
+        )
+        for block in range(self.meta["blocks"]):
+            self._block(block)
+
+        for row in range(self.size):
+            record = self.identities[row]
+            pid = int(record["id"])
+            if pid < 0:
+                self.free.append(row)
+                continue
+            persons[f"id_{pid}"] = {
+                "extractedFeatures": self._gallery(row),
+                "id": pid,
+                "row": row,
+                "appearances": int(record["appearances"]),
+                "first_seen": time_to_iso(record["first_seen"]),
+                "last_seen": time_to_iso(record["last_seen"]),
+            }
+
+        centroids_file, ids_file = self.meta["index_files"]
+        self.index = IdentityIndex.attach(
+            open_memmap(self._file(centroids_file), mode="r+"),
+            open_memmap(self._file(ids_file), mode="r+"),
+            self.meta["index_size"],
+            allocator=self.allocate_index,
+        )
+        return self.index, persons, self.meta["id_counter"]
+
+    def new_gallery(self, pid, dim, now):
+        """
+        Reserve a row for a new identity seen at now and return its mapped
+        gallery. The record carries its real timestamps from the start, so
+        aging after a restart does not take it for the oldest identity.
+        """
+        if self.dim is None:
+            self.meta["dim"] = dim
+        if self.free:
+            row = self.free.pop()
+        else:
+            row = self.size
+            self._ensure_identities(row + 1)
+            self.meta["size"] = row + 1
+        self.identities[row] = (pid, 1, now, now, 0, 0)
+        self.dirty.add(row)
+        gallery = self._gallery(row)
+        # A reused row still holds the running sum of its previous owner
+        gallery.total[:] = 0
+        return row, gallery
+
+    def release(self, row):
+        """Free the row of an evicted identity for reuse"""
+        self.identities[row]["id"] = -1
+        self.dirty.discard(row)
+        self.free.append(row)
+
+    def touch(self, row, gallery=None, now=None):
+        """
+        Mark the row for the next snapshot. The ring position of the gallery
+        and the time the identity was seen are written right away, so they
+        match the mapped totals after a crash.
+        """
+        self.dirty.add(row)
+        record = self.identities[row]
+        if gallery is not None:
+            record["count"] = gallery.count
+            record["head"] = gallery.head
+        if now is not None:
+            record["last_seen"] = now
+
+    def _write_meta(self):
+        tmp = self._file(META_FILE + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump(self.meta, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._file(META_FILE))
+
+    def maybe_snapshot(self, persons, id_counter):
+        if time.monotonic() - self.last_snapshot >= self.snapshot_interval:
+            self.snapshot(persons, id_counter)
+
+    def snapshot(self, persons, id_counter):
+        """Flush the maps and persist the metadata of dirty identities"""
+        if self.identities is not None:
+            for row in self.dirty:
+                pid = int(self.identities[row]["id"])
+                person = persons.get(f"id_{pid}")
+                if person is None:
+                    continue
+                gallery = person["extractedFeatures"]
+                self.identities[row] = (
+                    pid,
+                    person["appearances"],
+                    iso_to_time(person["first_seen"]),
+                    iso_to_time(person["last_seen"]),
+                    gallery.count,
+                    gallery.head,
+                )
+            self.identities.flush()
+        self.dirty.clear()
+
+        for samples, totals in self.blocks:
+            samples.flush()
+            totals.flush()
+        if self.index is not None and self.index.centroids is not None:
+            if hasattr(self.index.centroids, "flush"):
+                self.index.centroids.flush()
+                self.index.ids.flush()
+            self.meta["index_size"] = self.index.size
+
+        self.meta["id_counter"] = id_counter
+        self._write_meta()
+
+        if self.retired:
+            for name in self.retired:
+                if name not in self.meta["index_files"]:
+                    try:
+                        os.remove(self._file(name))
+                    except FileNotFoundError:
+                        pass
+            self.retired = None
+        self.last_snapshot = time.monotonic()
+
+
+def time_to_iso(timestamp):
+    return datetime.fromtimestamp(float(timestamp)).isoformat()
+
+
+def iso_to_time(value):
+    return datetime.fromisoformat(value).timestamp()
@@ -0,0 +1,45 @@
+import multiprocessing
+import struct
+from shmring import ShmRing
+
+MESSAGES = 20000
+# Odd capacity, so messages and WRAP markers land at every offset
+CAPACITY = 10007
+
+
+def payload(i):
+    """Message i: its number followed by 1 to 3000 bytes derived from it"""
+    size = 1 + (i * 7919) % 3000
+    pattern = bytes((i + j) & 0xFF for j in range(256))
+    return struct.pack("<I", i) + (pattern * (size // 256 + 1))[:size]
+
+
+def produce(handle, count):
+    ring = ShmRing.attach(*handle)
+    for i in range(count):
+        message = payload(i)
+        # Split in parts as PacketRing does, retried while the ring is full
+        while not ring.write([message[:3], message[3:]], progress=i):
+            pass
+    ring.close()
+
+
+def test_messages_cross_processes_in_order():
+    context = multiprocessing.get_context("spawn")
+    ring = ShmRing.create(CAPACITY, context)
+    producer = context.Process(target=produce, args=(ring.handle(), MESSAGES))
+    producer.start()
+    try:
+        for i in range(MESSAGES):
+            message = ring.read(timeout=30)
+            assert message is not None, f"timed out waiting for message {i}"
+            (number,) = struct.unpack_from("<I", message)
+            assert number == i, f"expected message {i}, got {number}"
+            assert message == payload(i), f"message {i} corrupted"
+        assert ring.read(timeout=0.1) is None
+        assert len(ring) == 0
+    finally:
+        producer.join(timeout=30)
+        ring.close()
+        ring.unlink()
+    assert producer.exitcode == 0
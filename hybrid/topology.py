@@ -0,0 +1,47 @@
+from collections import OrderedDict
+
+
+class CameraTopology:
+    """
+    Graph of cameras with the identities recently active in each one.
+
+    A camera only searches the identities seen by itself or by one of its
+    neighbors within the transit window.
+    """
+
+    def __init__(self, adjacency=None, transit_window=30.0):
+        self.transit_window = transit_window
+        self.neighbors = {}
+        self.recent = {}
+        for camera, neighbors in (adjacency or {}).items():
+            for neighbor in neighbors or []:
+                self.neighbors.setdefault(camera, {camera}).add(neighbor)
+                self.neighbors.setdefault(neighbor, {neighbor}).add(camera)
+
+    def get_neighbors(self, camera):
+        """Camera itself plus its adjacent cameras"""
+        return self.neighbors.get(camera, {camera})
+
+    def _expire(self, camera, now):
+        recent = self.recent.get(camera)
+        if recent is None:
+            return {}
+        while recent:
+            pid, last_seen = next(iter(recent.items()))
+            if now - last_seen <= self.transit_window:
+                break
+            recent.popitem(last=False)
+        return recent
+
+    def mark(self, camera, pid, now):
+        """Register that pid was seen at camera"""
+        recent = self.recent.setdefault(camera, OrderedDict())
+        recent[pid] = now
+        recent.move_to_end(pid)
+
+    def candidates(self, camera, now):
+        """Identities active at camera or its neighbors inside the window"""
+        pids = set()
+        for neighbor in self.get_neighbors(camera):
+            pids.update(self._expire(neighbor, now))
+        return pids
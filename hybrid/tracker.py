@@ -0,0 +1,179 @@
+import cv2
+import numpy as np
+
+# Geometry the sharpness is measured at, so crops of any size compare
+SHARPNESS_SIZE = (64, 128)
+
+
+def iou_matrix(a, b):
+    """Pairwise IoU between two arrays of (x1, y1, x2, y2) boxes"""
+    x1 = np.maximum(a[:, None, 0], b[None, :, 0])
+    y1 = np.maximum(a[:, None, 1], b[None, :, 1])
+    x2 = np.minimum(a[:, None, 2], b[None, :, 2])
+    y2 = np.minimum(a[:, None, 3], b[None, :, 3])
+    inter = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    return inter / np.maximum(area_a[:, None] + area_b[None, :] - inter, 1e-9)
+
+
+def crop_quality(crop, confidence, sharpness_ref=100.0):
+    """
+    Score of a crop for re-identification: detector confidence times the
+    crop side (bigger crops carry more detail) times a saturating
+    sharpness term from the variance of the Laplacian
+    """
+    if crop.size == 0:
+        return 0.0
+    h, w = crop.shape[:2]
+    gray = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY) if crop.ndim == 3 else crop
+    gray = cv2.resize(gray, SHARPNESS_SIZE, interpolation=cv2.INTER_AREA)
+    sharpness = cv2.Laplacian(gray, cv2.CV_32F).var()
+    return float(confidence * np.sqrt(h * w) * sharpness / (sharpness + sharpness_ref))
+
+
+class Tracklet:
+    def __init__(self, track_id, box, timestamp):
+        self.track_id = track_id
+        self.box = np.asarray(box, dtype=np.float32)
+        self.velocity = np.zeros(4, dtype=np.float32)
+        self.last_seen = timestamp
+        self.hits = 1
+        self.sends = 0
+        self.last_sent = None
+        self.best_sent = 0.0
+        # Best crop seen since the last send: (quality, crop, box, frame)
+        self.pending = None
+
+    def predict(self, timestamp):
+        """Box expected at timestamp under constant velocity"""
+        return self.box + self.velocity * (timestamp - self.last_seen)
+
+    def update(self, box, timestamp, smoothing):
+        box = np.asarray(box, dtype=np.float32)
+        dt = timestamp - self.last_seen
+        if dt > 0:
+            velocity = (box - self.box) / dt
+            self.velocity = smoothing * self.velocity + (1 - smoothing) * velocity
+        self.box = box
+        self.last_seen = timestamp
+        self.hits += 1
+
+    def offer(self, quality, crop, box, frame):
+        if self.pending is None or quality > self.pending[0]:
+            self.pending = (quality, crop.copy(), box, frame)
+
+
+class CropSelector:
+    """
+    IoU tracker that groups the detections of a camera into tracklets and
+    decides which crops are worth sending.
+
+    Detections are matched greedily to the box each tracklet is expected
+    at, predicted with a smoothed constant velocity. A tracklet sends the
+    best crop of its first min_hits frames, then again when a crop beats
+    the best one sent by improve, and otherwise refreshes with the best
+    crop seen every refresh_interval seconds. max_sends caps the crops of
+    a tracklet, 0 means no cap. A tracklet that ends before min_hits still
+    sends its best crop if it lasted flush_hits frames, so one-frame false
+    positives stay filtered.
+    """
+
+    def __init__(
+        self,
+        iou=0.3,
+        max_age=1.0,
+        min_hits=2,
+        refresh_interval=5.0,
+        improve=0.25,
+        max_sends=0,
+        smoothing=0.5,
+        flush_hits=2,
+    ):
+        self.iou = iou
+        self.max_age = max_age
+        self.min_hits = min_hits
+        self.refresh_interval = refresh_interval
+        self.improve = improve
+        self.max_sends = max_sends
+        self.smoothing = smoothing
+        self.flush_hits = flush_hits
+        self.tracklets = {}
+        self.next_id = 1
+        self.detections = 0
+        self.selected = 0
+
+    def update(self, boxes, timestamp):
+        """Assign every box of a frame to a tracklet, returns the tracklets"""
+        boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        self.detections += len(boxes)
+        tracklets = list(self.tracklets.values())
+        assigned = [None] * len(boxes)
+        if tracklets and len(boxes):
+            predicted = np.stack([t.predict(timestamp) for t in tracklets])
+            overlap = iou_matrix(predicted, boxes)
+            for flat in np.argsort(overlap, axis=None)[::-1]:
+                t, b = divmod(int(flat), len(boxes))
+                if overlap[t, b] < self.iou:
+                    break
+                if assigned[b] is not None or tracklets[t] is None:
+                    continue
+                tracklets[t].update(boxes[b], timestamp, self.smoothing)
+                assigned[b] = tracklets[t]
+                tracklets[t] = None
+
+        for b, box in enumerate(boxes):
+            if assigned[b] is None:
+                tracklet = Tracklet(self.next_id, box, timestamp)
+                self.next_id = (self.next_id % 0xFFFFFFFF) + 1
+                self.tracklets[tracklet.track_id] = assigned[b] = tracklet
+        return assigned
+
+    def _ready(self, tracklet, timestamp):
+        if tracklet.pending is None or tracklet.hits < self.min_hits:
+            return False
+        if self.max_sends and tracklet.sends >= self.max_sends:
+            return False
+        if tracklet.sends == 0:
+            return True
+        if tracklet.pending[0] > tracklet.best_sent * (1 + self.improve):
+            return True
+        return timestamp - tracklet.last_sent >= self.refresh_interval
+
+    def _take(self, tracklet, timestamp):
+        quality, crop, box, frame = tracklet.pending
+        tracklet.pending = None
+        tracklet.sends += 1
+        tracklet.last_sent = timestamp
+        tracklet.best_sent = max(tracklet.best_sent, quality)
+        self.selected += 1
+        return tracklet.track_id, frame, box, crop
+
+    def select(self, timestamp):
+        """
+        Crops to send now as (track_id, frame, box, crop). Tracklets not
+        seen for max_age seconds are dropped, sending their best crop first
+        when they never sent one and lasted at least flush_hits frames.
+        """
+        chosen = []
+        for track_id, tracklet in list(self.tracklets.items()):
+            if timestamp - tracklet.last_seen > self.max_age:
+                del self.tracklets[track_id]
+                # Short tracklets never reach min_hits, they still get one crop
+                if (
+                    tracklet.sends == 0
+                    and tracklet.pending is not None
+                    and tracklet.hits >= self.flush_hits
+                ):
+                    chosen.append(self._take(tracklet, timestamp))
+            elif self._ready(tracklet, timestamp):
+                chosen.append(self._take(tracklet, timestamp))
+        return chosen
+
+    def get_status(self):
+        return {
+            "tracklets": self.next_id - 1,
+            "active": len(self.tracklets),
+            "detections": self.detections,
+            "selected": self.selected,
+        }